@@ -1,12 +1,23 @@
+import argparse
 import os
 
-from agent.flow.caption_flow import caption_flow
+from agent.flow.caption_flow import caption_flow, watch_caption_flow
 from agent.flow.weaver_flow import weaver_flow
 
 root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 if __name__ == "__main__":
-    db_path = os.path.join(root_dir, 'db/image_database.db')
-    image_dir = os.path.join(root_dir, "example")
-    caption_flow(image_dir, db_path)
-    weaver_flow(image_id_list=[], db_path=db_path)
+    parser = argparse.ArgumentParser(description="图片识别与剧本创作")
+    parser.add_argument("--image-dir", default=os.path.join(root_dir, "example"), help="图片目录")
+    parser.add_argument("--db-path", default=os.path.join(root_dir, 'db/image_database.db'), help="数据库路径")
+    parser.add_argument("--watch", action="store_true", help="常驻监听模式：按间隔增量扫描目录并识别新图片")
+    parser.add_argument("--interval", type=float, default=30, help="监听模式的扫描间隔（秒）")
+    parser.add_argument("--settle-seconds", type=float, default=5,
+                        help="监听模式下修改时间距今不足该秒数的文件视为仍在写入，留到下一轮")
+    args = parser.parse_args()
+
+    if args.watch:
+        watch_caption_flow(args.image_dir, args.db_path, interval=args.interval, settle_seconds=args.settle_seconds)
+    else:
+        caption_flow(args.image_dir, args.db_path)
+        weaver_flow(image_id_list=[], db_path=args.db_path)
@@ -1,18 +1,38 @@
 
+import time
+
+from loguru import logger
 from pocketflow import Node, Flow
 
 from agent.node.caption_node import ImageCaptionNode, ImageDescStructNode
 
-def caption_flow(image_dir,db_path):
+def caption_flow(image_dir, db_path, max_in_flight=None, settle_seconds=0, stream=None):
     # Create nodes
     image_caption = ImageCaptionNode()
     image_desc_struct = ImageDescStructNode()
     # Connect nodes
-    image_caption - "finish" >> image_desc_struct
+    image_caption - "desc" >> image_desc_struct
     # Create and run flow
     flow = Flow(start=image_caption)
-    shared = {"image_dir": image_dir, "db_path":db_path }
+    shared = {"image_dir": image_dir, "db_path": db_path, "caption_max_in_flight": max_in_flight,
+              "caption_settle_seconds": settle_seconds, "caption_stream": stream}
     flow.run(shared)
+    return shared
+
+
+def watch_caption_flow(image_dir, db_path, interval=30, max_in_flight=None, settle_seconds=5):
+    """
+    常驻监听模式：按固定间隔增量扫描目录，识别新落盘或变更的图片。
+
+    每轮只对文件做 stat 并与扫描清单比较，目录未变化时几乎没有开销。
+    """
+    logger.info(f"开始监听目录 {image_dir}，扫描间隔 {interval}s")
+    while True:
+        try:
+            caption_flow(image_dir, db_path, max_in_flight=max_in_flight, settle_seconds=settle_seconds)
+        except Exception as e:
+            logger.error(f"监听模式本轮识别失败: {e}")
+        time.sleep(interval)
 
 
 
@@ -1,7 +1,9 @@
+import os
+
 from pocketflow import Node, Flow
 
 from agent.node.batch_node import BatchI2VideoAndAudio
-from agent.node.weaver_node import PicWeaverNode
+from agent.node.weaver_node import ChunkOutlineNode, ImageSelectNode, PicWeaverNode
 
 
 class NoOp(Node):
@@ -9,15 +11,26 @@ class NoOp(Node):
     pass
 
 
-def weaver_flow(image_id_list, db_path):
+def weaver_flow(image_id_list, db_path, theme=None, mode=None):
+    """
+    :param mode: select（按预算筛选图片后一次创作）或 map_reduce（大相册分段概括后再创作），
+                 默认读取环境变量 WEAVER_MODE
+    """
+    mode = mode or os.getenv("WEAVER_MODE", "select")
     # Create nodes
     pic_weaver = PicWeaverNode()
     end = NoOp()
     # Connect nodes
+    if mode == "map_reduce":
+        start = ChunkOutlineNode()
+        start - "outlined" >> pic_weaver
+    else:
+        start = ImageSelectNode()
+        start - "selected" >> pic_weaver
     pic_weaver - "done" >> end
     # Create and run flow
-    flow = Flow(start=pic_weaver)
-    shared = {"image_id_list": image_id_list, "db_path": db_path}
+    flow = Flow(start=start)
+    shared = {"image_id_list": image_id_list, "db_path": db_path, "theme": theme}
     flow.run(shared)
 
 
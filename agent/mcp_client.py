@@ -1,4 +1,7 @@
 import os
+import time
+import uuid
+from collections import deque
 
 from dotenv import load_dotenv
 from fastmcp import Client
@@ -7,6 +10,8 @@ import asyncio
 import websockets
 import json
 
+from agent.utils.binary_frame import encode_binary_frame
+
 load_dotenv()
 
 caption_mcp_server_url = os.getenv("CAPTION_MCP_SERVER_URL")
@@ -43,7 +48,7 @@ async def mcp_call_tool(tool_name=None, arguments=None):
             logger.info(f"客户端已连接: {client.is_connected()}")
             tools = await client.list_tools()
             if any(tool.name == tool_name for tool in tools):
-                print(f"调用工具: {tool_name}")
+                logger.info(f"调用工具: {tool_name}")
                 result = await client.call_tool(name=tool_name, arguments=arguments)
                 if result:
                     content = result[0].text
@@ -55,32 +60,219 @@ async def mcp_call_tool(tool_name=None, arguments=None):
         logger.error(f"MCP 调用失败: {e}", exc_info=True)
         raise
 
-async def fancy_feast_mcp_server(payload):
+def _encode_message(payload, blobs=None):
+    """无字节块时使用旧的 JSON 文本消息，否则编码为二进制帧（图片以原始字节传输）"""
+    if blobs:
+        return encode_binary_frame(payload, blobs)
+    return json.dumps(payload)
+
+
+class _PooledConnection:
+    """
+    连接池中的一条 WebSocket 长连接。后台读取协程按 request_id 把响应分发给对应请求，
+    同一连接上可以同时有多个未完成的请求。
+    """
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.ws = None
+        self.reader = None
+        self.pending = {}  # request_id -> (future, on_partial)
+        self.open_lock = asyncio.Lock()
+
+    @property
+    def is_open(self):
+        return self.ws is not None and self.reader is not None and not self.reader.done()
+
+    async def open(self):
+        # 二进制帧可能包含较大的图片，取消默认 1MB 的消息大小限制
+        self.ws = await websockets.connect(self.uri, max_size=None)
+        self.reader = asyncio.create_task(self._read_loop())
+        logger.info(f"已连接到MCP服务器: {self.uri}")
+
+    async def _read_loop(self):
+        try:
+            async for message in self.ws:
+                response = json.loads(message)
+                request_id = response.pop("request_id", None)
+                if request_id is None and len(self.pending) == 1:
+                    # 旧服务端不回传 request_id，连接上只有一个请求时直接对应
+                    request_id = next(iter(self.pending))
+                entry = self.pending.get(request_id)
+                if entry is None:
+                    logger.warning(f"收到无法对应请求的响应: {request_id}")
+                    continue
+                future, on_partial = entry
+                if response.get("type") == "partial":
+                    if on_partial is not None:
+                        on_partial(response)
+                    continue
+                del self.pending[request_id]
+                if not future.done():
+                    future.set_result(response)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            error = ConnectionError(f"与 {self.uri} 的连接已断开")
+            for future, _ in self.pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self.pending.clear()
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self.reader is not None:
+            await asyncio.gather(self.reader, return_exceptions=True)
+
+
+class MultiplexedWebSocketClient:
+    """
+    长连接、多路复用的 WebSocket 客户端。
+
+    - 每个服务地址维护一个连接池，新请求分配到未完成请求最少的连接；
+    - 每个请求带 request_id，同一连接上可同时有多个请求在途；
+    - 连接断开时自动重连并重发受影响的请求；
+    - 记录每个请求的耗时，可通过 stats() 查看。
+
+    连接绑定在事件循环上，检测到事件循环变化（如多次 asyncio.run）时会丢弃旧连接重新建立。
+    """
+
+    def __init__(self, pool_size: int = 2, max_retries: int = 2, latency_window: int = 1000,
+                 request_timeout: float = None):
+        self.pool_size = max(1, pool_size)
+        self.max_retries = max_retries
+        # 未单独指定超时的请求使用该值，None 表示不超时
+        self.request_timeout = request_timeout
+        self._pools = {}
+        self._loop = None
+        self._latencies = {}
+        self._latency_window = latency_window
+
+    async def _acquire(self, uri) -> _PooledConnection:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._pools = {}
+        pool = self._pools.setdefault(uri, [])
+        if len(pool) < self.pool_size:
+            pool.append(_PooledConnection(uri))
+        conn = min(pool, key=lambda c: len(c.pending))
+        if not conn.is_open:
+            # 并发请求可能同时发现连接未建立，加锁保证只建立一次
+            async with conn.open_lock:
+                if not conn.is_open:
+                    await conn.open()
+        return conn
+
+    async def call(self, uri, payload, blobs=None, on_partial=None, timeout=None) -> dict:
+        """
+        发送一个请求并等待最终响应（流式 partial 帧交给 on_partial 处理）。
+
+        :param uri: 服务地址
+        :param payload: 请求（tool、params）
+        :param blobs: 可选的 (名称, 原始字节) 列表，提供时以二进制帧发送
+        :param on_partial: 可选回调，收到 partial 帧时调用
+        :param timeout: 单次请求超时秒数，None 表示使用 request_timeout
+        :return: 响应字典，附带 latency（秒）
+        :raises asyncio.TimeoutError: 超时未收到最终响应
+        """
+        if timeout is None:
+            timeout = self.request_timeout
+        for attempt in range(self.max_retries + 1):
+            conn = await self._acquire(uri)
+            request_id = uuid.uuid4().hex
+            future = asyncio.get_running_loop().create_future()
+            conn.pending[request_id] = (future, on_partial)
+            start_time = time.time()
+            try:
+                await conn.ws.send(_encode_message(dict(payload, request_id=request_id), blobs))
+                response = await asyncio.wait_for(future, timeout)
+            except (ConnectionError, websockets.ConnectionClosed) as e:
+                conn.pending.pop(request_id, None)
+                # 发送失败时读取协程可能已为该请求设置了异常，取走它避免未处理异常告警
+                if future.done() and not future.cancelled():
+                    future.exception()
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"第 {attempt + 1} 次请求 {uri} 时连接断开，重连后重试: {e}")
+                continue
+            except BaseException:
+                conn.pending.pop(request_id, None)
+                raise
+            latency = time.time() - start_time
+            self._record_latency(uri, latency)
+            response["latency"] = latency
+            return response
+
+    def _record_latency(self, uri, latency):
+        latencies = self._latencies.setdefault(uri, deque(maxlen=self._latency_window))
+        latencies.append(latency)
+
+    def stats(self) -> dict:
+        """各服务地址最近请求的耗时统计（秒）"""
+        result = {}
+        for uri, latencies in self._latencies.items():
+            ordered = sorted(latencies)
+            result[uri] = {
+                "count": len(ordered),
+                "avg": sum(ordered) / len(ordered),
+                "p50": ordered[len(ordered) // 2],
+                "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                "max": ordered[-1],
+            }
+        return result
+
+    async def close(self):
+        """关闭所有连接"""
+        for pool in self._pools.values():
+            for conn in pool:
+                await conn.close()
+        self._pools = {}
+
+
+ws_client = MultiplexedWebSocketClient(pool_size=int(os.getenv("MCP_WS_POOL_SIZE", "2")),
+                                       request_timeout=float(os.getenv("MCP_REQUEST_TIMEOUT", "600")) or None)
+
+
+async def fancy_feast_mcp_server(payload, blobs=None):
+    """
+    调用图片描述服务。流式请求（params 中 stream 为 True）时服务端会先推送若干
+    {"type": "partial"} 文本帧，这里持续接收直到最终结果，并在结果中附带客户端侧的首字延迟 ttft（秒）。
+
+    :param payload: 请求（tool、params）
+    :param blobs: 可选的 (名称, 原始字节) 列表，提供时以二进制帧发送，params 应为字典
+    """
     uri = os.getenv("FAMCY_MS_MCP_SERVER_URL")
+    start_time = time.time()
+    first_token = []
+
+    def _on_partial(frame):
+        if not first_token:
+            first_token.append(time.time() - start_time)
+            logger.info(f"首字延迟：{first_token[0]:.2f}s")
+
     try:
-        async with websockets.connect(uri) as ws:
-            print("已连接到MCP服务器")
-            await ws.send(json.dumps(payload))
-            response = await ws.recv()
-            print("来自服务器的响应:")
-            print(json.dumps(json.loads(response), indent=2, ensure_ascii=False))
-            return json.loads(response)
-    except Exception as e:
-        print(f"WebSocket错误: {e}")
+        response = await ws_client.call(uri, payload, blobs=blobs, on_partial=_on_partial)
+        logger.info(f"来自服务器的响应，耗时 {response['latency']:.2f}s")
+        response["ttft"] = first_token[0] if first_token else response["latency"]
+        return response
+    except asyncio.TimeoutError:
+        logger.error(f"请求 {uri} 超时（{ws_client.request_timeout}s）")
+    except Exception:
+        logger.exception(f"请求 {uri} 失败")
 
 
-async def comfyui_mcp_server(payload):
+async def comfyui_mcp_server(payload, blobs=None):
     uri = os.getenv("COMFYUI_MS_MCP_SERVER_URL")
     try:
-        async with websockets.connect(uri) as ws:
-            print("已连接到MCP服务器")
-            await ws.send(json.dumps(payload))
-            response = await ws.recv()
-            print("来自服务器的响应:")
-            print(json.dumps(json.loads(response), indent=2, ensure_ascii=False))
-
-    except Exception as e:
-        print(f"WebSocket错误: {e}")
+        response = await ws_client.call(uri, payload, blobs=blobs)
+        logger.info(f"来自服务器的响应: {json.dumps(response, indent=2, ensure_ascii=False)}")
+        return response
+    except asyncio.TimeoutError:
+        logger.error(f"请求 {uri} 超时（{ws_client.request_timeout}s）")
+    except Exception:
+        logger.exception(f"请求 {uri} 失败")
 
 
 if __name__ == "__main__":
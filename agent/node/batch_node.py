@@ -1,10 +1,11 @@
 import asyncio
 import json
+import os
 
 from pocketflow import Node
 from loguru import logger
 
-from agent.mcp_client import comfyui_mcp_server
+from agent.mcp_client import comfyui_mcp_server, ws_client
 from database.db_manager import DatabaseManager
 from database.image_manager import ImageDBManager
 
@@ -50,6 +51,17 @@ class BatchI2VideoAndAudio(Node):
 
     def exec(self, input):
         result, tags, lyrics = input
+        # 所有请求在同一个事件循环中执行，复用到服务端的长连接
+        asyncio.run(self._generate_all(result, tags, lyrics))
+        return "finish"
+
+    async def _generate_all(self, result, tags, lyrics):
+        try:
+            await self._generate(result, tags, lyrics)
+        finally:
+            await ws_client.close()
+
+    async def _generate(self, result, tags, lyrics):
         audio_workflow_id = "audio_ace_step_api"
 
         payload = {
@@ -60,23 +72,28 @@ class BatchI2VideoAndAudio(Node):
                 "workflow_id": audio_workflow_id
             })
         }
-        asyncio.run(comfyui_mcp_server(payload))
+        await comfyui_mcp_server(payload)
 
         i2v_workflow_id = "hy_image_to_video_api"
 
+        # 二进制帧协议：直接发送图片字节，服务端无需访问本机路径
+        binary = os.getenv("MCP_BINARY_PROTOCOL", "true").lower() == "true"
         for ret in result:
             image_path = ret["image_path"]
             prompt = ret["video_prompt"]
-            payload = {
-                "tool": "generate_image_to_video",
-                "params": json.dumps({
-                    "prompt": prompt,
-                    "image_path": image_path,
-                    "workflow_id": i2v_workflow_id
-                })
+            params = {
+                "prompt": prompt,
+                "image_path": image_path,
+                "workflow_id": i2v_workflow_id
             }
-            asyncio.run(comfyui_mcp_server(payload))
-        return "finish"
+            if binary and image_path and os.path.exists(image_path):
+                with open(image_path, "rb") as image_file:
+                    blobs = [("image", image_file.read())]
+                payload = {"tool": "generate_image_to_video", "params": params}
+                await comfyui_mcp_server(payload, blobs=blobs)
+            else:
+                payload = {"tool": "generate_image_to_video", "params": json.dumps(params)}
+                await comfyui_mcp_server(payload)
 
     def post(self, shared, prep_res, exec_res):
 
@@ -1,15 +1,17 @@
 import asyncio
 import json
-import os.path
+import os
 import time
-from time import sleep
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from loguru import logger
 from pocketflow import Node
 
-from agent.tools.image_desc_structure import analyze_image_structure
-from agent.utils.image import batch_read_images, batch_convert_to_base64
-from agent.mcp_client import mcp_call_tool, fancy_feast_mcp_server
+from agent.tools.image_desc_structure import analyze_image_structure, analyze_image_structures
+from agent.utils.image import iter_scan_changed_images, iter_load_images, encode_image_for_upload, \
+    prepare_image_for_upload
+from agent.utils.adaptive_executor import run_adaptive
+from agent.mcp_client import mcp_call_tool, fancy_feast_mcp_server, ws_client
 from database.db_manager import DatabaseManager
 from database.image_manager import ImageDBManager
 
@@ -44,67 +46,233 @@ class ImageCaptionNode(Node):
 
     def prep(self, shared):
         """Prepare tool execution parameters"""
-        return shared["image_dir"], shared["db_path"]
+        # 同时在途的识别请求数，未指定时读取环境变量 CAPTION_MAX_IN_FLIGHT
+        max_in_flight = shared.get("caption_max_in_flight") or int(os.getenv("CAPTION_MAX_IN_FLIGHT", "4"))
+        # 上传前的图片预处理参数：最长边像素（<=0 表示上传原图）、编码格式与质量
+        upload_options = {
+            "max_edge": int(os.getenv("CAPTION_IMAGE_MAX_EDGE", "1024")),
+            "image_format": os.getenv("CAPTION_IMAGE_FORMAT", "JPEG"),
+            "quality": int(os.getenv("CAPTION_IMAGE_QUALITY", "90")),
+        }
+        # 监听模式下，修改时间距今不足该秒数的文件视为仍在写入，留到下一轮扫描
+        settle_seconds = shared.get("caption_settle_seconds", 0)
+        # 流式识别：服务端逐段推送文本，可观察首字延迟；流式请求不参与服务端微批合并
+        stream = shared.get("caption_stream")
+        if stream is None:
+            stream = os.getenv("CAPTION_STREAM", "false").lower() == "true"
+        upload_options["stream"] = stream
+        # 二进制帧协议：图片以原始字节发送，避免 Base64 膨胀和多次 JSON 复制；关闭时使用旧的 JSON 格式
+        upload_options["binary"] = os.getenv("MCP_BINARY_PROTOCOL", "true").lower() == "true"
+        return shared["image_dir"], shared["db_path"], max(1, max_in_flight), upload_options, settle_seconds
 
     def exec(self, input):
         """Execute the chosen tool"""
-        image_dir, db_path = input
-        logger.info(f"开始执行图片描述任务")
-        image_paths = batch_read_images(image_dir)
-        logger.info(f"图片数量：{len(image_paths)}")
-
-        image_base64_list = batch_convert_to_base64(image_paths)
+        image_dir, db_path, max_in_flight, upload_options, settle_seconds = input
+        logger.info(f"开始执行图片描述任务，最大并发请求数：{max_in_flight}，上传预处理：{upload_options}")
 
         # tool_name = "generate_image_caption"
         db_manager = DatabaseManager(db_path=db_path)
         db_manager.connect()
+        db_manager.create_image_info_table()  # 确保表结构及内容哈希索引存在
+        db_manager.create_scan_manifest_table()
         image_db = ImageDBManager(db_manager)
-        image_info_list = []
-        for idx, item in enumerate(image_base64_list):
-            # parameters = {
-            #     "image_base64": item["base64_image"]
-            # }
-            start_time = time.time()
 
-            image_path = item['image_path']
+        # 扫描清单：只 stat 文件，大小与修改时间未变的文件不再查库、不再读取
+        manifest = db_manager.get_scan_manifest(os.path.join(image_dir, ""))
+        scanned = {}
+        seen = set()
+
+        def _changed_paths():
+            for image_path, file_size, mtime_ns in iter_scan_changed_images(image_dir, manifest, seen,
+                                                                            settle_seconds):
+                scanned[image_path] = (file_size, mtime_ns)
+                yield image_path
 
+        def _record(image_path, content_hash=None):
+            file_size, mtime_ns = scanned.pop(image_path)
+            db_manager.upsert_scan_manifest(image_path, file_size, mtime_ns, content_hash)
+
+        def _is_processed(image_path):
+            # 先查库再读文件：已识别的图片不会被读取和编码
+            if image_path in manifest:
+                # 清单中已有但大小/修改时间变化，需读取内容进一步判断
+                logger.info(f"`{image_path}` 文件已变更。")
+                return False
             if db_manager.is_image_path_exists(image_path):
                 logger.info(f"`{image_path}` 存在于数据库中,不做识别更新。")
-                continue
+                _record(image_path)
+                return True
+            logger.info(f"`{image_path}` 不存在于数据库中。")
+            return False
+
+        def _is_duplicate(image_path, content_hash):
+            known = manifest.get(image_path)
+            if known is not None and known[2] == content_hash:
+                # 仅修改时间变化（如被 touch），内容未变
+                _record(image_path, content_hash)
+                return True
+            # 内容已识别过（重命名或换目录同步）：关联新路径，复用已有描述
+            image_id = image_db.link_duplicate_image(image_path, content_hash)
+            if image_id is not None:
+                logger.info(f"`{image_path}` 与图片ID {image_id} 内容相同，已关联路径，不做识别。")
+                _record(image_path, content_hash)
+                return True
+            return False
+
+        # 流式管道：增量扫描 -> 按路径/内容哈希查库过滤 -> 进程池缩放编码 -> 发送
+        image_items = iter_load_images(_changed_paths(), skip=_is_processed, skip_hash=_is_duplicate)
+
+        preprocess_workers = int(os.getenv("CAPTION_PREPROCESS_WORKERS", "0")) or None
+        try:
+            with ProcessPoolExecutor(max_workers=preprocess_workers) as preprocess_pool:
+                image_info_list = asyncio.run(
+                    self._caption_all_and_close(image_items, image_db, max_in_flight, preprocess_pool,
+                                                upload_options, on_stored=_record))
+            # 清理已删除文件的清单记录
+            removed = [image_path for image_path in manifest if image_path not in seen]
+            if removed:
+                db_manager.delete_scan_manifest(removed)
+        finally:
+            db_manager.close()
+
+        logger.info(f"新识别图片数量：{len(image_info_list)}")
+        return image_info_list
+
+    async def _caption_all_and_close(self, *args, **kwargs):
+        """识别结束后关闭到识别服务的长连接（连接绑定在本次事件循环上）"""
+        try:
+            return await self._caption_all(*args, **kwargs)
+        finally:
+            logger.info(f"识别请求耗时统计：{ws_client.stats()}")
+            await ws_client.close()
+
+    async def _caption_all(self, image_items, image_db, max_in_flight, preprocess_pool, upload_options,
+                           on_stored=None):
+        """
+        以固定大小的在途窗口并发识别图片。
+
+        只有窗口中有请求完成、空出槽位时才会从生成器读取下一张图片，
+        服务端变慢时客户端随之放缓（背压），内存中最多保留 max_in_flight 张图片。
+        每个请求完成后立即写入数据库，并以 (image_path, content_hash) 调用 on_stored。
+
+        读取文件、计算哈希与读写数据库都在同一个后台线程中依次执行，不阻塞事件循环，
+        也不会在多个线程中同时使用同一个数据库连接。单张图片失败时记录错误并继续。
+        """
+        loop = asyncio.get_running_loop()
+        image_info_list = []
+        pending = set()
+        idx = 0
+        exhausted = False
+        with ThreadPoolExecutor(max_workers=1) as io_pool:
+            try:
+                while True:
+                    while not exhausted and len(pending) < max_in_flight:
+                        item = await loop.run_in_executor(io_pool, next, image_items, None)
+                        if item is None:
+                            exhausted = True
+                            break
+                        pending.add(asyncio.create_task(
+                            self._caption_one(idx, item, preprocess_pool, upload_options), name=item['image_path']))
+                        idx += 1
+
+                    if not pending:
+                        break
+
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        try:
+                            image_info = task.result()
+                            if image_info is None:
+                                continue
+                            if await loop.run_in_executor(io_pool, self._store, image_db, image_info, on_stored):
+                                image_info_list.append(image_info)
+                        except Exception as e:
+                            logger.error(f"`{task.get_name()}` 识别或写库失败，跳过该图片，下次运行会重新识别：{e!r}")
+            finally:
+                # 出错或被取消时不再等待剩余请求
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+        return image_info_list
+
+    @staticmethod
+    def _store(image_db, image_info, on_stored=None) -> bool:
+        """写入识别结果，返回是否新增或更新了描述（仅关联路径时返回 False）"""
+        image_path, content_hash = image_info['image_path'], image_info['content_hash']
+        stored = False
+        # 同一批次中内容相同的图片可能同时在途，先完成的写库，后完成的只关联路径
+        if image_db.link_duplicate_image(image_path, content_hash) is None:
+            image_id = image_db.db_manager.get_image_id_by_path(image_path)
+            if image_id is not None:
+                # 同一路径的文件内容已变更，覆盖原记录的描述
+                image_db.update_processed_image(image_id, image_description=image_info['image_desc'],
+                                                content_hash=content_hash)
             else:
-                logger.info(f"`{image_path}` 不存在于数据库中。")
+                image_id = image_db.process_and_store_image(image_info['image_name'], image_path,
+                                                            image_info['image_desc'],
+                                                            lens="",
+                                                            composition="", visual_style="",
+                                                            content_hash=content_hash)
+            image_info['image_id'] = image_id
+            stored = True
+        if on_stored is not None:
+            on_stored(image_path, content_hash)
+        return stored
 
-            # result = asyncio.run(mcp_call_tool(tool_name, parameters))
+    async def _caption_one(self, idx, item, preprocess_pool, upload_options):
+        """识别单张图片，失败时返回 None（不写库，下次运行会重新识别）"""
+        start_time = time.time()
+        image_path = item['image_path']
+        file_name = item['image_name']
+
+        # 缩放与重新编码是 CPU 密集操作，放到进程池中执行，不阻塞事件循环
+        image_data = item.pop("image_data")
+        encode_fn = prepare_image_for_upload if upload_options["binary"] else encode_image_for_upload
+        try:
+            upload_data = await asyncio.get_running_loop().run_in_executor(
+                preprocess_pool, encode_fn, image_data, upload_options["max_edge"],
+                upload_options["image_format"], upload_options["quality"])
+        except Exception as e:
+            logger.error(f"第{idx}张图预处理失败，图片文件名称：{file_name}，错误：{e}")
+            return None
+        logger.info(f"第{idx}张图上传大小：{len(image_data)} -> {len(upload_data)} 字节")
+        del image_data
+
+        # result = await mcp_call_tool(tool_name, parameters)
+        if upload_options["binary"]:
+            payload = {
+                "tool": "generate_image_caption",
+                "params": {"stream": upload_options["stream"]}
+            }
+            result = await fancy_feast_mcp_server(payload, blobs=[("image", upload_data)])
+        else:
             payload = {
                 "tool": "generate_image_caption",
                 "params": json.dumps({
-                    "image_base64": item["base64_image"],
+                    "image_base64": upload_data,
+                    "stream": upload_options["stream"],
                 })
             }
-            result = asyncio.run(fancy_feast_mcp_server(payload))
-
-            text = json.loads(result)["result"]
-            logger.info(f"图片描述：{text}")
-            _, _, image_desc = extract_sections(text)
-
-            file_name = os.path.basename(image_path)
-            sleep(10)
-
-            end_time = time.time()
-            duration_time = (end_time - start_time) / 1000
-            logger.info(f"第{idx}张图，图片文件名称：{file_name}，\n 图片描述：{image_desc}，\n 耗时：{duration_time}s")
-            image_id = image_db.process_and_store_image(item['image_name'], item['image_path'], item['image_desc'],
-                                                        lens="",
-                                                        composition="", visual_style="")
-            image_info_list.append({
-                'image_id': image_id,
-                'image_path': image_path,
-                'image_name': file_name,
-                'image_desc': image_desc
-            })
-
-        db_manager.close()
-        return image_info_list
+            result = await fancy_feast_mcp_server(payload)
+        if not result or "result" not in result:
+            logger.error(f"第{idx}张图识别失败，图片文件名称：{file_name}，返回：{result}")
+            return None
+
+        text = result["result"]
+        logger.info(f"图片描述：{text}")
+        _, _, image_desc = extract_sections(text)
+
+        duration_time = time.time() - start_time
+        logger.info(f"第{idx}张图，图片文件名称：{file_name}，\n 图片描述：{image_desc}，\n 耗时：{duration_time}s，"
+                    f"首字延迟：{result.get('ttft')}s")
+        return {
+            'image_path': image_path,
+            'image_name': file_name,
+            'content_hash': item['content_hash'],
+            'image_desc': image_desc,
+            'ttft': result.get('ttft'),
+            'duration': duration_time
+        }
 
     def post(self, shared, prep_res, exec_res):
         image_info_list = exec_res
@@ -120,28 +288,64 @@ class ImageDescStructNode(Node):
 
     def prep(self, shared):
         """Prepare tool execution parameters"""
-        return shared["image_info_list"]
+        # 每次请求携带的描述条数，<=1 时逐条分析
+        batch_size = shared.get("struct_batch_size") or int(os.getenv("STRUCT_BATCH_SIZE", "8"))
+        # 并发执行参数：最大并发请求数、每秒请求数上限（0 不限速）、视为健康的单次调用耗时
+        executor_options = {
+            "max_workers": shared.get("struct_max_workers") or int(os.getenv("STRUCT_MAX_WORKERS", "4")),
+            "rate": float(os.getenv("STRUCT_RATE_PER_SECOND", "0")),
+            "latency_target": float(os.getenv("STRUCT_LATENCY_TARGET", "30")),
+        }
+        return shared["image_info_list"], shared.get("db_path"), batch_size, executor_options
 
-    def exec(self, image_info_list):
-        for item in image_info_list:
-            lens, composition, visual_style = analyze_image_structure(item['image_desc'])
+    def exec(self, input):
+        image_info_list, db_path, batch_size, executor_options = input
+        if not image_info_list:
+            return image_info_list
+        batches = [image_info_list[start:start + max(1, batch_size)]
+                   for start in range(0, len(image_info_list), max(1, batch_size))]
+        logger.info(f"开始结构化图片描述，共 {len(image_info_list)} 条，{len(batches)} 次请求，并发参数：{executor_options}")
 
-            item['lens'] = lens
-            item['composition'] = composition
-            item['visual_style'] = visual_style
-            logger.info(f"镜头：{lens}\n 图片结构：{composition}\n 视觉风格：{visual_style}")
+        db = DatabaseManager(db_path=db_path) if db_path else DatabaseManager()
+        db.connect()
+        image_db = ImageDBManager(db)
+        try:
+            # 各批次并发请求，每完成一个批次立即写库
+            for batch, results, error in run_adaptive(self._analyze, batches, **executor_options):
+                if error is not None:
+                    logger.error(f"图片描述结构化失败，图片ID：{[item['image_id'] for item in batch]}，错误：{error}")
+                    continue
+                for item in batch:
+                    self._apply(item, *results[item['image_id']])
+                    try:
+                        image_db.update_processed_image(item['image_id'], item['image_name'], item['image_path'],
+                                                        item['image_desc'],
+                                                        lens=item['lens'],
+                                                        composition=item['composition'],
+                                                        visual_style=item['visual_style'])
+                    except Exception as e:
+                        # 单条写库失败不影响其余结果与后续的向量补齐
+                        logger.error(f"图片ID {item['image_id']} 的结构化结果写库失败：{e!r}")
+            # 写库时不生成向量，全部写完后批量补齐
+            db.sync_embeddings()
+        finally:
+            db.close()
         return image_info_list
 
+    @staticmethod
+    def _analyze(batch):
+        if len(batch) == 1:
+            return {batch[0]['image_id']: analyze_image_structure(batch[0]['image_desc'])}
+        # 批量模式：多条描述合并为一次请求，按图片ID取回各自的结果
+        return analyze_image_structures({item['image_id']: item['image_desc'] for item in batch})
+
+    @staticmethod
+    def _apply(item, lens, composition, visual_style):
+        item['lens'] = lens
+        item['composition'] = composition
+        item['visual_style'] = visual_style
+        logger.info(f"镜头：{lens}\n 图片结构：{composition}\n 视觉风格：{visual_style}")
+
     def post(self, shared, prep_res, exec_res):
-        image_info_list = exec_res
-        db = DatabaseManager()
-        db.connect()
-        image_db = ImageDBManager(db)
-        for item in image_info_list:
-            image_db.update_processed_image(item['image_id'], item['image_name'], item['image_path'],
-                                            item['image_desc'],
-                                            lens=item['lens'],
-                                            composition=item['composition'],
-                                            visual_style=item['visual_style'])
-        db.close()
+        # 结果已在 exec 中随完成随写库
         return "finish"
@@ -1,30 +1,158 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from pocketflow import Node
-import yaml
 
-from agent.utils.call_llm import call_llm
+from agent.tools.image_selection import estimate_tokens, format_image_block, select_images
+from agent.tools.script_scoring import MUSIC_TAGS_TEXT, SCRIPT_SCHEMA, score_script
+from agent.tools.story_outline import chunk_by_similarity, chunk_by_time, format_outline_block, reduce_outlines, \
+    summarize_chunk
+from agent.utils.adaptive_executor import run_adaptive
+from agent.utils.structured_output import call_llm_structured
+from agent.utils.image import get_capture_time
 from loguru import logger
 
 from database.db_manager import DatabaseManager
 from database.image_manager import ImageDBManager
+from database.vector_index import VectorIndex, vector_index_enabled
+
+
+def _load_image_info_list(shared) -> list:
+    db = DatabaseManager(db_path=shared["db_path"])
+    db.connect()
+    image_db = ImageDBManager(db)
+    image_info_list = image_db.get_all_processed_images(shared["image_id_list"])
+    db.close()
+    return image_info_list
+
+
+class ImageSelectNode(Node):
+    """
+    剧本创作前的图片筛选：按 token 预算挑选相关且多样的图片子集，
+    避免素材库增大后剧本提示词超出模型上下文。
+    """
+
+    def prep(self, shared):
+        theme = shared.get("theme")
+        options = {
+            "token_budget": int(os.getenv("WEAVER_IMAGE_TOKEN_BUDGET", "6000")),
+            "diversity": float(os.getenv("WEAVER_SELECT_DIVERSITY", "0.5")),
+            "max_images": int(os.getenv("WEAVER_MAX_IMAGES", "0")),
+            "theme": theme,
+            "candidate_limit": int(os.getenv("WEAVER_SELECT_CANDIDATES", "1000")),
+        }
+        if theme and vector_index_enabled():
+            # 有创作主题时，先用向量索引召回与主题最相近的候选图片
+            db = DatabaseManager(db_path=shared["db_path"])
+            db.connect()
+            hits = VectorIndex(db).search_text(theme, top_k=int(os.getenv("WEAVER_RETRIEVE_TOP_K", "200")),
+                                               id_filter=shared["image_id_list"] or None)
+            image_info_list = db.get_all_image_info([image_id for image_id, _ in hits]) if hits else []
+            db.close()
+            options["relevance_scores"] = dict(hits)
+            logger.info(f"按主题“{theme}”召回候选图片 {len(image_info_list)} 张")
+            return image_info_list, options
+
+        # 未启用向量索引时，主题相关度由 select_images 按词项向量计算
+        image_info_list = _load_image_info_list(shared)
+        if not theme and vector_index_enabled():
+            # 代表性用预先计算的描述向量求得，筛选时只需为候选图片计算词项向量
+            db = DatabaseManager(db_path=shared["db_path"])
+            db.connect()
+            options["relevance_scores"] = VectorIndex(db).centroid_scores(
+                [item["id"] for item in image_info_list])
+            db.close()
+        return image_info_list, options
+
+    def exec(self, prep_res):
+        image_info_list, options = prep_res
+        return select_images(image_info_list, **options)
+
+    def post(self, shared, prep_res, exec_res):
+        shared["image_info_list"] = exec_res
+        return "selected"
+
+
+class ChunkOutlineNode(Node):
+    """
+    大相册的分段概括（map 阶段）：按拍摄时间或画面相似度把图片分段，
+    各段并发概括为小段大纲并挑出关键图片，最终剧本只基于大纲与关键图片创作（reduce 阶段）。
+    """
+
+    def prep(self, shared):
+        image_info_list = _load_image_info_list(shared)
+        token_budget = int(os.getenv("WEAVER_IMAGE_TOKEN_BUDGET", "6000"))
+        max_chunk_size = int(os.getenv("WEAVER_CHUNK_SIZE", "40"))
+        chunk_by = os.getenv("WEAVER_CHUNK_BY", "time")
+        if chunk_by == "similarity" and not vector_index_enabled():
+            logger.warning("未启用向量索引（VECTOR_INDEX_ENABLED=false），改为按拍摄时间分段")
+            chunk_by = "time"
+        if chunk_by == "similarity":
+            db = DatabaseManager(db_path=shared["db_path"])
+            db.connect()
+            vectors = VectorIndex(db).get_vectors([item["id"] for item in image_info_list])
+            db.close()
+            chunks = chunk_by_similarity(image_info_list, vectors, token_budget, max_chunk_size)
+        else:
+            capture_times = {item["id"]: get_capture_time(item["image_path"]) for item in image_info_list}
+            chunks = chunk_by_time(image_info_list, capture_times, token_budget, max_chunk_size,
+                                   gap_seconds=float(os.getenv("WEAVER_CHUNK_TIME_GAP", "10800")))
+        options = {
+            "key_image_count": int(os.getenv("WEAVER_CHUNK_KEY_IMAGES", "4")),
+            "token_budget": token_budget,
+            "outline_share": float(os.getenv("WEAVER_OUTLINE_BUDGET_SHARE", "0.5")),
+        }
+        executor_options = {
+            "max_workers": int(os.getenv("WEAVER_MAX_WORKERS", "4")),
+            "rate": float(os.getenv("STRUCT_RATE_PER_SECOND", "0")),
+            "latency_target": float(os.getenv("STRUCT_LATENCY_TARGET", "30")),
+        }
+        logger.info(f"共 {len(image_info_list)} 张图片，分为 {len(chunks)} 段并发概括")
+        return chunks, image_info_list, options, executor_options
+
+    def exec(self, prep_res):
+        chunks, image_info_list, options, executor_options = prep_res
+        key_image_count = options["key_image_count"]
+        outlines = [None] * len(chunks)
+        for (index, chunk), outline, error in run_adaptive(
+                lambda indexed: summarize_chunk(indexed[1], key_image_count), list(enumerate(chunks)),
+                **executor_options):
+            if error is not None:
+                logger.error(f"第 {index + 1} 段概括失败: {error!r}")
+                outline = {"chunk_theme": "", "summary": "",
+                           "key_image_ids": [item["id"] for item in chunk[:key_image_count]]}
+            outlines[index] = outline
+
+        # 段数很多时大纲本身会挤占关键图片的预算：大纲超出预算的固定份额时逐层合并（reduce），
+        # 剩余预算（至少为份额之外的部分）用于在关键图片中按预算筛选
+        token_budget = options["token_budget"]
+        outline_budget = int(token_budget * options["outline_share"])
+        outlines = reduce_outlines(outlines, outline_budget, token_budget, key_image_count, executor_options)
+        outline_tokens = sum(estimate_tokens(format_outline_block(index, outline))
+                             for index, outline in enumerate(outlines, start=1))
+        image_info_by_id = {item["id"]: item for item in image_info_list}
+        key_images = [image_info_by_id[image_id] for outline in outlines for image_id in outline["key_image_ids"]]
+        key_images = select_images(key_images, token_budget=max(token_budget - outline_budget,
+                                                                  token_budget - outline_tokens))
+        return outlines, key_images
+
+    def post(self, shared, prep_res, exec_res):
+        shared["chunk_outlines"], shared["image_info_list"] = exec_res
+        return "outlined"
 
 
 class PicWeaverNode(Node):
     def prep(self, shared):
         """Prepare tool execution parameters"""
-        db_path = shared["db_path"]
-        image_id_list = shared["image_id_list"]
-        db = DatabaseManager(db_path=db_path)
-        db.connect()
-        image_db = ImageDBManager(db)
-        image_info_list = image_db.get_all_processed_images(image_id_list)
-        db.close()
-
-        return image_info_list
+        # 已经过筛选或分段概括节点时直接使用其结果
+        if "image_info_list" in shared:
+            return shared["image_info_list"], shared.get("chunk_outlines")
+        return _load_image_info_list(shared), None
 
-    def exec(self, image_info_list):
+    def exec(self, prep_res):
         """Execute the chosen tool"""
+        image_info_list, chunk_outlines = prep_res
 
         prompt = """你是一位专业的影视编剧，请基于以下图片信息，为一部科幻动画短片撰写完整的剧本与分镜脚本。
 
@@ -40,7 +168,7 @@ class PicWeaverNode(Node):
 说明：
 - tags 是必须字段，应体现情绪、节奏、乐器等特征。
 
-可选的tags有可选的Tags有：electronic, rock, pop, funk, soul, melodic, surf music, DUBSTEP, OBSCURE, DARKNESS, FEAR, TERROR, cyberpunk, Acid jazz, electro, em, soft electric drums, dark, death rock, metal, hardcore, electric guitar, powerful, bass, drums, Cuban music, salsa, son, Afro-Cuban, traditional Cuban, country rock, folk rock, southern rock, bluegrass, aggressive, Heavy Riffs, Blast Beats, Satanic Black Metal, Galaxy, space, electric guitar, cosmic tides, Galactic dreams, Neon lights, Industrial Techno,    Gothic Rave, city rock, folk rock, southern rock, bluegrass, country rock, folk rock, mandolin, pop, Aggressive, Heavy Riffs, Blast Beats, Satanic Black Metal, Jazz, Electro, 808 bass, smooth flow, party atmosphere, theme, sub bassline, mandarin hip hop, smooth, bassline, fast, hip hop, rap, yachtrck, female singer, catchy, lounge, funny, uplifting, emotive soundscape, dramatic female vocals, sad, traditional)
+可选的tags有可选的Tags有：""" + MUSIC_TAGS_TEXT + """)
 如：
 funk, pop, soul, rock, melodic, guitar, drums, bass, keyboard
 - lyrics 可为空，若提供则需押韵并贴合画面氛围。
@@ -83,29 +211,67 @@ scenes:
 ```
 注意：你将看到多张图像，这些图像可能包含关键人物、场景或情绪线索，请结合图像内容进行剧本创作。
 
-## 图片素材
+"""
+        if chunk_outlines:
+            prompt += """
+## 分段大纲
 
+以下是按顺序排列的相册分段概括，请让故事依次经过这些段落，分镜只使用各段的关键图片。
 """
-        for item in image_info_list:
-            prompt += f"""
-### 图片ID: {item["id"]}
+            for index, outline in enumerate(chunk_outlines, start=1):
+                prompt += format_outline_block(index, outline)
+        prompt += """
+## 图片素材
 
-镜头：{item['lens']}
-构图：{item['composition']}
-视觉风格：{item['visual_style']}
 """
+        for item in image_info_list:
+            prompt += format_image_block(item)
         logger.info(prompt)
-        result, success = call_llm(prompt)
+        valid_image_ids = [item["id"] for item in image_info_list]
+        candidate_count = int(os.getenv("WEAVER_CANDIDATES", "1"))
+        if candidate_count <= 1:
+            script = self._generate(prompt)
+            if script is None:
+                return "无法生成分析结果，请稍后再试。", []
+            score, problems = score_script(script, valid_image_ids)
+            return script, [(score, problems, script)]
 
-        if success:
-            yaml_str = result.split("```yaml")[1].split("```")[0].strip()
-            logger.info(f"分析结果: {yaml_str}")
-            analysis = yaml.safe_load(yaml_str)
-            return analysis
-        else:
-            return "无法生成分析结果，请稍后再试。"
+        # 并发生成多个候选剧本（借助采样得到不同结果），总耗时约等于一次调用
+        def _generate_candidate(_):
+            try:
+                return self._generate(prompt)
+            except Exception as e:
+                logger.error(f"候选剧本生成失败: {e!r}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=candidate_count) as executor:
+            scripts = list(executor.map(_generate_candidate, range(candidate_count)))
+        candidates = []
+        for script in scripts:
+            score, problems = score_script(script, valid_image_ids)
+            if score is not None:
+                candidates.append((score, problems, script))
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+        for rank, (score, problems, _) in enumerate(candidates):
+            logger.info(f"候选剧本 {rank + 1}：得分 {score}，问题：{problems or '无'}")
+        if not candidates:
+            return "无法生成分析结果，请稍后再试。", []
+        return candidates[0][2], candidates
+
+    @staticmethod
+    def _generate(prompt, use_cache=False):
+        """
+        生成一个剧本，返回解析后的结果；失败时返回 None。
+        剧本是创作结果，默认不使用响应缓存，每次构建都得到新的剧本。
+        """
+        # 流式生成：剧本较长，代码块闭合即结束，格式明显错误时提前中止；只有部分字段有问题时单独修复
+        script = call_llm_structured(prompt, SCRIPT_SCHEMA, use_cache=use_cache, stream=True)
+        if script is not None:
+            logger.info(f"分析结果: {script}")
+        return script
 
     def post(self, shared, prep_res, exec_res):
+        exec_res, candidates = exec_res
         if isinstance(exec_res, dict) and "scenes" in exec_res:
             db_path = shared.get("db_path")
             db = DatabaseManager(db_path=db_path)
@@ -120,9 +286,15 @@ scenes:
 
             # 插入剧本与分镜数据
             db.insert_script_scene_info(exec_res)
+            # 多候选时保留未入选的剧本，供之后比较或替换
+            if len(candidates) > 1:
+                db.create_script_table()
+                db.insert_script_candidates(script_id, candidates)
+                logger.info(f"入选剧本得分 {candidates[0][0]}，另保留 {len(candidates) - 1} 个候选剧本。")
 
             db.close()
             logger.info("剧本与分镜信息已成功保存。")
+            shared["script_id"] = script_id
             return "done"
         else:
             logger.warning("无法识别剧本格式，未执行保存。")
@@ -1,7 +1,14 @@
 from agent.utils.call_llm import  call_llm
-import yaml
+from agent.utils.structured_output import broken_fields, call_llm_structured, parse_tolerant
 from loguru import logger
 
+STRUCTURE_FIELDS = ('lens', 'composition', 'visual_style')
+STRUCTURE_SCHEMA = {
+    "type": "object",
+    "properties": {field: {"type": "string"} for field in STRUCTURE_FIELDS},
+    "required": list(STRUCTURE_FIELDS),
+}
+
 
 def analyze_image_structure(image_description: str):
     """
@@ -39,24 +46,94 @@ visual_style: |
 - 单行字段不使用|字符
 - 非键值对不允许随意使用冒号: 
 """
-    result, success = call_llm(prompt)
-    if success:
-        try:
-            # 尝试将结果解析为 YAML 格式
-            yaml_str = result.split("```yaml")[1].split("```")[0].strip()
-            logger.info(f"分析结果: {yaml_str}")
-            analysis = yaml.safe_load(yaml_str)
-
-            if isinstance(analysis,
-                          dict) and 'lens' in analysis and 'composition' in analysis and 'visual_style' in analysis:
-                return analysis['lens'], analysis['composition'], analysis['visual_style']
-            else:
-                # 如果解析失败或格式不正确，返回错误信息
-                logger.error(f"错误: LLM 返回的结果格式不正确。")
-                return '', '', ''
-        except yaml.YAMLError:
-            logger.error(f"错误: LLM 返回的结果格式不正确。")
-            return '', '', ''
-    else:
-        logger.error(f"无法生成分析结果，请稍后再试。")
+    analysis = call_llm_structured(prompt, STRUCTURE_SCHEMA)
+    if analysis is None:
         return '', '', ''
+    logger.info(f"分析结果: {analysis}")
+    return tuple(str(analysis[field]).strip() for field in STRUCTURE_FIELDS)
+
+
+def analyze_image_structures(image_descriptions: dict, max_rounds: int = 2) -> dict:
+    """
+    批量分析多条图片描述：一次请求携带多条描述，按图片ID输出 YAML，
+    指令部分只发送一次。返回结果中缺失的ID单独再次请求，最多 max_rounds 轮，
+    仍缺失的逐条调用 analyze_image_structure 兜底。
+
+    :param image_descriptions: {图片ID: 图片描述}
+    :param max_rounds: 批量请求的最大轮数（含首轮）
+    :return: {图片ID: (镜头, 构图, 视觉风格)}，键与输入一致
+    """
+    results = {}
+    missing = {str(image_id): desc for image_id, desc in image_descriptions.items()}
+    id_map = {str(image_id): image_id for image_id in image_descriptions}
+    for round_idx in range(max_rounds):
+        if not missing:
+            break
+        parsed = _analyze_batch(missing)
+        for key, fields in parsed.items():
+            if key in missing:
+                results[id_map[key]] = fields
+                del missing[key]
+        if missing:
+            logger.warning(f"第 {round_idx + 1} 轮批量分析缺少图片ID：{', '.join(missing)}，重新请求缺失部分")
+
+    for key, desc in missing.items():
+        logger.warning(f"图片ID {key} 批量分析失败，改为单独分析")
+        results[id_map[key]] = analyze_image_structure(desc)
+    return results
+
+
+def _analyze_batch(image_descriptions: dict) -> dict:
+    """发送一次批量分析请求，返回解析成功的 {图片ID字符串: (镜头, 构图, 视觉风格)}"""
+    descriptions = "\n\n".join(f"### 图片ID: {image_id}\n\n{desc}" for image_id, desc in image_descriptions.items())
+    example_id = next(iter(image_descriptions))
+    prompt = f"""
+##  请根据以下 {len(image_descriptions)} 张图片的描述，分别按指定格式拆分出：
+- 镜头 (lens)
+- 构图 (composition)
+- 视觉风格 (visual_style)
+
+## 图片描述（按图片ID区分）：
+
+{descriptions}
+
+## 输出格式示例：
+
+```yaml 
+"{example_id}":
+    lens: |
+        <镜头描述>
+    composition: |
+        <构图描述>
+    visual_style: |
+        <视觉风格描述>
+```
+
+重要：请确保：
+- 上面列出的每个图片ID都输出一项，且只输出这些图片ID
+- 以图片ID作为顶层键，并用双引号包裹
+- 使用中文描述
+- 使用YAML格式返回响应
+- 使用|字符表示多行文本字段
+- 多行字段使用缩进（4个空格）
+- 单行字段不使用|字符
+- 非键值对不允许随意使用冒号: 
+"""
+    # 只缓存能解析的响应，无法解析时再次调用会重新请求
+    result, success = call_llm(prompt, validate=lambda text: isinstance(parse_tolerant(text), dict))
+    if not success:
+        logger.error(f"无法生成批量分析结果，请稍后再试。")
+        return {}
+    # 缺失或格式有误的条目由调用方按图片ID重新请求，这里只做宽松解析
+    analysis = parse_tolerant(result)
+    if not isinstance(analysis, dict):
+        logger.error(f"错误: LLM 返回的批量结果格式不正确。")
+        return {}
+
+    # 字段缺失、为空或不是文本的条目视为缺失，由调用方重新请求
+    parsed = {}
+    for image_id, fields in analysis.items():
+        if not broken_fields(fields, STRUCTURE_SCHEMA):
+            parsed[str(image_id)] = tuple(str(fields[field]).strip() for field in STRUCTURE_FIELDS)
+    logger.info(f"批量分析完成，请求 {len(image_descriptions)} 条，解析成功 {len(parsed)} 条")
+    return parsed
@@ -0,0 +1,138 @@
+import math
+from collections import Counter
+
+import numpy as np
+from loguru import logger
+
+from database.vector_index import CJK_RE, text_terms
+
+
+def format_image_block(item: dict) -> str:
+    """单张图片在剧本提示词中的信息块"""
+    return f"""
+### 图片ID: {item["id"]}
+
+镜头：{item['lens']}
+构图：{item['composition']}
+视觉风格：{item['visual_style']}
+"""
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符约 1 字 1 token，其余字符约 4 个 1 token"""
+    if not text:
+        return 0
+    cjk = len(CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def _item_text(item: dict) -> str:
+    return " ".join(str(item.get(key) or "") for key in
+                    ("image_description", "lens", "composition", "visual_style"))
+
+
+def _normalize(vector: dict) -> dict:
+    norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+    return {term: weight / norm for term, weight in vector.items()} if norm else {}
+
+
+def _cosine(a: dict, b: dict) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(weight * b.get(term, 0.0) for term, weight in a.items())
+
+
+def _tfidf_vectors(texts: list) -> list:
+    counts = [Counter(text_terms(text)) for text in texts]
+    document_freq = Counter(term for count in counts for term in count)
+    total = len(texts)
+    return [_normalize({term: (1 + math.log(tf)) * math.log(1 + total / document_freq[term])
+                        for term, tf in count.items()}) for count in counts]
+
+
+def _to_matrix(vectors: list) -> np.ndarray:
+    """稀疏的词项向量转为稠密矩阵（每行已归一化）"""
+    vocabulary = {}
+    for vector in vectors:
+        for term in vector:
+            vocabulary.setdefault(term, len(vocabulary))
+    matrix = np.zeros((len(vectors), max(1, len(vocabulary))), dtype=np.float32)
+    for row, vector in enumerate(vectors):
+        for term, weight in vector.items():
+            matrix[row, vocabulary[term]] = weight
+    return matrix
+
+
+def _top_candidates(relevance: list, limit: int) -> list:
+    """相关度最高的 limit 张图片的下标，limit<=0 表示全部"""
+    order = np.argsort(-np.asarray(relevance, dtype=np.float32), kind="stable")
+    return [int(index) for index in (order[:limit] if limit > 0 else order)]
+
+
+def select_images(image_info_list: list, token_budget: int, theme: str = None, diversity: float = 0.5,
+                  max_images: int = 0, relevance_scores: dict = None, candidate_limit: int = 1000) -> list:
+    """
+    在 token 预算内挑选用于剧本创作的图片。
+
+    按最大边际相关（MMR）贪心挑选：相关度高、且与已选图片差异大的优先，
+    每次只考虑剩余预算放得下的图片，直到预算用完或没有可选图片。
+    只在相关度最高的 candidate_limit 张图片中挑选，挑选耗时不随素材库增大而增长。
+
+    :param image_info_list: 候选图片信息（get_all_image_info 的返回值）
+    :param token_budget: 图片信息块可占用的 token 上限，<=0 表示不限制
+    :param theme: 创作主题，为空时以与整体素材的相似度（代表性）作为相关度
+    :param diversity: 多样性权重（0~1），越大越倾向挑选彼此不同的图片
+    :param max_images: 最多挑选的图片数，0 表示不限制
+    :param relevance_scores: 向量检索给出的相关度 {图片ID: 相似度}，给出时代替按文本计算的相关度
+    :param candidate_limit: 参与挑选的候选图片数上限，<=0 表示不限制
+    :return: 选中的图片信息，保持输入顺序
+    """
+    costs = [estimate_tokens(format_image_block(item)) for item in image_info_list]
+    if (token_budget <= 0 or sum(costs) <= token_budget) and (max_images <= 0 or len(image_info_list) <= max_images):
+        return list(image_info_list)
+
+    if relevance_scores is not None:
+        # 相关度已由向量检索给出：先预筛，只为候选图片计算词项向量
+        relevance = [relevance_scores.get(item["id"], 0.0) for item in image_info_list]
+        candidates = _top_candidates(relevance, candidate_limit)
+        vectors = dict(zip(candidates, _tfidf_vectors([_item_text(image_info_list[index])
+                                                       for index in candidates])))
+    else:
+        all_vectors = _tfidf_vectors([_item_text(item) for item in image_info_list])
+        if theme:
+            query = _normalize(Counter(text_terms(theme)))
+        else:
+            query = Counter()
+            for vector in all_vectors:
+                query.update(vector)
+            query = _normalize(query)
+        relevance = [_cosine(query, vector) for vector in all_vectors]
+        candidates = _top_candidates(relevance, candidate_limit)
+        vectors = {index: all_vectors[index] for index in candidates}
+
+    # 之后的计算在候选图片的稠密矩阵上进行
+    matrix = _to_matrix([vectors[index] for index in candidates])
+    similarity = matrix @ matrix.T
+    candidate_relevance = np.asarray([relevance[index] for index in candidates], dtype=np.float32)
+    candidate_costs = np.asarray([costs[index] for index in candidates])
+
+    remaining = token_budget if token_budget > 0 else int(candidate_costs.sum())
+    # 每张候选图与已选图片的最大相似度，随挑选增量更新
+    max_similarity = np.zeros(len(candidates), dtype=np.float32)
+    available = np.ones(len(candidates), dtype=bool)
+    selected = []
+    while max_images <= 0 or len(selected) < max_images:
+        fitting = available & (candidate_costs <= remaining)
+        if not fitting.any():
+            break
+        scores = (1 - diversity) * candidate_relevance - diversity * max_similarity
+        best = int(np.argmax(np.where(fitting, scores, -np.inf)))
+        selected.append(best)
+        available[best] = False
+        remaining -= int(candidate_costs[best])
+        np.maximum(max_similarity, similarity[best], out=max_similarity)
+
+    chosen = sorted(candidates[index] for index in selected)
+    logger.info(f"图片筛选：候选 {len(image_info_list)} 张（参与挑选 {len(candidates)} 张），选中 {len(chosen)} 张，"
+                f"约 {sum(costs[index] for index in chosen)} tokens（预算 {token_budget}）")
+    return [image_info_list[index] for index in chosen]
@@ -0,0 +1,97 @@
+MUSIC_TAGS_TEXT = ("electronic, rock, pop, funk, soul, melodic, surf music, DUBSTEP, OBSCURE, DARKNESS, FEAR, TERROR, "
+                   "cyberpunk, Acid jazz, electro, em, soft electric drums, dark, death rock, metal, hardcore, "
+                   "electric guitar, powerful, bass, drums, Cuban music, salsa, son, Afro-Cuban, traditional Cuban, "
+                   "country rock, folk rock, southern rock, bluegrass, aggressive, Heavy Riffs, Blast Beats, "
+                   "Satanic Black Metal, Galaxy, space, electric guitar, cosmic tides, Galactic dreams, Neon lights, "
+                   "Industrial Techno, \xa0 \xa0Gothic Rave, city rock, folk rock, southern rock, bluegrass, "
+                   "country rock, folk rock, mandolin, pop, Aggressive, Heavy Riffs, Blast Beats, Satanic Black Metal, Jazz, "
+                   "Electro, 808 bass, smooth flow, party atmosphere, theme, sub bassline, mandarin hip hop, smooth, "
+                   "bassline, fast, hip hop, rap, yachtrck, female singer, catchy, lounge, funny, uplifting, "
+                   "emotive soundscape, dramatic female vocals, sad, traditional")
+# 背景音乐可选的风格标签（小写）
+MUSIC_TAGS = frozenset(tag.strip().lower() for tag in MUSIC_TAGS_TEXT.split(","))
+
+SCRIPT_FIELDS = ("story_theme", "plot_summary", "key_plot_points", "emotional_tone", "tags")
+SCENE_FIELDS = ("scene_number", "image_id", "camera_movement", "subject_action", "transition_effect",
+                "image_to_video_prompt", "narration_subtitle")
+
+# 剧本输出结构（JSON Schema），用于约束输出与校验
+SCRIPT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        **{field: {"type": "string"} for field in SCRIPT_FIELDS + ("lyrics",)},
+        "scenes": {
+            "type": "array",
+            "minItems": 1,
+            "items": {
+                "type": "object",
+                "properties": {field: {"type": "integer" if field == "image_id" else "string"}
+                               for field in SCENE_FIELDS},
+                "required": ["image_id"],
+            },
+        },
+    },
+    "required": ["story_theme", "plot_summary", "scenes"],
+}
+
+
+def _filled(value) -> bool:
+    return value is not None and str(value).strip() != ""
+
+
+def score_script(script, valid_image_ids, min_scenes: int = 3, max_scenes: int = 5,
+                 summary_range: tuple = (150, 200)) -> tuple:
+    """
+    为候选剧本打分（满分 100）：结构完整度 30、图片ID有效性 30、梗概长度 20、音乐标签有效性 20。
+
+    :param script: 解析后的剧本
+    :param valid_image_ids: 提示词中提供的图片ID
+    :return: (分数, 问题列表)；不是有效剧本（没有分镜）时分数为 None
+    """
+    if not isinstance(script, dict) or not isinstance(script.get("scenes"), list) or not script["scenes"]:
+        return None, ["没有分镜"]
+    problems = []
+    scenes = [scene for scene in script["scenes"] if isinstance(scene, dict)]
+
+    # 结构完整度：剧本字段与每个分镜的字段
+    missing = [field for field in SCRIPT_FIELDS if not _filled(script.get(field))]
+    if missing:
+        problems.append(f"缺少剧本字段：{', '.join(missing)}")
+    scene_filled = sum(_filled(scene.get(field)) for scene in scenes for field in SCENE_FIELDS)
+    scene_ratio = scene_filled / (len(script["scenes"]) * len(SCENE_FIELDS))
+    if scene_ratio < 1:
+        problems.append(f"分镜字段完整度 {scene_ratio:.0%}")
+    structure = 15 * (1 - len(missing) / len(SCRIPT_FIELDS)) + 15 * scene_ratio
+
+    # 图片ID有效性：引用提示词中给出的图片，且分镜数符合要求
+    valid_ids = {str(image_id) for image_id in valid_image_ids}
+    referenced = [str(scene.get("image_id")).strip() for scene in scenes]
+    invalid = [image_id for image_id in referenced if image_id not in valid_ids]
+    if invalid:
+        problems.append(f"无效的图片ID：{', '.join(invalid)}")
+    image_score = 25 * (len(referenced) - len(invalid)) / len(script["scenes"])
+    if min_scenes <= len(script["scenes"]) <= max_scenes:
+        image_score += 5
+    else:
+        problems.append(f"分镜数 {len(script['scenes'])} 不在 {min_scenes}~{max_scenes} 之间")
+
+    # 梗概长度：在范围内满分，超出部分按比例扣分
+    summary_length = len(str(script.get("plot_summary") or "").strip())
+    low, high = summary_range
+    if summary_length < low:
+        summary_score = 20 * summary_length / low
+    elif summary_length > high:
+        summary_score = 20 * max(0.0, 1 - (summary_length - high) / high)
+    else:
+        summary_score = 20
+    if summary_score < 20:
+        problems.append(f"梗概长度 {summary_length} 字")
+
+    # 音乐标签有效性：属于可选标签的比例
+    tags = [tag.strip().lower() for tag in str(script.get("tags") or "").replace("，", ",").split(",") if tag.strip()]
+    unknown = [tag for tag in tags if tag not in MUSIC_TAGS]
+    if unknown:
+        problems.append(f"未知的音乐标签：{', '.join(unknown)}")
+    tag_score = 20 * (len(tags) - len(unknown)) / len(tags) if tags else 0
+
+    return round(structure + image_score + summary_score + tag_score, 2), problems
@@ -0,0 +1,264 @@
+import math
+
+import numpy as np
+
+from loguru import logger
+
+from agent.tools.image_selection import estimate_tokens, format_image_block, select_images
+from agent.utils.adaptive_executor import run_adaptive
+from agent.utils.structured_output import call_llm_structured
+from database.vector_index import kmeans
+
+# 段落大纲输出结构（JSON Schema）
+OUTLINE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "chunk_theme": {"type": "string"},
+        "summary": {"type": "string"},
+        "key_images": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"image_id": {"type": "integer"}, "reason": {"type": "string"}},
+                "required": ["image_id"],
+            },
+        },
+    },
+    "required": ["summary", "key_images"],
+}
+
+
+def _pack(image_info_list: list, token_budget: int, max_chunk_size: int) -> list:
+    """按顺序把图片装入分段，每段不超过 token 预算与图片数上限"""
+    chunks, current, used = [], [], 0
+    for item in image_info_list:
+        cost = estimate_tokens(format_image_block(item))
+        if current and (used + cost > token_budget or len(current) >= max_chunk_size):
+            chunks.append(current)
+            current, used = [], 0
+        current.append(item)
+        used += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def chunk_by_time(image_info_list: list, capture_times: dict, token_budget: int, max_chunk_size: int,
+                  gap_seconds: float = 3 * 3600) -> list:
+    """
+    按拍摄时间排序后分段：相邻照片间隔超过 gap_seconds（如换了一天、一个景点）时另起一段，
+    段内再按 token 预算与图片数切分。
+
+    :param capture_times: {图片ID: 拍摄时间戳}
+    """
+    ordered = sorted(image_info_list, key=lambda item: (capture_times.get(item["id"], 0), item["id"]))
+    chunks, segment, last_time = [], [], None
+    for item in ordered:
+        capture_time = capture_times.get(item["id"], 0)
+        if segment and last_time is not None and capture_time - last_time > gap_seconds:
+            chunks.extend(_pack(segment, token_budget, max_chunk_size))
+            segment = []
+        segment.append(item)
+        last_time = capture_time
+    chunks.extend(_pack(segment, token_budget, max_chunk_size))
+    return chunks
+
+
+def chunk_by_similarity(image_info_list: list, vectors: dict, token_budget: int, max_chunk_size: int,
+                        iterations: int = 10, seed: int = 0) -> list:
+    """
+    按描述向量 k-means 聚类分段，相似的画面归入同一段，段内再按 token 预算与图片数切分。
+
+    :param vectors: {图片ID: 归一化的描述向量}，缺少向量的图片单独成段
+    """
+    with_vector = [item for item in image_info_list if item["id"] in vectors]
+    without_vector = [item for item in image_info_list if item["id"] not in vectors]
+    chunks = _pack(without_vector, token_budget, max_chunk_size)
+    if not with_vector:
+        return chunks
+
+    matrix = np.stack([vectors[item["id"]] for item in with_vector])
+    cluster_count = min(len(with_vector), math.ceil(len(with_vector) / max_chunk_size))
+    centroids = kmeans(matrix, cluster_count, iterations, np.random.default_rng(seed))
+    assign = np.argmax(matrix @ centroids.T, axis=1)
+    for cluster in range(cluster_count):
+        members = [item for item, label in zip(with_vector, assign) if label == cluster]
+        chunks.extend(_pack(sorted(members, key=lambda item: item["id"]), token_budget, max_chunk_size))
+    return chunks
+
+
+def summarize_chunk(chunk: list, key_image_count: int = 4) -> dict:
+    """
+    把一段图片概括为小段大纲，并挑出最能代表该段的关键图片。
+
+    :return: {"chunk_theme", "summary", "key_image_ids"}；模型调用失败时按多样性挑选关键图片，概括为空
+    """
+    prompt = f"""
+## 请阅读以下一组图片的信息，把这组画面概括为故事中的一个段落，并挑选出最能代表该段落的 {key_image_count} 张以内的关键图片。
+
+## 图片素材
+"""
+    for item in chunk:
+        prompt += format_image_block(item)
+    prompt += """
+## 输出格式示例：
+
+```yaml
+chunk_theme: |
+    <该段画面的主题>
+summary: |
+    <100字以内的段落概括，包含场景、情绪与可能的情节>
+key_images:
+  - image_id: <图片ID>
+    reason: <入选理由>
+```
+
+重要：请确保：
+- 使用中文描述
+- 使用YAML格式返回响应
+- image_id 只能使用上面给出的图片ID
+- 非键值对不允许随意使用冒号:
+"""
+    outline = _parse_outline(call_llm_structured(prompt, OUTLINE_SCHEMA) or {}, [item["id"] for item in chunk],
+                             key_image_count)
+    if not outline["key_image_ids"]:
+        outline["key_image_ids"] = [item["id"] for item in
+                                    select_images(chunk, token_budget=0, max_images=key_image_count)]
+    return outline
+
+
+def format_outline_block(index: int, outline: dict) -> str:
+    """单个段落大纲在剧本提示词中的信息块"""
+    return f"""
+### 段落 {index}：{outline['chunk_theme']}
+
+{outline['summary']}
+关键图片ID：{', '.join(str(image_id) for image_id in outline['key_image_ids'])}
+"""
+
+
+def _outline_tokens(outlines: list) -> int:
+    return sum(estimate_tokens(format_outline_block(index, outline))
+               for index, outline in enumerate(outlines, start=1))
+
+
+def _parse_outline(outline: dict, valid_ids: list, key_image_count: int) -> dict:
+    """从模型输出中取出大纲，关键图片只保留 valid_ids 中的ID"""
+    id_map = {str(image_id): image_id for image_id in valid_ids}
+    key_image_ids = []
+    for key_image in outline.get("key_images") or []:
+        image_id = id_map.get(str(key_image.get("image_id")).strip()) if isinstance(key_image, dict) else None
+        if image_id is not None and image_id not in key_image_ids:
+            key_image_ids.append(image_id)
+    return {
+        "chunk_theme": str(outline.get("chunk_theme") or "").strip(),
+        "summary": str(outline.get("summary") or "").strip(),
+        "key_image_ids": key_image_ids[:key_image_count],
+    }
+
+
+def merge_outlines(outlines: list, key_image_count: int = 4) -> dict:
+    """
+    把若干相邻的段落大纲合并为一个更高层的段落大纲，关键图片从各段的关键图片中挑选。
+
+    :return: 与 summarize_chunk 相同结构；模型调用失败时按顺序从各段轮流取关键图片，概括为各段概括的拼接
+    """
+    prompt = f"""
+## 以下是故事中按顺序相邻的 {len(outlines)} 个段落，请把它们合并概括为一个更大的段落，
+并从各段落的关键图片中挑选出最能代表合并后段落的 {key_image_count} 张以内的关键图片。
+
+## 段落大纲
+"""
+    for index, outline in enumerate(outlines, start=1):
+        prompt += format_outline_block(index, outline)
+    prompt += """
+## 输出格式示例：
+
+```yaml
+chunk_theme: |
+    <合并后段落的主题>
+summary: |
+    <100字以内的段落概括，保持原有的先后顺序>
+key_images:
+  - image_id: <图片ID>
+    reason: <入选理由>
+```
+
+重要：请确保：
+- 使用中文描述
+- 使用YAML格式返回响应
+- image_id 只能使用上面段落中列出的关键图片ID
+- 非键值对不允许随意使用冒号:
+"""
+    merged = call_llm_structured(prompt, OUTLINE_SCHEMA)
+    if merged is None:
+        return _fallback_merge(outlines, key_image_count)
+    merged = _parse_outline(merged, [image_id for outline in outlines for image_id in outline["key_image_ids"]],
+                            key_image_count)
+    if not merged["key_image_ids"]:
+        merged["key_image_ids"] = _fallback_merge(outlines, key_image_count)["key_image_ids"]
+    return merged
+
+
+def _fallback_merge(outlines: list, key_image_count: int) -> dict:
+    """不经模型合并大纲：概括按顺序拼接后截断，关键图片从各段轮流选取，保证每段都有代表"""
+    key_image_ids = []
+    for rank in range(key_image_count):
+        for outline in outlines:
+            if rank < len(outline["key_image_ids"]) and len(key_image_ids) < key_image_count:
+                key_image_ids.append(outline["key_image_ids"][rank])
+    return {
+        "chunk_theme": outlines[0]["chunk_theme"],
+        "summary": "".join(outline["summary"] for outline in outlines)[:200],
+        "key_image_ids": key_image_ids,
+    }
+
+
+def _group_outlines(outlines: list, group_size: int, token_budget: int) -> list:
+    """按顺序把大纲分组，每组不超过 group_size 个且不超过 token 预算；只剩一个的末组并入前一组"""
+    groups, current, used = [], [], 0
+    for index, outline in enumerate(outlines, start=1):
+        cost = estimate_tokens(format_outline_block(index, outline))
+        if current and (used + cost > token_budget or len(current) >= group_size):
+            groups.append(current)
+            current, used = [], 0
+        current.append(outline)
+        used += cost
+    if current:
+        if len(current) == 1 and groups:
+            groups[-1].extend(current)
+        else:
+            groups.append(current)
+    return groups
+
+
+def reduce_outlines(outlines: list, outline_budget: int, token_budget: int, key_image_count: int = 4,
+                    executor_options: dict = None) -> list:
+    """
+    逐层合并段落大纲，直到全部大纲不超过 outline_budget 个 token（或只剩一个）。
+    每层把相邻大纲分组并发合并，每组的合并请求不超过 token_budget。
+
+    :return: 合并后的大纲，保持原有顺序
+    """
+    level = 0
+    while len(outlines) > 1 and _outline_tokens(outlines) > outline_budget:
+        # 每组大小按“合并后需要剩下多少个大纲”估算，通常一层即可进入预算
+        average = _outline_tokens(outlines) / len(outlines)
+        target_count = max(1, int(outline_budget // average))
+        group_size = max(2, math.ceil(len(outlines) / target_count))
+        groups = _group_outlines(outlines, group_size, token_budget)
+        if len(groups) == len(outlines):
+            logger.warning("段落大纲无法继续合并，停止合并")
+            break
+        level += 1
+        merged = [None] * len(groups)
+        for (index, group), outline, error in run_adaptive(
+                lambda indexed: merge_outlines(indexed[1], key_image_count), list(enumerate(groups)),
+                **(executor_options or {})):
+            if error is not None:
+                logger.error(f"第 {level} 层第 {index + 1} 组大纲合并失败: {error!r}")
+                outline = _fallback_merge(group, key_image_count)
+            merged[index] = outline
+        logger.info(f"第 {level} 层大纲合并：{len(outlines)} 段合并为 {len(merged)} 段")
+        outlines = merged
+    return outlines
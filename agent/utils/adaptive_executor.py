@@ -0,0 +1,115 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Iterable
+
+from loguru import logger
+
+from agent.utils.call_llm import LLMOverloadedError
+from agent.utils.llm_client import no_overload_retry
+
+
+class TokenBucket:
+    """令牌桶限速：平均每秒 rate 个请求，允许 capacity 个突发；rate<=0 表示不限速"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """取一个令牌，不足时阻塞到补充完成"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class AIMDLimiter:
+    """
+    AIMD 并发控制：服务过载时并发上限减半（乘性减），
+    延迟正常的请求每完成一轮（约等于当前上限个请求）上限加一（加性增）。
+    """
+
+    def __init__(self, min_limit: int = 1, max_limit: int = 8, initial: int = None,
+                 latency_target: float = 30.0):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(initial or min_limit)
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency: float = None, overloaded: bool = False):
+        with self._cond:
+            self.in_flight -= 1
+            if overloaded:
+                self.limit = max(self.min_limit, self.limit / 2)
+                logger.warning(f"模型服务过载，并发上限降为 {int(self.limit)}")
+            elif latency is not None and latency <= self.latency_target:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+def run_adaptive(fn: Callable, items: Iterable, max_workers: int = 4, rate: float = 0,
+                 latency_target: float = 30.0, max_retries: int = 3, backoff: float = 2.0):
+    """
+    并发执行 fn(item)，按完成顺序产出 (item, result, error)。
+
+    并发数由 AIMDLimiter 在 [1, max_workers] 内自适应，请求速率由 TokenBucket 限制；
+    fn 抛出 LLMOverloadedError 时降低并发并按指数退避重试，最多 max_retries 次。
+    fn 中的 LLM 请求遇到 429/5xx 时不在 HTTP 客户端内重试，每次过载都直接反馈给并发控制。
+
+    :param fn: 处理单个任务的函数（同步，如一次 LLM 调用）
+    :param items: 任务列表
+    :param max_workers: 最大并发数
+    :param rate: 每秒最多发起的请求数，0 表示不限速
+    :param latency_target: 单次调用耗时不超过该秒数时视为健康，允许继续提升并发
+    """
+    limiter = AIMDLimiter(min_limit=1, max_limit=max_workers, initial=min(2, max_workers),
+                          latency_target=latency_target)
+    bucket = TokenBucket(rate)
+
+    def _run(item):
+        for attempt in range(max_retries + 1):
+            limiter.acquire()
+            bucket.acquire()
+            start_time = time.time()
+            try:
+                with no_overload_retry():
+                    result = fn(item)
+            except LLMOverloadedError:
+                limiter.release(overloaded=True)
+                if attempt == max_retries:
+                    raise
+                time.sleep(backoff * 2 ** attempt)
+                continue
+            except Exception:
+                limiter.release()
+                raise
+            limiter.release(latency=time.time() - start_time)
+            return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_run, item): item for item in items}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
@@ -0,0 +1,22 @@
+import json
+import struct
+
+# 二进制帧格式（与服务端 binary_frame.py 保持一致）：
+#   4 字节魔数 b"PFWB" | 4 字节大端无符号整数：头部长度 | UTF-8 JSON 头部 | 依次拼接的原始字节块
+# 头部即原 JSON 请求（tool、params、request_id 等，params 为对象而非字符串），
+# 另含 "blobs": [{"name": 名称, "size": 字节数}, ...] 描述后续字节块，图片以原始字节传输，无需 Base64。
+FRAME_MAGIC = b"PFWB"
+_HEADER_LEN = struct.Struct(">I")
+
+
+def encode_binary_frame(header: dict, blobs: list[tuple[str, bytes]]) -> bytes:
+    """
+    将请求头部和原始字节块编码为一个二进制 WebSocket 消息。
+
+    :param header: 请求头部（tool、params 等）
+    :param blobs: (名称, 原始字节) 列表，如 [("image", image_bytes)]
+    :return: 二进制消息
+    """
+    header = dict(header, blobs=[{"name": name, "size": len(data)} for name, data in blobs])
+    header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    return b"".join([FRAME_MAGIC, _HEADER_LEN.pack(len(header_bytes)), header_bytes, *[data for _, data in blobs]])
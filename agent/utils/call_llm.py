@@ -1,85 +1,349 @@
+import hashlib
+import json
 import os
-import requests
+import sqlite3
+import threading
+import time
+
 from loguru import logger
 from dotenv import load_dotenv
 
+from agent.utils.llm_client import llm_client
+from agent.utils.yaml_stream import FencedYamlMonitor
+
 load_dotenv()
 
 
-def call_llm(prompt):
+class LLMOverloadedError(Exception):
+    """模型服务过载（429 或 5xx），调用方应降低并发或稍后重试"""
+
+    def __init__(self, status_code: int):
+        super().__init__(f"模型服务过载，状态码: {status_code}")
+        self.status_code = status_code
+
+
+def _is_overloaded(status_code: int) -> bool:
+    return status_code == 429 or status_code >= 500
+
+
+class LLMResponseCache:
+    """
+    LLM 响应的 SQLite 持久缓存，键为 (平台, 模型名, 完整请求负载) 的哈希。
+    条目超过 ttl 秒视为过期；条目数超过 max_entries 时淘汰最久未使用的条目。
+    多线程共用（如并发结构化），通过锁串行访问连接。
+    """
+
+    def __init__(self, db_path: str, ttl: float = 7 * 24 * 3600, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._puts_since_prune = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS llm_response_cache (
+                cache_key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        ''')
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(platform: str, model_name: str, payload: dict) -> str:
+        key_source = json.dumps([platform, model_name, payload], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """查询未过期的缓存响应，未命中返回 None"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT response FROM llm_response_cache WHERE cache_key = ? AND created_at > ?',
+                                     (key, now - self.ttl)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute('UPDATE llm_response_cache SET accessed_at = ? WHERE cache_key = ?', (now, key))
+            self._conn.commit()
+            return row[0]
+
+    def put(self, key: str, response: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute('''
+                INSERT OR REPLACE INTO llm_response_cache (cache_key, response, created_at, accessed_at)
+                VALUES (?, ?, ?, ?)
+            ''', (key, response, now, now))
+            self._conn.commit()
+            self._puts_since_prune += 1
+            if self._puts_since_prune >= 100:
+                self._prune(now)
+
+    def _prune(self, now: float):
+        """删除过期条目，并按最近使用时间淘汰超出上限的条目"""
+        self._puts_since_prune = 0
+        self._conn.execute('DELETE FROM llm_response_cache WHERE created_at <= ?', (now - self.ttl,))
+        (count,) = self._conn.execute('SELECT COUNT(*) FROM llm_response_cache').fetchone()
+        if count > self.max_entries:
+            self._conn.execute('''
+                DELETE FROM llm_response_cache WHERE cache_key IN (
+                    SELECT cache_key FROM llm_response_cache ORDER BY accessed_at LIMIT ?
+                )
+            ''', (count - self.max_entries,))
+        self._conn.commit()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0}
+
+
+_llm_cache = None
+_llm_cache_lock = threading.Lock()
+
+
+def get_llm_cache():
+    """按环境变量创建全局响应缓存，LLM_CACHE_ENABLED=false 时返回 None"""
+    global _llm_cache
+    if os.getenv("LLM_CACHE_ENABLED", "true").lower() != "true":
+        return None
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            _llm_cache = LLMResponseCache(
+                os.getenv("LLM_CACHE_PATH", os.path.join(root_dir, "db", "llm_cache.db")),
+                ttl=float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600))),
+                max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000")),
+            )
+    return _llm_cache
+
+
+def call_llm(prompt, use_cache=True, stream=None, required_keys=None, output_schema=None, validate=None):
+    """
+    调用语言模型。相同平台、模型与请求负载的成功响应会被缓存，
+    需要重新生成（如希望得到不同的创作结果）时传入 use_cache=False。
+    validate 为调用方的解析检查，只有 validate(响应) 为真时才写入缓存，
+    避免无法解析的响应被缓存后重试也一直命中同样的错误结果。
+
+    stream=True（或环境变量 LLM_STREAM=true）时使用流式输出，边生成边检查 ```yaml 代码块：
+    代码块闭合即结束生成，明显格式错误时提前中止并返回失败；required_keys 为 YAML 必须包含的顶层键。
+
+    output_schema 为 JSON Schema 时请求模型按该结构输出 JSON（云端 response_format、Ollama format），
+    此时不使用流式输出。
+    """
     if os.getenv("MODEL_PLATFORM") == "cloud":
-        return call_cloud_model(prompt)
-    return call_local_llm(prompt)
+        platform, model_name = "cloud", os.getenv("CLOUD_MODEL_NAME")
+        payload = _build_payload(prompt, model_name, output_schema=output_schema)
+    else:
+        platform, model_name = "local", os.getenv("LOCAL_MODEL_NAME")
+        payload = _build_local_payload(prompt, output_schema=output_schema)
+
+    cache = get_llm_cache() if use_cache else None
+    key = cache.make_key(platform, model_name, payload) if cache is not None else None
+    if key is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            logger.info(f"命中LLM响应缓存，缓存统计：{cache.stats()}")
+            return cached, True
+
+    if stream is None:
+        stream = os.getenv("LLM_STREAM", "false").lower() == "true"
+    if stream and output_schema is None:
+        result, success = call_llm_stream(prompt, platform, required_keys)
+    elif platform == "cloud":
+        result, success = call_cloud_model(prompt, output_schema=output_schema)
+    else:
+        result, success = call_local_llm(prompt, output_schema=output_schema)
+    if key is not None and success and (validate is None or validate(result)):
+        cache.put(key, result)
+    return result, success
+
+
+_call_metrics = threading.local()
+
+
+def get_last_call_metrics() -> dict:
+    """当前线程最近一次流式调用的统计：首字延迟、生成 token 数、生成速度、总耗时"""
+    return getattr(_call_metrics, "value", {})
+
+
+def call_llm_stream(prompt, platform=None, required_keys=None):
+    """
+    流式调用语言模型并增量检查 ```yaml 代码块，记录首字延迟与生成速度。
+
+    :return: (文本, 是否成功)。代码块闭合后生成的内容被丢弃；格式错误提前中止时返回 (已生成文本, False)
+    """
+    platform = platform or ("cloud" if os.getenv("MODEL_PLATFORM") == "cloud" else "local")
+    monitor = FencedYamlMonitor(fence_deadline_chars=int(os.getenv("LLM_STREAM_FENCE_DEADLINE", "4000")),
+                                required_keys=required_keys)
+    start_time = time.time()
+    stats = {"first_token_at": None, "chunks": 0, "completion_tokens": None}
+
+    def _on_delta(content, reasoning=""):
+        if (content or reasoning) and stats["first_token_at"] is None:
+            stats["first_token_at"] = time.time()
+        stats["chunks"] += 1
+        # 思考内容不参与 YAML 检查，只计入生成统计
+        return monitor.feed(content) if content else True
+
+    if platform == "cloud":
+        model_name = os.getenv("CLOUD_MODEL_NAME")
+        url = os.getenv("CLOUD_API_URL")
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {os.getenv("CLOUD_API_KEY")}'
+        }
+        payload = _build_payload(prompt, model_name, stream=True)
+
+        def _on_line(line):
+            # OpenAI 兼容的 SSE：data: {...}，以 data: [DONE] 结束
+            if not line.startswith("data:"):
+                return True
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                return False
+            chunk = json.loads(data)
+            usage = chunk.get("usage") or {}
+            if usage.get("completion_tokens"):
+                stats["completion_tokens"] = usage["completion_tokens"]
+            choices = chunk.get("choices") or []
+            if not choices:
+                return True
+            delta = choices[0].get("delta") or {}
+            return _on_delta(delta.get("content") or "", delta.get("reasoning_content") or "")
+    else:
+        model_name = os.getenv("LOCAL_MODEL_NAME")
+        url = os.getenv("LOCAL_LLM_URL")
+        headers = None
+        payload = _build_local_payload(prompt, stream=True)
+
+        def _on_line(line):
+            # Ollama：每行一个 JSON，最后一行 done=true 并带 eval_count
+            chunk = json.loads(line)
+            if chunk.get("done"):
+                stats["completion_tokens"] = chunk.get("eval_count")
+                return False
+            return _on_delta(chunk.get("response") or "")
+
+    logger.info(f"使用{'云端' if platform == 'cloud' else '本地'}模型{model_name},进行语言(非视觉)流式操作")
+    try:
+        status_code, body = llm_client.post_stream_sync(url, payload, _on_line, headers)
+    except Exception as e:
+        logger.error(f"流式调用LLM时发生异常: {e!r}")
+        return "错误: 调用LLM时发生异常。", False
+    if status_code != 200:
+        if _is_overloaded(status_code):
+            raise LLMOverloadedError(status_code)
+        logger.error(f"错误: 无法从模型获取响应。状态码: {status_code}，响应: {body}")
+        return "错误: 无法从模型获取响应。", False
+
+    if not monitor.done:
+        monitor.finish()
+    end_time = time.time()
+    first_token_at = stats["first_token_at"]
+    tokens = stats["completion_tokens"] or stats["chunks"]
+    generate_seconds = end_time - first_token_at if first_token_at else 0
+    metrics = {
+        "ttft": round(first_token_at - start_time, 3) if first_token_at else None,
+        "tokens": tokens,
+        "tokens_per_second": round(tokens / generate_seconds, 2) if generate_seconds > 0 else None,
+        "duration": round(end_time - start_time, 3),
+        "aborted": monitor.state == "malformed",
+    }
+    _call_metrics.value = metrics
+    logger.info(f"流式调用统计：{metrics}")
+
+    if monitor.state == "malformed":
+        logger.error(f"模型输出格式错误，已提前中止生成：{monitor.error}")
+        return monitor.text, False
+    logger.info(f"模型返回信息{monitor.result_text()}")
+    return monitor.result_text(), True
 
 
-def call_local_llm(prompt, ):
+def call_local_llm(prompt, output_schema=None):
     # 支持视觉与非视觉模型  ·
     try:
         url = f"{os.getenv('LOCAL_LLM_URL')}"
 
         logger.info(f"使用本地模型{os.getenv('LOCAL_MODEL_NAME')},进行语言(非视觉)操作")
-        payload = {
-            "model": f"{os.getenv('LOCAL_MODEL_NAME')}",
-            "prompt": prompt,
-            "stream": False
-        }
-        response = requests.post(url, json=payload)
-        if response.status_code == 200:
-            logger.info(f"模型返回信息{response.json().get('response')}")
-            return response.json().get("response", ""), True
+        payload = _build_local_payload(prompt, output_schema=output_schema)
+        status_code, data = llm_client.post_json_sync(url, payload)
+        if status_code == 200:
+            logger.info(f"模型返回信息{data.get('response')}")
+            return data.get("response", ""), True
+        elif _is_overloaded(status_code):
+            raise LLMOverloadedError(status_code)
         else:
-            logger.error(f"错误: 无法从模型获取响应。状态码: {response.status_code}")
+            logger.error(f"错误: 无法从模型获取响应。状态码: {status_code}")
             return "错误: 无法从模型获取响应。", False
+    except LLMOverloadedError:
+        raise
     except Exception as e:
-        logger.error(f"调用LLM时发生异常: {e}")
+        logger.error(f"调用LLM时发生异常: {e!r}")
         return "错误: 调用LLM时发生异常。", False
 
 
-def call_cloud_model(prompt, max_retries=2):
+def call_cloud_model(prompt, max_retries=2, output_schema=None):
+    """调用云端模型；连接复用、超时与退避重试由 llm_client 负责，max_retries 为重试次数"""
     api_key = os.getenv("CLOUD_API_KEY")
     api_url = os.getenv("CLOUD_API_URL")
     model_name = os.getenv("CLOUD_MODEL_NAME")
-    for attempt in range(max_retries):
-        try:
+    logger.info(f"使用云端模型{model_name},进行语言(非视觉)操作")
+
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {api_key}'
+    }
+    payload = _build_payload(prompt, model_name, output_schema=output_schema)
+    try:
+        status_code, json_data = llm_client.post_json_sync(api_url, payload, headers, max_retries=max_retries)
+    except Exception as e:
+        logger.error(f"所有尝试均失败: {e!r}")
+        raise Exception(f"云端模型调用失败，重试 {max_retries} 次后仍未成功: {e!r}")
+
+    if status_code != 200:
+        if _is_overloaded(status_code):
+            # 重试后仍过载：交给调用方（如自适应并发执行器）退避
+            raise LLMOverloadedError(status_code)
+        logger.error(f"云端模型调用失败，状态码: {status_code}，响应: {json_data}")
+        return "云端模型调用出现异常", False
+    try:
+        # 解析 JSON 数据
+        choices = json_data.get("choices", [])
 
-            logger.info(f"使用云端模型{os.getenv('CLOUD_MODEL_NAME')},进行语言(非视觉)操作")
+        if choices:  # 确保 choices 列表非空
+            first_choice = choices[0]  # 获取第一个选择
+            message = first_choice.get("message", {})
+            content = message.get("content", "无内容")  # 获取 content 字段，若不存在则返回默认值
+            reasoning_content = message.get("reasoning_content", "无推理内容")  # 获取 reasoning_content 字段
 
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {api_key}'
-            }
-            payload = _build_payload(prompt, model_name)
-            response = requests.post(api_url, json=payload, headers=headers)
-            if response.status_code == 200:
-                try:
-                    # 解析 JSON 数据
-                    json_data = response.json()
-                    choices = json_data.get("choices", [])
-
-                    if choices:  # 确保 choices 列表非空
-                        first_choice = choices[0]  # 获取第一个选择
-                        message = first_choice.get("message", {})
-                        content = message.get("content", "无内容")  # 获取 content 字段，若不存在则返回默认值
-                        reasoning_content = message.get("reasoning_content", "无推理内容")  # 获取 reasoning_content 字段
-
-                        logger.info(f"API 响应: Content={content}\n, Reasoning Content={reasoning_content}")
-                        return content, True  # 返回 content 字段
-                    else:
-                        logger.warning("API 响应中没有 choices 数据")
-                        return "无内容", False
-                except Exception as e:
-                    logger.error(f"云端模型调用出现异常: {e}")
-                    return "云端模型调用出现异常", False
-            logger.warning(f"第 {attempt + 1} 次尝试失败，状态码: {response.status_code}")
-        except Exception as e:
-            logger.warning(f"第 {attempt + 1} 次尝试失败: {str(e)}")
-            if attempt == max_retries - 1:
-                logger.error("所有尝试均失败")
-                raise Exception(f"评估图片相关性失败，尝试 {max_retries} 次后仍未成功: {str(e)}")
-    raise Exception("evaluate_image_relevance 方法中发生意外错误")
-
-
-def _build_payload(prompt, model_name, ) -> dict:
+            logger.info(f"API 响应: Content={content}\n, Reasoning Content={reasoning_content}")
+            return content, True  # 返回 content 字段
+        else:
+            logger.warning("API 响应中没有 choices 数据")
+            return "无内容", False
+    except Exception as e:
+        logger.error(f"云端模型调用出现异常: {e}")
+        return "云端模型调用出现异常", False
+
+
+def _build_local_payload(prompt, stream=False, output_schema=None) -> dict:
+    """构建本地模型（Ollama generate 接口）请求负载"""
+    payload = {
+        "model": f"{os.getenv('LOCAL_MODEL_NAME')}",
+        "prompt": prompt,
+        "stream": stream
+    }
+    if output_schema is not None:
+        # Ollama 按 JSON Schema 约束解码
+        payload["format"] = output_schema
+    return payload
+
+
+def _build_payload(prompt, model_name, stream=False, output_schema=None) -> dict:
     """构建评估请求负载。
     :type model_name: object
     """
@@ -90,7 +354,7 @@ def _build_payload(prompt, model_name, ) -> dict:
         }
     ]
 
-    return {
+    payload = {
         "model": f"{model_name}",
         "enable_thinking": True,
         "frequency_penalty": 0,
@@ -104,5 +368,13 @@ def _build_payload(prompt, model_name, ) -> dict:
                 "content": content
             }
         ],
-        "stream": False
+        "stream": stream
     }
+    if output_schema is not None:
+        # OpenAI 兼容接口的结构化输出；不支持 json_schema 的服务可设置 CLOUD_RESPONSE_FORMAT=json_object
+        if os.getenv("CLOUD_RESPONSE_FORMAT", "json_schema") == "json_object":
+            payload["response_format"] = {"type": "json_object"}
+        else:
+            payload["response_format"] = {"type": "json_schema",
+                                          "json_schema": {"name": "output", "schema": output_schema}}
+    return payload
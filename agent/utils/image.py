@@ -1,5 +1,69 @@
 import os
+import time
 import base64
+import hashlib
+from io import BytesIO
+from typing import Callable, Iterable, Iterator, Optional
+
+from loguru import logger
+from PIL import Image, ImageOps
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+
+
+# 新增函数：惰性遍历文件夹内的图片
+def iter_read_images(folder_path: str) -> Iterator[str]:
+    """
+    递归遍历指定文件夹，逐个产出图片文件路径（不会一次性构建完整列表）。
+
+    :param folder_path: 文件夹路径
+    :return: 图片文件路径生成器
+    """
+    for root, _, files in os.walk(folder_path):
+        for file in files:
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(root, file)
+
+
+# 新增函数：基于扫描清单的增量遍历
+def iter_scan_changed_images(folder_path: str, manifest: dict, seen: Optional[set] = None,
+                             settle_seconds: float = 0) -> Iterator[tuple]:
+    """
+    递归遍历文件夹，只对文件做 stat，与扫描清单比较后产出新增或变更的图片。
+
+    :param folder_path: 文件夹路径
+    :param manifest: 扫描清单 {image_path: (file_size, mtime_ns, content_hash)}
+    :param seen: 可选集合，遍历时收集所有存在的图片路径，用于清理已删除文件的清单记录
+    :param settle_seconds: 修改时间距今小于该秒数的文件视为仍在写入，本轮跳过
+    :return: (image_path, file_size, mtime_ns) 生成器
+    """
+    settle_ns = int(settle_seconds * 1e9)
+    now_ns = time.time_ns()
+    pending_dirs = [folder_path]
+    while pending_dirs:
+        try:
+            entries = os.scandir(pending_dirs.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending_dirs.append(entry.path)
+                    continue
+                if not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                if seen is not None:
+                    seen.add(entry.path)
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                known = manifest.get(entry.path)
+                if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+                    continue
+                if now_ns - stat.st_mtime_ns < settle_ns:
+                    continue
+                yield entry.path, stat.st_size, stat.st_mtime_ns
 
 
 # 新增函数：批量读取文件夹内的图片
@@ -10,29 +74,139 @@ def batch_read_images(folder_path: str) -> list[str]:
     :param folder_path: 文件夹路径
     :return: 包含图片文件路径的列表
     """
-    image_paths = []
-    for root, _, files in os.walk(folder_path):
-        for file in files:
-            if file.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif')):
-                image_paths.append(os.path.join(root, file))
-    return image_paths
+    return list(iter_read_images(folder_path))
+
+
+# 新增函数：计算图片内容哈希
+def compute_content_hash(image_data: bytes) -> str:
+    """
+    计算图片字节内容的 SHA-256 哈希，用于按内容去重。
+
+    :param image_data: 图片文件的原始字节
+    :return: 十六进制哈希字符串
+    """
+    return hashlib.sha256(image_data).hexdigest()
+
+
+# 新增函数：流式读取图片
+def iter_load_images(image_paths: Iterable[str],
+                     skip: Optional[Callable[[str], bool]] = None,
+                     skip_hash: Optional[Callable[[str, str], bool]] = None) -> Iterator[dict]:
+    """
+    逐张读取图片：先调用 skip 判断（如查询数据库），需要处理时才读取文件，
+    因此任意时刻内存中只保留一张图片的数据。读取失败（被删除、无权限等）的文件记录错误后跳过，
+    不调用 skip_hash，调用方不会为其记录扫描清单，下次扫描会重试。
+
+    :param image_paths: 图片文件路径（列表或生成器）
+    :param skip: 可选回调，返回 True 时跳过该图片且不读取文件
+    :param skip_hash: 可选回调，读取文件后以 (路径, 内容哈希) 调用，返回 True 时跳过
+    :return: 包含 image_path、image_name、content_hash、image_data 的字典生成器
+    """
+    for image_path in image_paths:
+        if skip is not None and skip(image_path):
+            continue
+        try:
+            with open(image_path, "rb") as image_file:
+                image_data = image_file.read()
+        except OSError as e:
+            logger.error(f"`{image_path}` 读取失败，跳过：{e}")
+            continue
+        content_hash = compute_content_hash(image_data)
+        if skip_hash is not None and skip_hash(image_path, content_hash):
+            continue
+        yield {
+            "image_path": image_path,
+            "image_name": os.path.basename(image_path),
+            "content_hash": content_hash,
+            "image_data": image_data,
+        }
+
+
+# 新增函数：流式将图片转换为 Base64 格式
+def iter_convert_to_base64(image_paths: Iterable[str],
+                           skip: Optional[Callable[[str], bool]] = None,
+                           skip_hash: Optional[Callable[[str, str], bool]] = None) -> Iterator[dict]:
+    """
+    逐张读取并编码图片，参数同 iter_load_images。
+
+    :return: 包含 image_path、image_name、content_hash、base64_image 的字典生成器
+    """
+    for item in iter_load_images(image_paths, skip=skip, skip_hash=skip_hash):
+        item["base64_image"] = base64.b64encode(item.pop("image_data")).decode("utf-8")
+        yield item
+
+
+# 新增函数：缩放并重新编码图片
+def resize_and_encode_image(image_data: bytes, max_edge: int = 1024, image_format: str = "JPEG",
+                            quality: int = 90) -> bytes:
+    """
+    将图片最长边缩放到 max_edge 以内，并重新编码为 JPEG/WebP。
+
+    识别模型的处理器会把图片缩放到视觉编码器的输入尺寸，上传原图只会增加传输和解码开销。
+    若重新编码后反而更大（如本身已很小的图片），返回原始数据。
+
+    :param image_data: 图片文件的原始字节
+    :param max_edge: 最长边像素上限，<=0 表示不缩放
+    :param image_format: 输出格式，JPEG 或 WEBP
+    :param quality: 编码质量
+    :return: 编码后的图片字节
+    """
+    image_format = image_format.upper()
+    with Image.open(BytesIO(image_data)) as image:
+        if max_edge > 0 and image.format == "JPEG":
+            # JPEG 可在解码阶段按 1/2、1/4、1/8 缩放，避免完整解码大图
+            image.draft("RGB", (max_edge, max_edge))
+        image = ImageOps.exif_transpose(image)
+        if max_edge > 0 and max(image.size) > max_edge:
+            image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        if image.mode in ("RGBA", "LA", "P") and image_format == "JPEG":
+            # JPEG 不支持透明通道，合成到白色背景上
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGB")
+
+        buffer = BytesIO()
+        image.save(buffer, format=image_format, quality=quality)
+    encoded = buffer.getvalue()
+    return encoded if len(encoded) < len(image_data) else image_data
+
+
+# 新增函数：生成上传用的图片字节（可在进程池中执行）
+def prepare_image_for_upload(image_data: bytes, max_edge: int = 1024, image_format: str = "JPEG",
+                             quality: int = 90) -> bytes:
+    """
+    缩放并重新编码图片，供二进制帧直接上传；max_edge<=0 时返回原始字节。
+
+    :return: 图片字节
+    """
+    if max_edge > 0:
+        return resize_and_encode_image(image_data, max_edge, image_format, quality)
+    return image_data
+
+
+# 新增函数：生成上传用的 Base64 图片（可在进程池中执行）
+def encode_image_for_upload(image_data: bytes, max_edge: int = 1024, image_format: str = "JPEG",
+                            quality: int = 90) -> str:
+    """
+    缩放、重新编码并转换为 Base64，供 JSON 格式的识别请求使用。
+
+    :return: Base64 编码字符串
+    """
+    return base64.b64encode(prepare_image_for_upload(image_data, max_edge, image_format, quality)).decode("utf-8")
 
 
 # 新增函数：批量将图片转换为 Base64 格式
-def batch_convert_to_base64(image_paths: list[str]) -> list[str]:
+def batch_convert_to_base64(image_paths: list[str]) -> list[dict]:
     """
     将图片文件路径列表批量转换为 Base64 编码字符串。
 
     :param image_paths: 图片文件路径列表
     :return: 包含 Base64 编码字符串的列表
     """
-    base64_images = []
-    for image_path in image_paths:
-        with open(image_path, "rb") as image_file:
-            image_data = image_file.read()
-            base64_image = base64.b64encode(image_data).decode("utf-8")
-            base64_images.append({"image_path": image_path, "base64_image": base64_image})
-    return base64_images
+    return list(iter_convert_to_base64(image_paths))
 
 
 # 新增函数：将单个图片转换为 Base64 格式（兼容性函数）
@@ -48,6 +222,29 @@ def convert_single_image_to_base64(image_path: str) -> str:
         return base64.b64encode(image_data).decode("utf-8")
 
 
+# 新增函数：获取照片拍摄时间
+def get_capture_time(image_path: str) -> float:
+    """
+    获取照片的拍摄时间（时间戳）：优先读取 EXIF 拍摄时间，没有时使用文件修改时间。
+
+    :param image_path: 图片文件路径
+    :return: 时间戳；文件不存在时返回 0
+    """
+    try:
+        with Image.open(image_path) as image:
+            exif = image.getexif()
+            # 0x9003 为 Exif 子目录中的 DateTimeOriginal，0x0132 为主目录中的 DateTime
+            value = exif.get_ifd(0x8769).get(0x9003) or exif.get(0x0132)
+        if value:
+            return time.mktime(time.strptime(str(value).strip(), "%Y:%m:%d %H:%M:%S"))
+    except (OSError, ValueError):
+        pass
+    try:
+        return os.path.getmtime(image_path)
+    except OSError:
+        return 0
+
+
 # 示例：使用上述函数进行批量处理
 if __name__ == "__main__":
     folder_path = "path/to/your/images"  # 替换为实际的图片文件夹路径
@@ -0,0 +1,202 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import aiohttp
+from dotenv import load_dotenv
+from loguru import logger
+
+load_dotenv()
+
+
+def _is_retryable(status: int) -> bool:
+    return status == 429 or status >= 500
+
+
+_thread_options = threading.local()
+
+
+@contextmanager
+def no_overload_retry():
+    """
+    在当前线程的此上下文中，429/5xx 不在客户端内重试，直接返回给调用方（网络错误仍重试）。
+    供自适应并发执行器使用：每次过载都能立即反馈给并发控制，由其降低并发并退避。
+    """
+    previous = getattr(_thread_options, "retry_overload", True)
+    _thread_options.retry_overload = False
+    try:
+        yield
+    finally:
+        _thread_options.retry_overload = previous
+
+
+class AsyncLLMClient:
+    """
+    异步 LLM HTTP 客户端：共享保活连接池（复用 TCP/TLS 连接），
+    单次请求超时 + 整体截止时间，429/5xx 与网络错误按指数退避加随机抖动重试。
+
+    会话绑定在创建它的事件循环上；同步代码通过 post_json_sync 调用，
+    请求统一在一个后台事件循环线程中执行，连接可跨调用复用。
+    """
+
+    def __init__(self, call_timeout: float = 300, total_timeout: float = 900, max_retries: int = 3,
+                 backoff_base: float = 1.0, backoff_max: float = 30, pool_size: int = 16):
+        """
+        :param call_timeout: 单次 HTTP 请求的超时时间（秒）
+        :param total_timeout: 含重试在内的整体截止时间（秒）
+        :param max_retries: 最大重试次数（不含首次请求）
+        :param backoff_base: 退避基数（秒），第 n 次重试最多等待 backoff_base * 2^n
+        :param backoff_max: 单次退避的最长等待时间（秒）
+        :param pool_size: 连接池大小
+        """
+        self.call_timeout = call_timeout
+        self.total_timeout = total_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool_size = pool_size
+        self._session = None
+        self._session_loop = None
+        self._loop = None
+        self._loop_lock = threading.Lock()
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._session_loop = loop
+        return self._session
+
+    def _backoff(self, attempt: int, retry_after: str = None) -> float:
+        """指数退避 + 全抖动；服务端给出 Retry-After 时以其为下限"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        return delay
+
+    async def post_json(self, url: str, payload: dict, headers: dict = None, max_retries: int = None,
+                        total_timeout: float = None, retry_overload: bool = True) -> tuple[int, object]:
+        """
+        POST JSON 并解析响应，遇到 429/5xx（retry_overload 为 True 时）或网络错误时重试。
+
+        :return: (状态码, 响应 JSON)；响应不是 JSON 时为文本；所有尝试均为网络错误时抛出最后一次异常
+        """
+        max_retries = self.max_retries if max_retries is None else max_retries
+        deadline = time.monotonic() + (total_timeout or self.total_timeout)
+        session = await self._get_session()
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            timeout = aiohttp.ClientTimeout(total=min(self.call_timeout, remaining))
+            retry_after = None
+            error = None
+            try:
+                async with session.post(url, json=payload, headers=headers, timeout=timeout) as response:
+                    status = response.status
+                    if status == 200 or not _is_retryable(status) or not retry_overload or attempt >= max_retries:
+                        try:
+                            return status, await response.json(content_type=None)
+                        except ValueError:
+                            return status, await response.text()
+                    retry_after = response.headers.get("Retry-After")
+                    logger.warning(f"第 {attempt + 1} 次请求失败，状态码: {status}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= max_retries:
+                    raise
+                logger.warning(f"第 {attempt + 1} 次请求失败: {e!r}")
+                error = e
+
+            delay = self._backoff(attempt, retry_after)
+            if time.monotonic() + delay >= deadline:
+                if error is not None:
+                    raise error
+                raise asyncio.TimeoutError(f"请求超过整体截止时间 {self.total_timeout}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def post_stream(self, url: str, payload: dict, on_line, headers: dict = None,
+                          max_retries: int = None, retry_overload: bool = True) -> tuple[int, object]:
+        """
+        POST JSON 并逐行读取流式响应（SSE 或 NDJSON），每行调用 on_line(line)；
+        on_line 返回 False 时立即关闭连接，服务端随之停止生成。
+
+        只在响应开始前（网络错误、retry_overload 为 True 时的 429/5xx）重试，已开始输出的流不会重放。
+        流式模式下 call_timeout 为两段输出之间的最长间隔，整体截止时间仍为 total_timeout。
+
+        :return: (状态码, 非 200 时的响应内容，否则为 None)
+        """
+        max_retries = self.max_retries if max_retries is None else max_retries
+        deadline = time.monotonic() + self.total_timeout
+        session = await self._get_session()
+        attempt = 0
+        started = False
+        while True:
+            timeout = aiohttp.ClientTimeout(total=deadline - time.monotonic(), sock_read=self.call_timeout)
+            retry_after = None
+            error = None
+            try:
+                async with session.post(url, json=payload, headers=headers, timeout=timeout) as response:
+                    status = response.status
+                    if status == 200:
+                        started = True
+                        async for raw_line in response.content:
+                            line = raw_line.decode("utf-8").strip()
+                            if line and on_line(line) is False:
+                                response.close()
+                                break
+                        return status, None
+                    if not _is_retryable(status) or not retry_overload or attempt >= max_retries:
+                        return status, await response.text()
+                    retry_after = response.headers.get("Retry-After")
+                    logger.warning(f"第 {attempt + 1} 次流式请求失败，状态码: {status}")
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if started or attempt >= max_retries:
+                    raise
+                logger.warning(f"第 {attempt + 1} 次流式请求失败: {e!r}")
+                error = e
+
+            delay = self._backoff(attempt, retry_after)
+            if time.monotonic() + delay >= deadline:
+                if error is not None:
+                    raise error
+                raise asyncio.TimeoutError(f"请求超过整体截止时间 {self.total_timeout}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def post_stream_sync(self, url: str, payload: dict, on_line, headers: dict = None, **kwargs) -> tuple[int, object]:
+        """post_stream 的同步版本；on_line 在后台事件循环线程中执行，应只做轻量处理"""
+        kwargs.setdefault("retry_overload", getattr(_thread_options, "retry_overload", True))
+        future = asyncio.run_coroutine_threadsafe(self.post_stream(url, payload, on_line, headers, **kwargs),
+                                                  self._get_loop())
+        return future.result()
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        """后台事件循环线程，供同步调用复用同一个会话"""
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="llm-client", daemon=True).start()
+        return self._loop
+
+    def post_json_sync(self, url: str, payload: dict, headers: dict = None, **kwargs) -> tuple[int, object]:
+        """post_json 的同步版本，可在任意线程（包括已有事件循环的线程）中调用"""
+        kwargs.setdefault("retry_overload", getattr(_thread_options, "retry_overload", True))
+        future = asyncio.run_coroutine_threadsafe(self.post_json(url, payload, headers, **kwargs), self._get_loop())
+        return future.result()
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+# 全局共享客户端
+llm_client = AsyncLLMClient(
+    call_timeout=float(os.getenv("LLM_CALL_TIMEOUT", "300")),
+    total_timeout=float(os.getenv("LLM_TOTAL_TIMEOUT", "900")),
+    max_retries=int(os.getenv("LLM_MAX_RETRIES", "3")),
+    pool_size=int(os.getenv("LLM_POOL_SIZE", "16")),
+)
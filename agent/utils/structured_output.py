@@ -0,0 +1,192 @@
+import json
+import os
+import re
+
+import yaml
+from loguru import logger
+
+from agent.utils.call_llm import call_llm
+from agent.utils.yaml_stream import quote_stray_colons
+
+_THINK_RE = re.compile(r"<think>.*?</think>", re.S)
+_FENCE_RE = re.compile(r"```[ \t]*(yaml|yml|json)?[ \t]*\n(.*?)(?:```|\Z)", re.S | re.I)
+_TOP_KEY_RE = re.compile(r"^[\"']?([\w\-]+)[\"']?:(?:\s|$)")
+
+
+def extract_block(text: str) -> str:
+    """
+    取出模型输出中的结构化内容：去掉思考内容，优先取 ```yaml/```json 代码块，
+    其次取任意代码块（允许未闭合），都没有时使用全文。
+    """
+    text = _THINK_RE.sub("", text or "")
+    blocks = _FENCE_RE.findall(text)
+    for language, body in blocks:
+        if language:
+            return body.strip()
+    if blocks:
+        return blocks[0][1].strip()
+    return text.strip()
+
+
+def _load(text: str):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return yaml.safe_load(text)
+
+
+def parse_tolerant(text: str):
+    """
+    宽松解析模型输出：先按原样解析 YAML/JSON，失败时修复值中多余的冒号后重试。
+
+    :return: 解析结果；无法解析时返回 None
+    """
+    block = extract_block(text)
+    for candidate in (block, quote_stray_colons(block), block.replace("\t", "    ")):
+        try:
+            return _load(candidate)
+        except (yaml.YAMLError, ValueError):
+            continue
+    return None
+
+
+def _salvage_fields(block: str) -> dict:
+    """整体解析失败时按顶层键分段，逐段解析，保留能解析的字段"""
+    sections, current = [], []
+    for line in block.splitlines():
+        if _TOP_KEY_RE.match(line) and current:
+            sections.append(current)
+            current = []
+        current.append(line)
+    if current:
+        sections.append(current)
+    fields = {}
+    for section in sections:
+        data = parse_tolerant("\n".join(section))
+        if isinstance(data, dict):
+            fields.update(data)
+    return fields
+
+
+def _check(value, schema: dict) -> bool:
+    """按 JSON Schema 的常用子集（type、required、properties、items、minItems）检查值"""
+    expected = schema.get("type")
+    if expected == "object":
+        if not isinstance(value, dict):
+            return False
+        if any(key not in value for key in schema.get("required", [])):
+            return False
+        return all(_check(value[key], sub) for key, sub in schema.get("properties", {}).items() if key in value)
+    if expected == "array":
+        if not isinstance(value, list) or len(value) < schema.get("minItems", 0):
+            return False
+        return all(_check(item, schema.get("items", {})) for item in value)
+    if expected == "string":
+        return not isinstance(value, (dict, list))
+    if expected == "integer":
+        return isinstance(value, int) or (isinstance(value, str) and value.strip().isdigit())
+    return True
+
+
+def broken_fields(data, schema: dict) -> list:
+    """返回缺失或不符合结构的顶层字段"""
+    if not isinstance(data, dict):
+        return list(schema.get("properties", {}))
+    properties = schema.get("properties", {})
+    broken = [key for key in schema.get("required", []) if data.get(key) in (None, "", [], {})]
+    broken += [key for key, sub in properties.items() if key in data and not _check(data[key], sub)]
+    return broken
+
+
+def _repair_fields(prompt: str, data: dict, fields: list, schema: dict, raw_text: str):
+    """只针对有问题的字段发送一次简短的修复请求，返回修复后的字段"""
+    field_schema = {
+        "type": "object",
+        "properties": {key: schema["properties"][key] for key in fields if key in schema.get("properties", {})},
+        "required": fields,
+    }
+    valid = {key: value for key, value in data.items() if key not in fields}
+    repair_prompt = f"""
+## 以下是一次生成结果中的部分字段，其中 {', '.join(fields)} 缺失或格式有误，请只重新输出这些字段。
+
+## 原始任务（节选）：
+
+{prompt[:1500]}
+
+## 已生成的有效字段（保持一致，不要重复输出）：
+
+```yaml
+{yaml.safe_dump(valid, allow_unicode=True, sort_keys=False)[:3000]}
+```
+
+## 有问题的原始输出（节选）：
+
+{raw_text[-2000:]}
+
+## 需要输出的字段结构（JSON Schema）：
+
+{json.dumps(field_schema, ensure_ascii=False)}
+
+重要：请确保：
+- 只输出 {', '.join(fields)} 这些字段
+- 使用YAML格式返回响应，放在 ```yaml 代码块中
+- 使用|字符表示多行文本字段
+- 非键值对不允许随意使用冒号:
+"""
+    result, success = call_llm(repair_prompt, use_cache=False)
+    if not success:
+        return {}
+    repaired = parse_tolerant(result)
+    if not isinstance(repaired, dict):
+        return {}
+    return {key: repaired[key] for key in fields if key in repaired}
+
+
+def call_llm_structured(prompt: str, schema: dict, use_cache: bool = True, stream: bool = None,
+                        repair: bool = True):
+    """
+    调用模型并得到符合 schema（JSON Schema 子集）的结构化结果。
+
+    - LLM_CONSTRAINED_OUTPUT=true 时请求后端按 schema 约束输出 JSON；
+    - 否则（或约束输出仍不合格时）宽松解析 YAML/JSON 并修复值中多余的冒号，整体无法解析时逐字段解析；
+    - 结果只有部分字段有问题时，只针对这些字段发送一次简短的修复请求，而不是整体重新生成；
+    - 只有无需修复即符合结构的响应才写入响应缓存，再次调用时会重新生成。
+
+    :return: 符合结构的结果；完全无法使用时返回 None
+    """
+    constrained = os.getenv("LLM_CONSTRAINED_OUTPUT", "false").lower() == "true"
+    if constrained:
+        prompt_to_send = (prompt + "\n\n请改为直接输出 JSON（不要使用代码块），字段含义与上面的格式说明一致，"
+                                   f"并符合以下 JSON Schema：\n{json.dumps(schema, ensure_ascii=False)}\n")
+        result, success = call_llm(prompt_to_send, use_cache=use_cache, output_schema=schema,
+                                   validate=lambda text: not broken_fields(parse_tolerant(text), schema))
+    else:
+        result, success = call_llm(prompt, use_cache=use_cache, stream=stream,
+                                   required_keys=schema.get("required"),
+                                   validate=lambda text: not broken_fields(parse_tolerant(text), schema))
+    # 流式输出因格式错误提前中止时，已生成的部分也尝试解析
+    data = parse_tolerant(result)
+    if not isinstance(data, dict) or broken_fields(data, schema):
+        salvaged = _salvage_fields(extract_block(result))
+        if isinstance(data, dict):
+            salvaged = {**salvaged, **{key: value for key, value in data.items()
+                                       if key not in broken_fields(data, schema)}}
+        data = salvaged
+    broken = broken_fields(data, schema)
+    if not broken:
+        return data
+    properties = schema.get("properties", {})
+    if not success and not any(key in data for key in properties):
+        logger.error("无法生成结构化结果，请稍后再试。")
+        return None
+    if not any(key in data and key not in broken for key in properties) or not repair:
+        logger.error(f"错误: LLM 返回的结果格式不正确，有问题的字段：{', '.join(broken)}")
+        return None
+
+    logger.warning(f"结果中 {', '.join(broken)} 字段缺失或格式有误，发送修复请求")
+    data.update(_repair_fields(prompt, data, broken, schema, result))
+    broken = broken_fields(data, schema)
+    if broken:
+        logger.error(f"错误: 修复后仍有字段不正确：{', '.join(broken)}")
+        return None
+    return data
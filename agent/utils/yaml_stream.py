@@ -0,0 +1,152 @@
+import re
+
+import yaml
+
+_KEY_LINE_RE = re.compile(r"^(\s*(?:-\s+)?)([\"']?[\w一-鿿\- ]+[\"']?):[ \t]+(.*)$")
+
+
+def quote_stray_colons(text: str) -> str:
+    """
+    修复最常见的 YAML 错误：普通值中出现冒号（如“时间: 黄昏”）。
+    这类值整体加双引号；| 与 > 多行文本内部的内容不受影响。
+    """
+    lines = []
+    block_indent = None
+    for line in text.splitlines():
+        indent = len(line) - len(line.lstrip())
+        if block_indent is not None:
+            if not line.strip() or indent > block_indent:
+                lines.append(line)
+                continue
+            block_indent = None
+        match = _KEY_LINE_RE.match(line)
+        if match:
+            prefix, key, value = match.groups()
+            stripped = value.strip()
+            if stripped[:1] in ("|", ">"):
+                # 多行文本的内容缩进比键所在列更深（列表项中的键在 "- " 之后）
+                block_indent = len(prefix)
+            elif stripped[:1] not in ('"', "'", "[", "{") and re.search(r":(\s|$)", stripped):
+                escaped = stripped.replace("\\", "\\\\").replace('"', '\\"')
+                line = f'{prefix}{key}: "{escaped}"'
+        lines.append(line)
+    return "\n".join(lines)
+
+
+class FencedYamlMonitor:
+    """
+    流式输出中的 ```yaml 代码块增量检查。
+
+    逐段喂入模型输出的文本，在生成过程中判断：
+    - 代码块已闭合且可解析：无需再等待后续文本，可提前结束生成；
+    - 输出已明显无法使用：超过一定字符仍未出现 ```yaml，或已完整的行中出现
+      不可能被后续文本修复的 YAML 语法错误（错误位置离末尾较远），可提前中止。
+    """
+
+    def __init__(self, fence_deadline_chars: int = 4000, check_every_lines: int = 10, required_keys=None):
+        """
+        :param fence_deadline_chars: 思考内容之外，超过该字符数仍未出现 ```yaml 即视为格式错误
+        :param check_every_lines: 代码块内每新增多少行尝试解析一次
+        :param required_keys: 解析结果必须包含的顶层键
+        """
+        self.fence_deadline_chars = fence_deadline_chars
+        self.check_every_lines = check_every_lines
+        self.required_keys = required_keys or []
+        self.text = ""
+        # searching -> in_yaml -> closed；任一阶段判定为格式错误时进入 malformed
+        self.state = "searching"
+        self.error = None
+        self.data = None
+        self._yaml_start = None
+        self._checked_lines = 0
+
+    @property
+    def done(self) -> bool:
+        return self.state in ("closed", "malformed")
+
+    def feed(self, delta: str) -> bool:
+        """喂入新生成的文本，返回是否需要继续生成"""
+        if self.done:
+            return False
+        self.text += delta
+        if self.state == "searching":
+            self._find_fence()
+        if self.state == "in_yaml":
+            self._check_body()
+        return not self.done
+
+    def finish(self):
+        """生成结束（未提前结束）时做最终检查：代码块未闭合时按已有内容解析"""
+        if self.state == "in_yaml":
+            self._validate(self.text[self._yaml_start:].strip())
+        elif self.state == "searching":
+            self._fail("输出中没有 ```yaml 代码块")
+
+    def result_text(self) -> str:
+        """截至代码块闭合处的文本（代码块闭合后生成的内容被丢弃）"""
+        if self.state == "closed" and self._yaml_start is not None:
+            end = self.text.find("```", self._yaml_start)
+            if end != -1:
+                return self.text[:end + 3]
+        return self.text
+
+    def _find_fence(self):
+        search_from = 0
+        if "<think>" in self.text:
+            close = self.text.rfind("</think>")
+            if close == -1:
+                # 仍在思考中，不计入期限
+                return
+            search_from = close + len("</think>")
+        fence = self.text.find("```yaml", search_from)
+        if fence == -1:
+            if len(self.text) - search_from > self.fence_deadline_chars:
+                self._fail(f"前 {self.fence_deadline_chars} 个字符内没有出现 ```yaml 代码块")
+            return
+        line_end = self.text.find("\n", fence)
+        if line_end == -1:
+            return
+        self._yaml_start = line_end + 1
+        self.state = "in_yaml"
+
+    def _check_body(self):
+        body = self.text[self._yaml_start:]
+        close = body.find("```")
+        if close != -1:
+            self._validate(body[:close].strip())
+            return
+        complete = body[:body.rfind("\n") + 1]
+        line_count = complete.count("\n")
+        if line_count - self._checked_lines < self.check_every_lines:
+            return
+        self._checked_lines = line_count
+        try:
+            # 值中多余的冒号可由解析端修复，不视为格式错误
+            yaml.safe_load(quote_stray_colons(complete))
+        except yaml.MarkedYAMLError as e:
+            mark = e.problem_mark or e.context_mark
+            # 末尾几行的错误可能只是内容尚未生成完，离末尾较远的错误不会被后续文本修复
+            if mark is not None and mark.line < line_count - 3:
+                self._fail(f"YAML 第 {mark.line + 1} 行格式错误：{e.problem}")
+        except yaml.YAMLError:
+            pass
+
+    def _validate(self, yaml_str: str):
+        try:
+            data = yaml.safe_load(quote_stray_colons(yaml_str))
+        except yaml.YAMLError as e:
+            self._fail(f"YAML 解析失败：{e}")
+            return
+        if not isinstance(data, dict):
+            self._fail("YAML 顶层不是键值对")
+            return
+        missing = [key for key in self.required_keys if key not in data]
+        if missing:
+            self._fail(f"YAML 缺少字段：{', '.join(missing)}")
+            return
+        self.data = data
+        self.state = "closed"
+
+    def _fail(self, error: str):
+        self.error = error
+        self.state = "malformed"
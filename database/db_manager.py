@@ -1,8 +1,13 @@
+import json
 import os
 import sqlite3
 from typing import List, Tuple
 import threading
 
+from loguru import logger
+
+from database.vector_index import VectorIndex, vector_index_enabled
+
 root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 
@@ -48,28 +53,123 @@ class DatabaseManager:
                 image_description TEXT,
                 lens TEXT,
                 composition TEXT,
-                visual_style TEXT
+                visual_style TEXT,
+                content_hash TEXT
+            )
+        ''')
+        # 兼容旧库：补充内容哈希列（追加在末尾，不影响按位置读取的旧代码）
+        self.cursor.execute("PRAGMA table_info(image_info)")
+        if "content_hash" not in [row[1] for row in self.cursor.fetchall()]:
+            self.cursor.execute("ALTER TABLE image_info ADD COLUMN content_hash TEXT")
+        # 内容哈希唯一索引（旧记录为 NULL，不受唯一约束限制）
+        self.cursor.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_image_info_content_hash ON image_info (content_hash)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_image_info_image_path ON image_info (image_path)")
+        # 路径别名表：相同内容的其他路径（重命名、换目录同步）指向已有的图片记录
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS image_path_alias (
+                image_path TEXT PRIMARY KEY,
+                image_id INTEGER NOT NULL
             )
         ''')
         self.conn.commit()
+        if self._vector_index_enabled():
+            VectorIndex(self).create_table()
 
     def insert_image_info(self, image_name: str, image_path: str, image_description: str, lens: str, composition: str,
-                          visual_style: str) -> int:
+                          visual_style: str, content_hash: str = None) -> int:
         """插入图片信息，并返回插入记录的ID"""
         self.cursor.execute('''
-            INSERT INTO image_info (image_name, image_path, image_description, lens, composition, visual_style)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (image_name, image_path, image_description, lens, composition, visual_style))
+            INSERT INTO image_info (image_name, image_path, image_description, lens, composition, visual_style,
+                                    content_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (image_name, image_path, image_description, lens, composition, visual_style, content_hash))
         self.conn.commit()
+        image_id = self.cursor.lastrowid
+        # 新图片没有向量，由 VectorIndex.sync() 补齐
         # 返回最后插入记录的ID
-        return self.cursor.lastrowid
+        return image_id
+
+    @staticmethod
+    def _vector_index_enabled() -> bool:
+        return vector_index_enabled()
+
+    def _invalidate_embedding(self, image_id: int):
+        """
+        描述变化时删除旧向量。写库时不调用向量模型（可能是远程服务），
+        缺失的向量在识别流程结束或检索前由 VectorIndex.sync() 批量补齐。
+        """
+        if not self._vector_index_enabled():
+            return
+        try:
+            VectorIndex(self).delete(image_id)
+        except Exception as e:
+            logger.warning(f"图片 {image_id} 的旧描述向量删除失败: {e!r}")
 
     def is_image_path_exists(self, image_path: str) -> bool:
-        """检查指定的 image_path 是否存在于数据库中"""
-        self.cursor.execute('SELECT 1 FROM image_info WHERE image_path = ?', (image_path,))
+        """检查指定的 image_path 是否存在于数据库中（包括路径别名）"""
+        self.cursor.execute('''
+            SELECT 1 FROM image_info WHERE image_path = ?
+            UNION ALL
+            SELECT 1 FROM image_path_alias WHERE image_path = ?
+            LIMIT 1
+        ''', (image_path, image_path))
         result = self.cursor.fetchone()
         return result is not None
 
+    def get_image_id_by_content_hash(self, content_hash: str):
+        """根据内容哈希获取图片ID，不存在时返回 None"""
+        self.cursor.execute('SELECT id FROM image_info WHERE content_hash = ?', (content_hash,))
+        result = self.cursor.fetchone()
+        return result[0] if result else None
+
+    def link_image_path(self, image_path: str, image_id: int):
+        """将新路径关联到已有的图片记录"""
+        self.cursor.execute('''
+            INSERT OR REPLACE INTO image_path_alias (image_path, image_id) VALUES (?, ?)
+        ''', (image_path, image_id))
+        self.conn.commit()
+
+    def get_image_id_by_path(self, image_path: str):
+        """根据路径获取图片ID，不存在时返回 None"""
+        self.cursor.execute('SELECT id FROM image_info WHERE image_path = ?', (image_path,))
+        result = self.cursor.fetchone()
+        return result[0] if result else None
+
+    # ==== 目录扫描清单 ===
+    def create_scan_manifest_table(self):
+        """创建目录扫描清单表，记录已处理文件的大小、修改时间与内容哈希"""
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS scan_manifest (
+                image_path TEXT PRIMARY KEY,
+                file_size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                content_hash TEXT
+            )
+        ''')
+        self.conn.commit()
+
+    def get_scan_manifest(self, folder_path: str) -> dict:
+        """获取指定目录下的扫描清单：{image_path: (file_size, mtime_ns, content_hash)}"""
+        self.cursor.execute('''
+            SELECT image_path, file_size, mtime_ns, content_hash FROM scan_manifest
+            WHERE substr(image_path, 1, ?) = ?
+        ''', (len(folder_path), folder_path))
+        return {row[0]: (row[1], row[2], row[3]) for row in self.cursor.fetchall()}
+
+    def upsert_scan_manifest(self, image_path: str, file_size: int, mtime_ns: int, content_hash: str = None):
+        """插入或更新扫描清单记录"""
+        self.cursor.execute('''
+            INSERT OR REPLACE INTO scan_manifest (image_path, file_size, mtime_ns, content_hash)
+            VALUES (?, ?, ?, ?)
+        ''', (image_path, file_size, mtime_ns, content_hash))
+        self.conn.commit()
+
+    def delete_scan_manifest(self, image_paths: list):
+        """删除已不存在文件的扫描清单记录"""
+        self.cursor.executemany('DELETE FROM scan_manifest WHERE image_path = ?', [(p,) for p in image_paths])
+        self.conn.commit()
+
     def get_all_image_info(self, id_list: list = None) -> list:
         """获取指定ID列表的图片信息，如果id_list为空则获取所有图片"""
 
@@ -94,9 +194,15 @@ class DatabaseManager:
         self.cursor.execute('SELECT id FROM image_info')
         return [row[0] for row in self.cursor.fetchall()]
 
+    def sync_embeddings(self) -> int:
+        """批量补齐缺失的描述向量，返回补齐的图片数；未启用向量索引时不做处理"""
+        if not self._vector_index_enabled():
+            return 0
+        return VectorIndex(self).sync()
+
     def update_image_info(self, image_id: int, image_name: str = None, image_path: str = None,
                           image_description: str = None, lens: str = None, composition: str = None,
-                          visual_style: str = None):
+                          visual_style: str = None, content_hash: str = None):
         """更新图片信息"""
         update_fields = []
         update_values = []
@@ -118,17 +224,25 @@ class DatabaseManager:
         if visual_style:
             update_fields.append('visual_style = ?')
             update_values.append(visual_style)
+        if content_hash:
+            update_fields.append('content_hash = ?')
+            update_values.append(content_hash)
 
         if update_fields:
             query = f"UPDATE image_info SET {', '.join(update_fields)} WHERE id = ?"
             update_values.append(image_id)
             self.cursor.execute(query, tuple(update_values))
             self.conn.commit()
+            if image_description or lens or composition or visual_style:
+                self._invalidate_embedding(image_id)
 
     def delete_image_info(self, image_id: int):
         """删除图片信息"""
         self.cursor.execute('DELETE FROM image_info WHERE id = ?', (image_id,))
+        self.cursor.execute('DELETE FROM image_path_alias WHERE image_id = ?', (image_id,))
         self.conn.commit()
+        if self._vector_index_enabled():
+            VectorIndex(self).delete(image_id)
 
     # ==== 剧本及分镜 ===
     def create_script_table(self):
@@ -154,6 +268,17 @@ class DatabaseManager:
                    script_id TEXT NOT NULL
                )
            ''')
+        # 同一次创作生成的其他候选剧本（按得分排序，rank 0 为已保存的入选剧本）
+        self.cursor.execute('''
+               CREATE TABLE IF NOT EXISTS script_candidate (
+                   script_id TEXT NOT NULL,
+                   rank INTEGER NOT NULL,
+                   score REAL,
+                   problems TEXT,
+                   script_json TEXT NOT NULL,
+                   PRIMARY KEY (script_id, rank)
+               )
+           ''')
         self.conn.commit()
 
     def insert_script_scene_info(self, script_data: dict):
@@ -191,6 +316,35 @@ class DatabaseManager:
             ))
         self.conn.commit()
 
+    def insert_script_candidates(self, script_id: str, candidates: list):
+        """
+        保存同一次创作的全部候选剧本
+
+        :param candidates: [(分数, 问题列表, 剧本)]，按得分从高到低排列
+        """
+        self.cursor.executemany('''
+            INSERT OR REPLACE INTO script_candidate (script_id, rank, score, problems, script_json)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(script_id, rank, score, json.dumps(problems, ensure_ascii=False),
+               json.dumps(script, ensure_ascii=False, default=str))
+              for rank, (score, problems, script) in enumerate(candidates)])
+        self.conn.commit()
+
+    def get_script_candidates(self, script_id: str) -> List[dict]:
+        """获取剧本的全部候选（含入选剧本），按得分从高到低排列"""
+        self.cursor.execute('''
+            SELECT rank, score, problems, script_json FROM script_candidate WHERE script_id = ? ORDER BY rank
+        ''', (script_id,))
+        return [
+            {
+                "rank": row[0],
+                "score": row[1],
+                "problems": json.loads(row[2]),
+                "script": json.loads(row[3])
+            }
+            for row in self.cursor.fetchall()
+        ]
+
     def get_all_script_scene_lists(self) -> dict:
         """获取所有剧本与分镜信息，按 script_id 分组"""
         self.cursor.execute('SELECT * FROM script_scene_info')
@@ -11,10 +11,21 @@ class ImageDBManager:
         self.db_manager = db_manager
 
     def process_and_store_image(self, image_name: str, image_path: str, image_description: str, lens: str = "",
-                                composition: str = "", visual_style: str = ""):
+                                composition: str = "", visual_style: str = "", content_hash: str = None):
         """处理并存储图片信息"""
         image_id = self.db_manager.insert_image_info(image_name, image_path, image_description, lens, composition,
-                                                     visual_style)
+                                                     visual_style, content_hash)
+        return image_id
+
+    def link_duplicate_image(self, image_path: str, content_hash: str):
+        """
+        若相同内容的图片已识别过，则把新路径关联到已有记录。
+
+        :return: 已有记录的图片ID；内容未识别过时返回 None
+        """
+        image_id = self.db_manager.get_image_id_by_content_hash(content_hash)
+        if image_id is not None:
+            self.db_manager.link_image_path(image_path, image_id)
         return image_id
 
     def get_all_processed_images(self,image_id_list) -> List[Tuple]:
@@ -27,10 +38,10 @@ class ImageDBManager:
 
     def update_processed_image(self, image_id: int, image_name: str = None, image_path: str = None,
                                image_description: str = None, lens: str = None, composition: str = None,
-                               visual_style: str = None):
+                               visual_style: str = None, content_hash: str = None):
         """更新已处理的图片信息"""
         self.db_manager.update_image_info(image_id, image_name, image_path, image_description, lens, composition,
-                                          visual_style)
+                                          visual_style, content_hash)
 
     def delete_processed_image(self, image_id: int):
         """删除已处理的图片信息"""
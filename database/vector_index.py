@@ -0,0 +1,323 @@
+import hashlib
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+import requests
+from loguru import logger
+
+CJK_RE = re.compile(r"[㐀-鿿豈-﫿]")
+_TERM_RE = re.compile(r"[㐀-鿿豈-﫿]+|[A-Za-z0-9]+")
+
+# 参与向量化的图片字段
+EMBEDDING_FIELDS = ("image_description", "lens", "composition", "visual_style")
+
+
+def image_embedding_text(image_info: dict) -> str:
+    return "\n".join(str(image_info.get(field) or "") for field in EMBEDDING_FIELDS)
+
+
+def text_terms(text: str, unigrams: bool = False) -> list:
+    """中文按相邻两字切分（unigrams=True 时同时保留单字），英文与数字按单词切分"""
+    terms = []
+    for run in _TERM_RE.findall(text or ""):
+        if CJK_RE.match(run):
+            bigrams = [run[i:i + 2] for i in range(len(run) - 1)]
+            terms.extend(list(run) + bigrams if unigrams else bigrams or [run])
+        else:
+            terms.append(run.lower())
+    return terms
+
+
+class HashingEmbedder:
+    """
+    本地哈希向量：中文按单字与相邻两字、英文按单词切分，经特征哈希映射到固定维度。
+    无需模型与网络，相同文本在任何机器上得到相同向量。
+    """
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+        self.model_id = f"hash-{dim}"
+
+    def embed(self, texts: list) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for term, tf in Counter(text_terms(text, unigrams=True)).items():
+                digest = hashlib.md5(term.encode("utf-8")).digest()
+                bucket = int.from_bytes(digest[:4], "little") % self.dim
+                sign = 1.0 if digest[4] & 1 else -1.0
+                vectors[row, bucket] += sign * (1 + math.log(tf))
+        return _normalize_rows(vectors)
+
+
+class OllamaEmbedder:
+    """通过 Ollama /api/embed 接口生成向量（如 bge-m3、nomic-embed-text）"""
+
+    def __init__(self, url: str, model_name: str, timeout: float = 60):
+        self.url = url
+        self.model_name = model_name
+        self.timeout = timeout
+        self.model_id = f"ollama-{model_name}"
+
+    def embed(self, texts: list) -> np.ndarray:
+        response = requests.post(self.url, json={"model": self.model_name, "input": texts}, timeout=self.timeout)
+        response.raise_for_status()
+        return _normalize_rows(np.asarray(response.json()["embeddings"], dtype=np.float32))
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def kmeans(matrix: np.ndarray, cluster_count: int, iterations: int = 10, rng=None) -> np.ndarray:
+    """
+    球面 k-means：以内积（归一化向量即余弦相似度）分配样本，返回归一化的簇中心。
+
+    :param matrix: 每行已归一化的向量矩阵
+    :param rng: numpy 随机数生成器，用于选取初始中心
+    """
+    rng = rng if rng is not None else np.random.default_rng(0)
+    centroids = matrix[rng.choice(len(matrix), size=cluster_count, replace=False)]
+    for _ in range(iterations):
+        assign = np.argmax(matrix @ centroids.T, axis=1)
+        for cluster in range(cluster_count):
+            members = matrix[assign == cluster]
+            if len(members):
+                centroids[cluster] = members.mean(axis=0)
+        centroids = _normalize_rows(centroids)
+    return centroids
+
+
+def vector_index_enabled() -> bool:
+    """VECTOR_INDEX_ENABLED=false 时不生成、不使用描述向量"""
+    return os.getenv("VECTOR_INDEX_ENABLED", "true").lower() == "true"
+
+
+_embedder = None
+
+
+def get_embedder():
+    """按环境变量 EMBEDDING_BACKEND（hash/ollama）创建全局向量化器"""
+    global _embedder
+    if _embedder is None:
+        backend = os.getenv("EMBEDDING_BACKEND", "hash")
+        if backend == "ollama":
+            _embedder = OllamaEmbedder(os.getenv("EMBEDDING_URL", "http://127.0.0.1:11434/api/embed"),
+                                       os.getenv("EMBEDDING_MODEL_NAME", "bge-m3"))
+        else:
+            _embedder = HashingEmbedder(int(os.getenv("EMBEDDING_DIM", "512")))
+    return _embedder
+
+
+class _IVFIndex:
+    """
+    倒排文件近似检索：k-means 将向量分成约 sqrt(n) 个簇，
+    查询时只在与查询最近的 nprobe 个簇内做精确计算。
+    """
+
+    def __init__(self, matrix: np.ndarray, iterations: int = 10, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        count = len(matrix)
+        cluster_count = max(1, int(math.sqrt(count)))
+        sample = matrix[rng.choice(count, size=min(count, cluster_count * 64), replace=False)]
+        self.centroids = kmeans(sample, cluster_count, iterations, rng)
+        assign = np.argmax(matrix @ self.centroids.T, axis=1)
+        self.lists = [np.flatnonzero(assign == cluster) for cluster in range(cluster_count)]
+
+    def candidates(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        nearest = np.argsort(-(self.centroids @ query))[:nprobe]
+        return np.concatenate([self.lists[cluster] for cluster in nearest])
+
+
+# 各数据库的向量矩阵缓存：{db_path: (签名, ID数组, 向量矩阵, 近似索引)}
+_matrix_cache = {}
+_matrix_lock = threading.Lock()
+
+
+class VectorIndex:
+    """
+    图片描述向量索引：向量以 float32 BLOB 存在 image_embedding 表中（与 image_info 同库），
+    检索时整表载入内存矩阵做向量化暴力 top-k；图片数超过 VECTOR_ANN_MIN_SIZE 时默认使用 IVF 近似检索。
+    """
+
+    def __init__(self, db_manager, embedder=None):
+        self.db_manager = db_manager
+        self.embedder = embedder or get_embedder()
+        self.ann_min_size = int(os.getenv("VECTOR_ANN_MIN_SIZE", "20000"))
+        self.ann_nprobe = int(os.getenv("VECTOR_ANN_NPROBE", "8"))
+
+    def create_table(self):
+        self.db_manager.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS image_embedding (
+                image_id INTEGER PRIMARY KEY,
+                model_id TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        # 覆盖索引：检查向量是否有变化时不必读取向量数据
+        self.db_manager.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_image_embedding_model ON image_embedding (model_id, updated_at)")
+        self.db_manager.conn.commit()
+
+    def upsert(self, image_ids: list, texts: list):
+        """为图片生成向量并写入（已有则覆盖）"""
+        if not image_ids:
+            return
+        self.create_table()
+        vectors = self.embedder.embed(texts)
+        now = time.time()
+        self.db_manager.cursor.executemany('''
+            INSERT OR REPLACE INTO image_embedding (image_id, model_id, vector, updated_at) VALUES (?, ?, ?, ?)
+        ''', [(image_id, self.embedder.model_id, vector.tobytes(), now)
+              for image_id, vector in zip(image_ids, vectors)])
+        self.db_manager.conn.commit()
+
+    def index_image(self, image_id: int):
+        """按 image_info 中的当前内容更新单张图片的向量"""
+        self.db_manager.cursor.execute(
+            f"SELECT {', '.join(EMBEDDING_FIELDS)} FROM image_info WHERE id = ?", (image_id,))
+        row = self.db_manager.cursor.fetchone()
+        if row is not None:
+            self.upsert([image_id], [image_embedding_text(dict(zip(EMBEDDING_FIELDS, row)))])
+
+    def delete(self, image_id: int):
+        self.create_table()
+        self.db_manager.cursor.execute("DELETE FROM image_embedding WHERE image_id = ?", (image_id,))
+        self.db_manager.conn.commit()
+
+    def sync(self, batch_size: int = 64) -> int:
+        """
+        补齐缺失或由其他向量模型生成的向量（新识别、描述更新、旧库、切换向量模型后），返回补齐的图片数。
+        某批向量化失败时记录警告并跳过，下次补齐时重试，检索使用已有的向量。
+        """
+        self.create_table()
+        self.db_manager.cursor.execute(f'''
+            SELECT i.id, {', '.join('i.' + field for field in EMBEDDING_FIELDS)}
+            FROM image_info i LEFT JOIN image_embedding e ON e.image_id = i.id
+            WHERE e.image_id IS NULL OR e.model_id != ?
+        ''', (self.embedder.model_id,))
+        rows = self.db_manager.cursor.fetchall()
+        synced = 0
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            try:
+                self.upsert([row[0] for row in batch],
+                            [image_embedding_text(dict(zip(EMBEDDING_FIELDS, row[1:]))) for row in batch])
+            except Exception as e:
+                logger.warning(f"{len(batch)} 张图片的描述向量生成失败，下次补齐时重试: {e!r}")
+                continue
+            synced += len(batch)
+        if synced:
+            logger.info(f"向量索引已补齐 {synced} 张图片")
+        return synced
+
+    def _load(self):
+        """载入当前模型的全部向量；表内容未变化时复用缓存的矩阵"""
+        cursor = self.db_manager.cursor
+        cursor.execute("SELECT COUNT(*), MAX(updated_at) FROM image_embedding WHERE model_id = ?",
+                       (self.embedder.model_id,))
+        signature = (self.embedder.model_id,) + tuple(cursor.fetchone())
+        db_path = self.db_manager.db_path
+        with _matrix_lock:
+            cached = _matrix_cache.get(db_path)
+            if cached is not None and cached[0] == signature:
+                return cached
+        cursor.execute("SELECT image_id, vector FROM image_embedding WHERE model_id = ? ORDER BY image_id",
+                       (self.embedder.model_id,))
+        rows = cursor.fetchall()
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        matrix = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32).reshape(len(rows), -1) \
+            if rows else np.zeros((0, 0), dtype=np.float32)
+        cached = (signature, ids, matrix, None)
+        with _matrix_lock:
+            _matrix_cache[db_path] = cached
+        return cached
+
+    def _ann(self, cached):
+        signature, ids, matrix, ivf = cached
+        if ivf is None:
+            ivf = _IVFIndex(matrix)
+            with _matrix_lock:
+                if _matrix_cache.get(self.db_manager.db_path, (None,))[0] == signature:
+                    _matrix_cache[self.db_manager.db_path] = (signature, ids, matrix, ivf)
+        return ivf
+
+    def search(self, query: np.ndarray, top_k: int = 20, id_filter: list = None, approximate: bool = None,
+               exclude: list = None) -> list:
+        """
+        按余弦相似度检索最相近的图片。
+
+        :param query: 已归一化的查询向量
+        :param id_filter: 只在这些图片ID中检索，为空表示全部图片
+        :param approximate: 是否使用近似检索，None 表示按图片数自动选择（指定 id_filter 时总是精确检索）
+        :param exclude: 排除的图片ID
+        :return: [(图片ID, 相似度)]，按相似度从高到低
+        """
+        cached = self._load()
+        _, ids, matrix, _ = cached
+        if not len(ids):
+            return []
+        if approximate is None:
+            approximate = len(ids) >= self.ann_min_size
+        if id_filter:
+            positions = np.flatnonzero(np.isin(ids, np.asarray([int(image_id) for image_id in id_filter])))
+        elif approximate:
+            positions = self._ann(cached).candidates(query, self.ann_nprobe)
+        else:
+            positions = None
+        if exclude:
+            keep = ~np.isin(ids if positions is None else ids[positions], np.asarray([int(image_id) for image_id in exclude]))
+            positions = np.flatnonzero(keep) if positions is None else positions[keep]
+
+        if positions is None:
+            scores = matrix @ query
+            candidate_ids = ids
+        else:
+            scores = matrix[positions] @ query
+            candidate_ids = ids[positions]
+        top_k = min(top_k, len(scores))
+        if top_k <= 0:
+            return []
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(candidate_ids[index]), float(scores[index])) for index in top]
+
+    def search_text(self, text: str, top_k: int = 20, **kwargs) -> list:
+        """按文本（主题、关键词或描述）检索图片"""
+        self.sync()
+        return self.search(self.embedder.embed([text])[0], top_k, **kwargs)
+
+    def get_vectors(self, image_ids: list) -> dict:
+        """获取图片的描述向量 {图片ID: 向量}，缺失的向量会先补齐"""
+        self.sync()
+        _, ids, matrix, _ = self._load()
+        positions = np.flatnonzero(np.isin(ids, np.asarray([int(image_id) for image_id in image_ids])))
+        return {int(ids[position]): matrix[position] for position in positions}
+
+    def centroid_scores(self, image_ids: list) -> dict:
+        """各图片与这些图片整体（向量均值）的相似度 {图片ID: 相似度}，用作代表性"""
+        vectors = self.get_vectors(image_ids)
+        if not vectors:
+            return {}
+        ids = list(vectors)
+        matrix = np.stack([vectors[image_id] for image_id in ids])
+        centroid = matrix.mean(axis=0)
+        scores = matrix @ (centroid / (np.linalg.norm(centroid) or 1))
+        return {image_id: float(score) for image_id, score in zip(ids, scores)}
+
+    def similar_images(self, image_id: int, top_k: int = 20, **kwargs) -> list:
+        """检索与指定图片最相似的其他图片"""
+        self.sync()
+        self.db_manager.cursor.execute("SELECT vector FROM image_embedding WHERE image_id = ? AND model_id = ?",
+                                       (image_id, self.embedder.model_id))
+        row = self.db_manager.cursor.fetchone()
+        if row is None:
+            return []
+        return self.search(np.frombuffer(row[0], dtype=np.float32), top_k, exclude=[image_id], **kwargs)
@@ -0,0 +1,34 @@
+import asyncio
+import time
+
+from remote_caption_mcp_server.utils.batch_scheduler import CaptionBatchScheduler
+
+
+class StandInCaptionModel:
+    """
+    CPU 替身模型：模拟 GPU 批量推理的耗时特征（每次调用固定开销 + 每张图片的边际开销），
+    用于在没有 GPU 的机器上测量微批调度的收益。
+    """
+
+    def __init__(self, fixed_seconds: float = 0.2, per_image_seconds: float = 0.02):
+        self.fixed_seconds = fixed_seconds
+        self.per_image_seconds = per_image_seconds
+
+    def __call__(self, images: list) -> list[str]:
+        time.sleep(self.fixed_seconds + self.per_image_seconds * len(images))
+        return [f"caption of {image}" for image in images]
+
+
+async def run_bench(request_count: int, max_batch_size: int, max_wait_ms: float) -> dict:
+    scheduler = CaptionBatchScheduler(StandInCaptionModel(), max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    start_time = time.time()
+    results = await asyncio.gather(*[scheduler.submit(f"image_{i}") for i in range(request_count)])
+    duration = time.time() - start_time
+    await scheduler.stop()
+    assert results == [f"caption of image_{i}" for i in range(request_count)]
+    return {"max_batch_size": max_batch_size, "duration": round(duration, 2), **scheduler.stats()}
+
+
+if __name__ == "__main__":
+    for batch_size in (1, 4, 8, 16):
+        print(asyncio.run(run_bench(request_count=32, max_batch_size=batch_size, max_wait_ms=20)))
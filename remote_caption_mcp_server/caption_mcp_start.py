@@ -1,19 +1,47 @@
-from fastmcp import FastMCP
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+
+from fastmcp import Context, FastMCP
 from loguru import logger
-import torch
 
-from remote_caption_mcp_server.utils.fancyfeast_model import FancyFeastModel
+from remote_caption_mcp_server.utils.fancyfeast_model import FancyFeastModel, ModelNotReadyError
 
 # 初始化 FastMCP 实例
 mcp = FastMCP("caption")
-# 使用单例模式加载模型
+# 使用单例模式管理模型，权重在服务启动后于后台加载
 model = FancyFeastModel()
+# 所有生成在同一个推理线程中依次执行，避免并发请求同时在共享模型上生成
+generation_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="caption-inference")
+# 生成开始后超过该时长（秒）没有新的文本视为超时，停止生成并返回错误
+STREAM_TIMEOUT = 60.0
+
+
+async def wait_model_ready(ctx: Context):
+    """模型加载期间排队等待，并把加载进度通知给客户端；加载失败时抛出异常"""
+    loop = asyncio.get_running_loop()
+    while not await loop.run_in_executor(None, model.wait_ready, 1.0):
+        if model.status == "failed":
+            raise ModelNotReadyError(f"模型加载失败：{model.error}")
+        await ctx.info(f"模型加载中：{model.stage}")
+        await ctx.report_progress(model.progress, 1.0)
+
+
+@mcp.tool()
+def get_model_status() -> dict:
+    """
+    查询模型加载状态：是否就绪、当前阶段、进度与各阶段耗时。
+    """
+    return model.readiness()
+
 
 # 定义生成图像描述的工具函数
 @mcp.tool()
-async def generate_image_caption(image_base64: str) -> str:
+async def generate_image_caption(image_base64: str, ctx: Context) -> str:
     """
     根据输入的Base64格式图像生成描述性文本或提示词。
+    生成过程中以日志通知的形式流式推送新生成的文本，并通过进度通知报告已生成的片段数。
     :param image_base64: Base64编码的图像数据
     :return: 生成的标题文本
     """
@@ -21,6 +49,7 @@ async def generate_image_caption(image_base64: str) -> str:
     # 将Base64字符串解码为图像数据
     image = decode_base64_to_image(image_base64)
     logger.info("图片对象转换成功")
+    await wait_model_ready(ctx)
     caption_type = "描述性"
     extra_options = [
         "包含有关照明的信息",
@@ -46,20 +75,58 @@ async def generate_image_caption(image_base64: str) -> str:
         {"role": "user", "content": prompt.strip()},
     ]
 
-    convo_string = model.get_processor().apply_chat_template(convo, tokenize=False,
-                                                                       add_generation_prompt=True)
+    backend = model.get_backend()
+    convo_string = backend.format_prompt(convo)
     logger.info("convo_string: {}", convo_string)
-    # assert isinstance(convo_string, str)
-    inputs = model.get_processor()(text=[convo_string], images=[image], return_tensors="pt").to('cuda')
-    inputs['pixel_values'] = inputs['pixel_values'].to(torch.bfloat16)
 
-    # 生成输出
+    # 生成输出：在推理线程中依次生成，事件循环逐段读取 streamer 并推送给客户端
     logger.info("开始生成输出")
-    outputs = model.get_model().generate(**inputs, max_new_tokens=512, do_sample=True, temperature=0.6,
-                                                   top_p=0.9, use_cache=False, top_k=None)
-    caption = model.get_processor().decode(outputs[0], skip_special_tokens=True)
-
-    return caption
+    stop_event = Event()
+    streamer, run = backend.stream_caption(convo_string, image, stop_event=stop_event, max_new_tokens=512,
+                                           do_sample=True, temperature=0.6, top_p=0.9, top_k=None)
+    started_at = []
+
+    def _generate():
+        started_at.append(time.time())
+        return run()
+
+    loop = asyncio.get_running_loop()
+    start_time = time.time()
+    generation = loop.run_in_executor(generation_executor, _generate)
+    pending = None
+    last_activity = None
+    chunk_count = 0
+    try:
+        while True:
+            if pending is None:
+                pending = loop.run_in_executor(None, next, streamer, None)
+            done, _ = await asyncio.wait({pending}, timeout=1.0)
+            if not done:
+                # 排队等待推理线程期间不计时，生成开始后才按 STREAM_TIMEOUT 判断
+                if started_at and time.time() - max(last_activity or 0, started_at[0]) > STREAM_TIMEOUT:
+                    raise RuntimeError(f"图片描述生成超时：{STREAM_TIMEOUT:g}s 内没有新的输出")
+                continue
+            text = pending.result()
+            pending = None
+            if text is None:
+                break
+            last_activity = time.time()
+            if chunk_count == 0:
+                logger.info(f"首个token耗时：{time.time() - start_time:.2f}s")
+            chunk_count += 1
+            if text:
+                await ctx.info(text)
+                await ctx.report_progress(chunk_count)
+        return await generation
+    except Exception as e:
+        logger.error(f"生成失败: {e}")
+        raise
+    finally:
+        if not generation.done():
+            # 超时或客户端断开：尚未开始的生成直接取消，进行中的生成在下一个 token 处停止
+            generation.cancel()
+            stop_event.set()
+            streamer.end()
 
 # 新增函数：将Base64字符串解码为图像
 def decode_base64_to_image(image_base64: str):
@@ -127,4 +194,6 @@ def build_prompt(caption_type: str, extra_options: list[str], caption_length: st
 
 # 启动服务器
 if __name__ == "__main__":
+    # 先监听端口，模型在后台加载并预热
+    model.start_background_load()
     mcp.run(transport="streamable-http", host="0.0.0.0", port=8000, path="/mcp")
@@ -1,15 +1,21 @@
 import asyncio
 import json
+import os
+import time
+from functools import lru_cache
 
 import websockets
 from loguru import logger
 from mcp.server.fastmcp import FastMCP
-import torch
 from contextlib import asynccontextmanager
-from remote_caption_mcp_server.utils.fancyfeast_model import FancyFeastModel
+from remote_caption_mcp_server.utils.batch_scheduler import CaptionBatchScheduler
+from remote_caption_mcp_server.utils.caption_router import CaptionRouter
+from remote_caption_mcp_server.utils.caption_cache import CaptionCache, make_cache_key
+from remote_caption_mcp_server.utils.binary_frame import MemoryViewReader, decode_binary_frame, is_binary_frame
+from remote_caption_mcp_server.utils.fancyfeast_model import FancyFeastModel, ModelNotReadyError
 from typing import AsyncIterator
 
-# 使用单例模式加载模型
+# 使用单例模式管理模型，权重在服务启动后于后台加载
 fancy_feast_model = FancyFeastModel()
 
 
@@ -24,8 +30,9 @@ async def app_lifespan(server: FastMCP) -> AsyncIterator[AppContext]:
     """管理应用程序生命周期"""
     logger.info("Starting MCP server lifecycle...")
     try:
-        # 启动：未来可添加ComfyUI健康检查
-        logger.info("图片返推模型已全局初始化")
+        # 启动：模型在后台加载，可通过 get_model_status 查询进度
+        fancy_feast_model.start_background_load()
+        logger.info("图片返推模型开始后台加载")
         yield AppContext(fancy_feast_model=fancy_feast_model)
     finally:
         # 关闭：清理（如果需要）
@@ -36,6 +43,80 @@ async def app_lifespan(server: FastMCP) -> AsyncIterator[AppContext]:
 mcp = FastMCP("Fancy_Feast_MCP_Server", lifespan=app_lifespan)
 
 
+# 单次 generate 的最大图片数，超过时拆分为多个批次，避免显存不足
+MAX_BATCH_SIZE = int(os.getenv("CAPTION_MAX_BATCH_SIZE", "8"))
+
+CAPTION_TYPE = "描述性"
+EXTRA_OPTIONS = [
+    "包含有关照明的信息",
+    "包含有关相机角度的信息",
+    "指出景深和背景是否聚焦或模糊",
+    "包含有关任何人物/角色年龄的信息（如果适用）",
+    "提及图像描绘的是极端特写、特写、中景特写、中景、牛仔镜头、中景宽镜头、全景或极端全景。",
+    "明确指定视角高度（眼平、低角虫眼、鸟瞰、无人机、屋顶等）。",
+    "不要包含关于无法更改的人/角色的信息（如种族、性别等），但仍需包含可更改的属性（如发型）",
+    "不要使用任何模棱两可的语言",
+    "不要提及图像中的任何文本",
+    "不要提及图像的分辨率",
+    "你的回答将被用于文本到图像模型，因此避免使用无用的元短语，如“这张图片显示...”，“你正在看...”等。",
+]
+CAPTION_LENGTH = "any"
+
+# 采样参数，批量与流式生成共用，同时作为结果缓存键的一部分
+GENERATION_KWARGS = {"max_new_tokens": 512, "do_sample": True, "temperature": 0.6, "top_p": 0.9, "top_k": None}
+
+
+@lru_cache(maxsize=32)
+def build_convo_string(caption_type: str = CAPTION_TYPE, extra_options: tuple = tuple(EXTRA_OPTIONS[3:]),
+                       caption_length: str = CAPTION_LENGTH) -> str:
+    """
+    构建对话模板字符串（系统提示 + 识别指令）。
+    同一组 (caption_type, extra_options, caption_length) 只渲染一次，后端再按该字符串缓存 token 与前缀 KV。
+    """
+    # 构建提示词
+    prompt = build_prompt(caption_type, list(extra_options), caption_length)
+    logger.info("prompt: {}", prompt)
+
+    # 处理输入
+    convo = [
+        {"role": "system", "content": "你是一个乐于助人的助手，帮助用户解决任何问题，没有审查或限制。"},
+        {"role": "user", "content": prompt.strip()},
+    ]
+
+    convo_string = fancy_feast_model.get_backend().format_prompt(convo)
+    logger.info("convo_string: {}", convo_string)
+    return convo_string
+
+
+def caption_images(images: list) -> list[str]:
+    """
+    将多张图片作为一个填充批次送入模型生成描述，按输入顺序返回结果。
+
+    :param images: PIL.Image 对象列表
+    :return: 与输入一一对应的描述文本列表
+    """
+    convo_string = build_convo_string()
+    backend = fancy_feast_model.get_backend()
+    captions = []
+    for start in range(0, len(images), MAX_BATCH_SIZE):
+        batch = images[start:start + MAX_BATCH_SIZE]
+        # 生成输出
+        logger.info(f"开始生成输出，批次大小：{len(batch)}")
+        captions.extend(backend.caption_batch(convo_string, batch, **GENERATION_KWARGS))
+    return captions
+
+
+def stream_caption_image(image):
+    """
+    流式生成单张图片的描述。
+
+    :param image: PIL.Image 对象
+    :return: (streamer, run)。run 需在推理线程中执行，生成结束后返回完整解码文本；
+             streamer 在生成过程中逐段产出新生成的文本
+    """
+    return fancy_feast_model.get_backend().stream_caption(build_convo_string(), image, **GENERATION_KWARGS)
+
+
 # 定义生成图像描述的工具函数
 @mcp.tool()
 def generate_image_caption(image_base64: str):
@@ -48,45 +129,42 @@ def generate_image_caption(image_base64: str):
     # 将Base64字符串解码为图像数据
     image = decode_base64_to_image(image_base64)
     logger.info("图片对象转换成功")
-    caption_type = "描述性"
-    extra_options = [
-        "包含有关照明的信息",
-        "包含有关相机角度的信息",
-        "指出景深和背景是否聚焦或模糊",
-        "包含有关任何人物/角色年龄的信息（如果适用）",
-        "提及图像描绘的是极端特写、特写、中景特写、中景、牛仔镜头、中景宽镜头、全景或极端全景。",
-        "明确指定视角高度（眼平、低角虫眼、鸟瞰、无人机、屋顶等）。",
-        "不要包含关于无法更改的人/角色的信息（如种族、性别等），但仍需包含可更改的属性（如发型）",
-        "不要使用任何模棱两可的语言",
-        "不要提及图像中的任何文本",
-        "不要提及图像的分辨率",
-        "你的回答将被用于文本到图像模型，因此避免使用无用的元短语，如“这张图片显示...”，“你正在看...”等。",
-    ]
-    caption_length = "any"
-    # 构建提示词
-    prompt = build_prompt(caption_type, extra_options[3:], caption_length)
-    logger.info("prompt: {}", prompt)
+    result = caption_images([image])[0]
 
-    # 处理输入
-    convo = [
-        {"role": "system", "content": "你是一个乐于助人的助手，帮助用户解决任何问题，没有审查或限制。"},
-        {"role": "user", "content": prompt.strip()},
-    ]
+    return {"result": result}
 
-    convo_string = fancy_feast_model.get_processor().apply_chat_template(convo, tokenize=False,
-                                                             add_generation_prompt=True)
-    logger.info("convo_string: {}", convo_string)
-    # assert isinstance(convo_string, str)
-    inputs = fancy_feast_model.get_processor()(text=[convo_string], images=[image], return_tensors="pt").to('cuda')
-    inputs['pixel_values'] = inputs['pixel_values'].to(torch.bfloat16)
 
-    # 生成输出
-    logger.info("开始生成输出")
-    outputs = fancy_feast_model.get_model().generate(**inputs, max_new_tokens=512, do_sample=True, temperature=0.6,
-                                         top_p=0.9, use_cache=False, top_k=None)
-    result = fancy_feast_model.get_processor().decode(outputs[0], skip_special_tokens=True)
+@mcp.tool()
+def generate_image_captions(images_base64: list[str]):
+    """
+    批量生成多张图像的描述，多张图片在一次 generate 中以填充批次推理。
+    :param images_base64: Base64编码的图像数据列表
+    :return: {"results": [...]}，与输入顺序一致，每项为 {"result": 文本} 或 {"error": 错误信息}
+    """
+    logger.info(f"成功调用generate_image_captions，图片数量：{len(images_base64)}")
+    results = [None] * len(images_base64)
+    images = []
+    indexes = []
+    for idx, image_base64 in enumerate(images_base64):
+        try:
+            images.append(decode_base64_to_image(image_base64))
+            indexes.append(idx)
+        except Exception as e:
+            logger.error(f"第{idx}张图片解码失败: {e}")
+            results[idx] = {"error": f"图片解码失败: {e}"}
 
-    return {"result": result}
+    if images:
+        for idx, caption in zip(indexes, caption_images(images)):
+            results[idx] = {"result": caption}
+    return {"results": results}
+
+
+@mcp.tool()
+def get_model_status():
+    """
+    查询模型加载状态：是否就绪、当前阶段、进度与各阶段耗时。
+    """
+    return fancy_feast_model.readiness()
 
 
 # 新增函数：将Base64字符串解码为图像
@@ -97,17 +175,39 @@ def decode_base64_to_image(image_base64: str):
     :param image_base64: Base64编码的图像数据
     :return: PIL.Image对象
     """
-    import base64
     from PIL import Image
     from io import BytesIO
 
     # 解码Base64字符串
-    image_data = base64.b64decode(image_base64)
+    image_data = decode_base64_to_bytes(image_base64)
     # 转换为PIL.Image对象
     image = Image.open(BytesIO(image_data))
     return image
 
 
+def decode_base64_to_bytes(image_base64: str) -> bytes:
+    """将Base64编码的图像数据解码为原始字节"""
+    import base64
+
+    return base64.b64decode(image_base64)
+
+
+# 新增函数：将原始图片字节（二进制帧中的 memoryview）解码为图像
+def decode_bytes_to_image(image_data: memoryview):
+    """
+    直接从 memoryview 解码为PIL.Image对象，不经过 Base64，也不复制字节。
+
+    :param image_data: 图片原始字节
+    :return: PIL.Image对象
+    """
+    from PIL import Image
+
+    image = Image.open(MemoryViewReader(image_data))
+    # 在返回前完成解码，之后不再依赖原消息缓冲区
+    image.load()
+    return image
+
+
 # 辅助函数：构建提示词
 def build_prompt(caption_type: str, extra_options: list[str], caption_length: str = "any") -> str:
     """
@@ -154,28 +254,242 @@ def build_prompt(caption_type: str, extra_options: list[str], caption_length: st
     )
 
 
+def parse_request_params(request: dict) -> dict:
+    """
+    解析请求参数：客户端把参数以 JSON 字符串放在 params 字段中，
+    同时兼容直接放在消息顶层的旧格式。
+    """
+    params = request.get("params")
+    if isinstance(params, str) and params:
+        return json.loads(params)
+    if isinstance(params, dict):
+        return params
+    return request
+
+
+# 微批调度器：并发到达的单图请求在等待窗口内合并为一个批次推理
+batch_scheduler = CaptionBatchScheduler(caption_images, max_batch_size=MAX_BATCH_SIZE,
+                                        max_wait_ms=float(os.getenv("CAPTION_BATCH_MAX_WAIT_MS", "20")))
+
+@lru_cache(maxsize=None)
+def get_caption_cache() -> CaptionCache:
+    """
+    识别结果缓存：内存 LRU + 磁盘，重复图片（重试、重新扫描）直接返回已有结果。
+    首次使用时才打开 SQLite，路由进程不处理识别请求，不会打开缓存库。
+    """
+    return CaptionCache(
+        os.getenv("CAPTION_CACHE_PATH", os.path.join(os.path.dirname(__file__), "cache", "caption_cache.db")),
+        max_memory_entries=int(os.getenv("CAPTION_CACHE_MEMORY_SIZE", "1024")),
+        max_disk_entries=int(os.getenv("CAPTION_CACHE_DISK_SIZE", "100000")),
+    )
+
+
+async def stream_caption_request(image, send_partial) -> dict:
+    """
+    流式识别：生成过程中通过 send_partial 逐段发送新文本，结束后返回完整结果。
+    流式请求不参与微批合并，但与批次推理共用同一推理线程，按顺序占用 GPU。
+    """
+    loop = asyncio.get_running_loop()
+    streamer, run = stream_caption_image(image)
+    start_time = time.time()
+    generation = asyncio.ensure_future(batch_scheduler.run_exclusive(run))
+    ttft = None
+    try:
+        while True:
+            text = await loop.run_in_executor(None, next, streamer, None)
+            if text is None:
+                break
+            if ttft is None:
+                ttft = time.time() - start_time
+                logger.info(f"首个token耗时：{ttft:.2f}s")
+            if text:
+                await send_partial({"type": "partial", "text": text})
+        result = await generation
+    finally:
+        if not generation.done():
+            # 客户端断开或出错：尚未开始的生成直接取消，并结束流，释放阻塞在 streamer 上的线程
+            generation.cancel()
+            streamer.end()
+    logger.info(f"流式生成完成，耗时：{time.time() - start_time:.2f}s")
+    return {"result": result}
+
+
+def caption_cache_key(image_data) -> str:
+    """按图片内容、提示词、模型与采样参数生成结果缓存键"""
+    prompt = build_prompt(CAPTION_TYPE, EXTRA_OPTIONS[3:], CAPTION_LENGTH)
+    return make_cache_key(image_data, prompt, fancy_feast_model.model_id, GENERATION_KWARGS)
+
+
+# 模型未就绪时的策略：queue 等待加载完成后处理，reject 直接返回错误
+NOT_READY_POLICY = os.getenv("CAPTION_NOT_READY_POLICY", "queue")
+# queue 策略下等待模型就绪的最长时间（秒）
+READY_TIMEOUT = float(os.getenv("CAPTION_READY_TIMEOUT", "600"))
+# 后台加载结束（成功或失败）时在事件循环中置位
+model_ready_event = asyncio.Event()
+
+
+async def ensure_model_ready():
+    """模型未就绪时按策略等待或拒绝；加载失败时抛出异常"""
+    if fancy_feast_model.is_ready:
+        return
+    if fancy_feast_model.status != "failed":
+        if NOT_READY_POLICY == "reject":
+            raise ModelNotReadyError(f"模型加载中（{fancy_feast_model.stage}），请稍后重试")
+        try:
+            await asyncio.wait_for(model_ready_event.wait(), READY_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise ModelNotReadyError(f"等待模型加载超时（{READY_TIMEOUT}s）")
+    if not fancy_feast_model.is_ready:
+        raise ModelNotReadyError(f"模型加载失败：{fancy_feast_model.error}")
+
+
+async def cached_caption(image_data, load_image) -> str:
+    """
+    带缓存的单图识别：命中缓存时不解码图片、不占用模型，模型加载期间也可直接返回；
+    相同图片的并发请求只推理一次。
+
+    :param image_data: 图片原始字节，用于计算缓存键
+    :param load_image: 未命中时调用，返回 PIL.Image 对象
+    """
+
+    async def _compute():
+        await ensure_model_ready()
+        return await batch_scheduler.submit(load_image())
+
+    return await get_caption_cache().get_or_compute(caption_cache_key(image_data), _compute)
+
+
+async def handle_request(request: dict, send_partial=None, blobs: list = None) -> dict:
+    """
+    处理单条 WebSocket 请求，识别请求先查结果缓存，未命中时经由微批调度器执行。
+    blobs 为二进制帧中的图片原始字节；为空时从 params 中读取 Base64 图片（旧 JSON 格式）。
+    """
+    tool = request.get("tool")
+    params = parse_request_params(request)
+    if tool == "generate_image_caption":
+        if blobs:
+            image_data, load_image = blobs[0], lambda: decode_bytes_to_image(blobs[0])
+        else:
+            image_data = decode_base64_to_bytes(params.get("image_base64", ""))
+            load_image = lambda: decode_bytes_to_image(memoryview(image_data))
+        if params.get("stream") and send_partial is not None:
+            key = caption_cache_key(image_data)
+            cached = get_caption_cache().get(key)
+            if cached is not None:
+                # 命中缓存时一次性返回完整结果，不再逐段发送
+                return {"result": cached, "cached": True}
+            await ensure_model_ready()
+            response = await stream_caption_request(load_image(), send_partial)
+            get_caption_cache().put(key, response["result"])
+            return response
+        return {"result": await cached_caption(image_data, load_image)}
+    elif tool == "generate_image_captions":
+        if blobs:
+            images_data = blobs
+        else:
+            images_data = params.get("images_base64", [])
+
+        async def _caption(image_data):
+            try:
+                if isinstance(image_data, str):
+                    image_data = decode_base64_to_bytes(image_data)
+                return {"result": await cached_caption(image_data,
+                                                       lambda: decode_bytes_to_image(memoryview(image_data)))}
+            except Exception as e:
+                return {"error": str(e)}
+
+        return {"results": list(await asyncio.gather(*[_caption(image_data) for image_data in images_data]))}
+    elif tool == "get_model_status":
+        return fancy_feast_model.readiness()
+    elif tool == "get_batch_stats":
+        return {**batch_scheduler.stats(), "cache": get_caption_cache().stats()}
+    return {"error": "未知工具"}
+
+
 # WebSocket服务器
 async def handle_websocket(websocket):
     logger.info("WebSocket客户端已连接")
+
+    async def _send(request, response):
+        # 同一连接上的请求并发处理，返回顺序可能与发送顺序不同，回传 request_id 供客户端对应
+        if "request_id" in request:
+            response["request_id"] = request["request_id"]
+        await websocket.send(json.dumps(response))
+
+    async def _respond(request, blobs=None):
+        try:
+            response = await handle_request(request, send_partial=lambda frame: _send(request, frame), blobs=blobs)
+        except websockets.ConnectionClosed:
+            logger.info("WebSocket客户端已断开连接，停止流式发送")
+            return
+        except ModelNotReadyError as e:
+            # 附带加载进度，客户端可据此决定何时重试
+            response = {"error": str(e), "not_ready": True, "readiness": fancy_feast_model.readiness()}
+        except Exception as e:
+            logger.error(f"处理请求失败: {e}")
+            response = {"error": str(e)}
+        try:
+            await _send(request, response)
+        except websockets.ConnectionClosed:
+            logger.info("WebSocket客户端已断开连接，丢弃结果")
+
+    tasks = set()
     try:
         async for message in websocket:
-            request = json.loads(message)
-            logger.info(f"收到消息: {request}")
-            if request.get("tool") == "generate_image_caption":
-                result = generate_image_caption(request.get("image_base64", ""))
-                await websocket.send(json.dumps(result))
+            # 二进制帧：头部 + 图片原始字节；文本消息：旧的 JSON + Base64 格式
+            if is_binary_frame(message):
+                request, blobs = decode_binary_frame(message)
             else:
-                await websocket.send(json.dumps({"error": "未知工具"}))
+                request, blobs = json.loads(message), None
+            logger.info(f"收到消息: {request.get('tool')}")
+            task = asyncio.create_task(_respond(request, blobs))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
     except websockets.ConnectionClosed:
         logger.info("WebSocket客户端已断开连接")
+    finally:
+        for task in tasks:
+            task.cancel()
 
 
 # 主服务器循环
-async def main():
-    logger.info("正在启动MCP服务器在 ws://0.0.0.0:9200...")
-    async with websockets.serve(handle_websocket, "0.0.0.0", 9200):
+async def main(host: str = "0.0.0.0", port: int = 9200):
+    logger.info(f"正在启动MCP服务器在 ws://{host}:{port}...")
+    # 先监听端口，模型在后台加载并预热，完成后唤醒等待中的请求
+    loop = asyncio.get_running_loop()
+    fancy_feast_model.start_background_load(on_done=lambda: loop.call_soon_threadsafe(model_ready_event.set))
+    # 图片请求可能超过默认 1MB 的消息大小限制
+    async with websockets.serve(handle_websocket, host, port, max_size=None):
         await asyncio.Future()  # 永远运行
 
 
+def run_worker(port: int):
+    """工作进程入口：仅监听本机端口，由前置路由转发请求"""
+    asyncio.run(main(host="127.0.0.1", port=port))
+
+
+async def run_router(worker_count: int, port: int = 9200):
+    """
+    路由模式：启动 worker_count 个工作进程（每个进程一份模型），
+    本进程监听对外端口，按各进程的在途请求数转发请求。
+    """
+    router = CaptionRouter(run_worker, worker_count,
+                           base_port=int(os.getenv("CAPTION_WORKER_BASE_PORT", "9201")),
+                           max_retries=int(os.getenv("CAPTION_ROUTER_MAX_RETRIES", "2")),
+                           request_timeout=float(os.getenv("CAPTION_ROUTER_REQUEST_TIMEOUT", "300")))
+    logger.info(f"正在启动路由在 ws://0.0.0.0:{port}，工作进程数：{worker_count}...")
+    await router.start()
+    try:
+        async with websockets.serve(router.handle_client, "0.0.0.0", port, max_size=None):
+            await asyncio.Future()  # 永远运行
+    finally:
+        await router.stop()
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    # CAPTION_WORKERS 大于 0 时以路由模式启动多个工作进程，否则单进程直接服务
+    workers = int(os.getenv("CAPTION_WORKERS", "0"))
+    if workers > 0:
+        asyncio.run(run_router(workers))
+    else:
+        asyncio.run(main())
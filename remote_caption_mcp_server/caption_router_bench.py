@@ -0,0 +1,64 @@
+import asyncio
+import base64
+import io
+import json
+import os
+import tempfile
+import time
+
+# 使用替身后端，无需 GPU；需在导入服务模块、启动工作进程之前设置
+os.environ.setdefault("CAPTION_BACKEND", "fake")
+os.environ.setdefault("CAPTION_FAKE_FIXED_MS", "200")
+os.environ.setdefault("CAPTION_FAKE_PER_IMAGE_MS", "20")
+
+import websockets
+from PIL import Image
+
+from remote_caption_mcp_server.caption_mcp_start_2 import run_worker
+from remote_caption_mcp_server.utils.caption_router import CaptionRouter
+
+
+def _make_image(index: int) -> str:
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), (index % 256, index // 256 % 256, 128)).save(buffer, "PNG")
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+async def run_bench(request_count: int, worker_count: int, kill_worker_after: float = None,
+                    port: int = 9300) -> dict:
+    """
+    启动路由与工作进程，并发发送 request_count 个识别请求；
+    kill_worker_after 不为空时，在该秒数后杀掉第一个工作进程，验证重启与重试。
+    """
+    # 每轮使用空的结果缓存，避免命中上一轮的结果
+    os.environ["CAPTION_CACHE_PATH"] = os.path.join(tempfile.mkdtemp(), "caption_cache.db")
+    router = CaptionRouter(run_worker, worker_count, base_port=port + 1, request_timeout=30)
+    await router.start()
+    server = await websockets.serve(router.handle_client, "127.0.0.1", port, max_size=None)
+    try:
+        async with websockets.connect(f"ws://127.0.0.1:{port}", max_size=None) as ws:
+            start_time = time.time()
+            for request_id in range(request_count):
+                await ws.send(json.dumps({"tool": "generate_image_caption", "request_id": request_id,
+                                          "params": {"image_base64": _make_image(request_id)}}))
+            if kill_worker_after is not None:
+                await asyncio.sleep(kill_worker_after)
+                router.workers[0].process.kill()
+            responses = {}
+            while len(responses) < request_count:
+                response = json.loads(await ws.recv())
+                responses[response["request_id"]] = response
+            duration = time.time() - start_time
+        errors = [response for response in responses.values() if "result" not in response]
+        return {"workers": worker_count, "requests": request_count, "errors": len(errors),
+                "duration": round(duration, 2), **router.stats()}
+    finally:
+        server.close()
+        await server.wait_closed()
+        await router.stop()
+
+
+if __name__ == "__main__":
+    for workers in (1, 2, 4):
+        print(asyncio.run(run_bench(request_count=64, worker_count=workers)))
+    print(asyncio.run(run_bench(request_count=64, worker_count=2, kill_worker_after=0.3)))
@@ -0,0 +1,126 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from loguru import logger
+
+
+class CaptionBatchScheduler:
+    """
+    动态微批调度器：把并发到达的识别请求放入队列，在最长等待窗口内凑成一个批次，
+    在独立线程中执行推理（不阻塞事件循环），再把结果分别返回给各自的调用方。
+
+    推理函数通过 caption_fn 注入，签名为 caption_fn(images: list) -> list[str]，
+    因此可以用 CPU 上的替身模型测试和测量批处理收益。
+    """
+
+    def __init__(self, caption_fn: Callable[[list], list], max_batch_size: int = 8, max_wait_ms: float = 20):
+        """
+        :param caption_fn: 批量推理函数，输入图片列表，按顺序返回描述列表
+        :param max_batch_size: 单个批次的最大请求数
+        :param max_wait_ms: 收到批次第一个请求后，等待更多请求加入的最长时间（毫秒）
+        """
+        self.caption_fn = caption_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = None
+        self._worker = None
+        # 模型只有一份，推理串行执行
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="caption-batch")
+        self.batch_count = 0
+        self.request_count = 0
+        self.busy_seconds = 0.0
+
+    async def start(self):
+        """在当前事件循环中启动调度协程"""
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止调度协程并释放推理线程"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        self._executor.shutdown(wait=False)
+
+    async def submit(self, image) -> str:
+        """提交单张图片，等待所在批次推理完成后返回其描述"""
+        await self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((image, future))
+        return await future
+
+    async def run_exclusive(self, fn: Callable, *args):
+        """在推理线程中单独执行 fn（如流式生成），与批次推理串行，不会同时占用模型"""
+
+        def _timed():
+            start_time = time.time()
+            try:
+                return fn(*args)
+            finally:
+                self.busy_seconds += time.time() - start_time
+
+        return await asyncio.get_running_loop().run_in_executor(self._executor, _timed)
+
+    def stats(self) -> dict:
+        """批处理统计：批次数、请求数、平均批大小、推理耗时"""
+        return {
+            "batch_count": self.batch_count,
+            "request_count": self.request_count,
+            "avg_batch_size": self.request_count / self.batch_count if self.batch_count else 0,
+            "busy_seconds": self.busy_seconds,
+            "queue_size": self._queue.qsize() if self._queue else 0,
+        }
+
+    async def _collect_batch(self) -> list:
+        """取出第一个请求后，在等待窗口内继续收集，直到批次满或超时"""
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # 窗口结束时队列中已到达的请求也一并带上
+        while len(batch) < self.max_batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect_batch()
+            # 调用方已取消（如客户端断开）的请求不再推理
+            batch = [(image, future) for image, future in batch if not future.done()]
+            if not batch:
+                continue
+
+            images = [image for image, _ in batch]
+            start_time = time.time()
+            try:
+                captions = await loop.run_in_executor(self._executor, self.caption_fn, images)
+            except Exception as e:
+                logger.error(f"批量推理失败，批次大小：{len(batch)}，错误：{e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                self.busy_seconds += time.time() - start_time
+
+            self.batch_count += 1
+            self.request_count += len(batch)
+            logger.info(f"完成批次推理，批次大小：{len(batch)}，耗时：{time.time() - start_time:.2f}s")
+            for (_, future), caption in zip(batch, captions):
+                if not future.done():
+                    future.set_result(caption)
@@ -0,0 +1,90 @@
+import io
+import json
+import struct
+
+# 二进制帧格式（与客户端 agent/utils/binary_frame.py 保持一致）：
+#   4 字节魔数 b"PFWB" | 4 字节大端无符号整数：头部长度 | UTF-8 JSON 头部 | 依次拼接的原始字节块
+# 头部含 tool、params（对象）、request_id 等字段，以及 "blobs": [{"name": 名称, "size": 字节数}, ...]
+FRAME_MAGIC = b"PFWB"
+_HEADER_LEN = struct.Struct(">I")
+
+
+def is_binary_frame(message) -> bool:
+    """判断 WebSocket 消息是否为二进制帧（旧客户端发送的是 JSON 文本）"""
+    return isinstance(message, (bytes, bytearray, memoryview)) and bytes(message[:4]) == FRAME_MAGIC
+
+
+def encode_binary_frame(header: dict, blobs: list[tuple[str, bytes]]) -> bytes:
+    """
+    将头部和原始字节块编码为一个二进制帧（路由转发请求时使用）。
+
+    :param header: 请求头部（tool、params 等）
+    :param blobs: (名称, 原始字节或 memoryview) 列表
+    :return: 二进制消息
+    """
+    header = dict(header, blobs=[{"name": name, "size": len(data)} for name, data in blobs])
+    header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    return b"".join([FRAME_MAGIC, _HEADER_LEN.pack(len(header_bytes)), header_bytes, *[data for _, data in blobs]])
+
+
+def decode_binary_frame(message) -> tuple[dict, list[memoryview]]:
+    """
+    解码二进制帧，字节块以 memoryview 切片返回，不复制数据。
+
+    :param message: 二进制消息
+    :return: (头部字典, 与头部 blobs 顺序一致的 memoryview 列表)
+    """
+    view = memoryview(message)
+    (header_len,) = _HEADER_LEN.unpack_from(view, len(FRAME_MAGIC))
+    offset = len(FRAME_MAGIC) + _HEADER_LEN.size
+    header = json.loads(bytes(view[offset:offset + header_len]).decode("utf-8"))
+    offset += header_len
+    blobs = []
+    for blob in header.get("blobs", []):
+        size = blob["size"]
+        if offset + size > len(view):
+            raise ValueError(f"二进制帧长度不足，字节块 {blob.get('name')} 缺少数据")
+        blobs.append(view[offset:offset + size])
+        offset += size
+    return header, blobs
+
+
+def find_blob(header: dict, blobs: list, name: str):
+    """按头部中的名称取出字节块，不存在时返回 None"""
+    for blob, data in zip(header.get("blobs", []), blobs):
+        if blob.get("name") == name:
+            return data
+    return None
+
+
+class MemoryViewReader(io.RawIOBase):
+    """只读文件对象，直接从 memoryview 读取，供 PIL.Image.open 使用而无需先复制为 bytes"""
+
+    def __init__(self, view: memoryview):
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), len(self._view) - self._pos)
+        buffer[:size] = self._view[self._pos:self._pos + size]
+        self._pos += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = len(self._view) + offset
+        self._pos = max(0, self._pos)
+        return self._pos
+
+    def tell(self):
+        return self._pos
@@ -0,0 +1,133 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+from loguru import logger
+
+
+def make_cache_key(image_data, prompt: str, model_id: str, sampling_params: dict) -> str:
+    """
+    生成缓存键：图片内容哈希 + 提示词 + 模型ID + 采样参数，任一变化都不会命中旧结果。
+
+    :param image_data: 图片原始字节（bytes 或 memoryview）
+    """
+    image_hash = hashlib.sha256(image_data).hexdigest()
+    key_source = json.dumps([image_hash, prompt, model_id, sampling_params], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+
+class CaptionCache:
+    """
+    图片描述结果缓存：内存 LRU + SQLite 磁盘两级，并合并相同的在途请求。
+
+    相同键的请求正在生成时，后到的请求等待同一个结果，而不会再次占用 GPU。
+    只在事件循环线程中使用，无需加锁。
+    """
+
+    def __init__(self, db_path: str, max_memory_entries: int = 1024, max_disk_entries: int = 100000):
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self._memory = OrderedDict()
+        self._inflight = {}
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS caption_cache (
+                cache_key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        ''')
+        self._conn.commit()
+        self._puts_since_prune = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.coalesced = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        """查询缓存，未命中返回 None"""
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return self._memory[key]
+        row = self._conn.execute('SELECT result FROM caption_cache WHERE cache_key = ?', (key,)).fetchone()
+        if row is not None:
+            self.disk_hits += 1
+            self._remember(key, row[0])
+            return row[0]
+        return None
+
+    def put(self, key: str, result: str):
+        """写入内存与磁盘两级缓存"""
+        self._remember(key, result)
+        self._conn.execute('INSERT OR REPLACE INTO caption_cache (cache_key, result, created_at) VALUES (?, ?, ?)',
+                           (key, result, time.time()))
+        self._conn.commit()
+        self._puts_since_prune += 1
+        if self._puts_since_prune >= 100:
+            self._prune_disk()
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[str]]) -> str:
+        """
+        命中缓存直接返回；相同键已在生成时等待其结果；否则调用 compute 生成并写入缓存。
+
+        生成在独立任务中执行，各请求（包括发起方）通过 shield 等待：发起请求被取消（如客户端断开）时
+        生成继续进行，合并进来的其他请求仍能拿到结果。
+        """
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        if key in self._inflight:
+            self.coalesced += 1
+            return await asyncio.shield(self._inflight[key])
+
+        self.misses += 1
+        task = asyncio.ensure_future(self._compute_and_put(key, compute))
+        # 所有等待方都已取消时取走异常，避免未处理异常告警
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self._inflight[key] = task
+        return await asyncio.shield(task)
+
+    async def _compute_and_put(self, key: str, compute: Callable[[], Awaitable[str]]) -> str:
+        try:
+            result = await compute()
+            self.put(key, result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "memory_entries": len(self._memory),
+            "inflight": len(self._inflight),
+        }
+
+    def _remember(self, key: str, result: str):
+        self._memory[key] = result
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _prune_disk(self):
+        """磁盘条目超过上限时删除最早写入的记录"""
+        self._puts_since_prune = 0
+        (count,) = self._conn.execute('SELECT COUNT(*) FROM caption_cache').fetchone()
+        excess = count - self.max_disk_entries
+        if excess > 0:
+            self._conn.execute('''
+                DELETE FROM caption_cache WHERE cache_key IN (
+                    SELECT cache_key FROM caption_cache ORDER BY created_at LIMIT ?
+                )
+            ''', (excess,))
+            self._conn.commit()
+            logger.info(f"描述缓存清理 {excess} 条过期记录")
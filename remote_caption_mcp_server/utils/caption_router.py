@@ -0,0 +1,308 @@
+import asyncio
+import itertools
+import json
+import multiprocessing
+import time
+from typing import Callable
+
+import websockets
+from loguru import logger
+
+from remote_caption_mcp_server.utils.binary_frame import decode_binary_frame, encode_binary_frame, is_binary_frame
+
+
+class WorkerLostError(ConnectionError):
+    """工作进程崩溃、断开或被判定为卡死，其上的在途请求需要重试"""
+
+
+class _Job:
+    """一条经路由转发的请求"""
+
+    def __init__(self, header: dict, blobs: list, send_to_client: Callable):
+        self.header = header
+        self.blobs = blobs
+        self.send_to_client = send_to_client
+        self.attempts = 0
+        # 已向客户端转发过流式片段的请求不能换进程重试，否则文本会重复
+        self.streamed = False
+        self.future = None
+
+    def encode(self, internal_id: int):
+        """用路由内部 ID 替换 request_id 后重新编码，避免不同客户端的 ID 冲突"""
+        header = dict(self.header, request_id=internal_id)
+        if self.blobs is None:
+            return json.dumps(header)
+        names = [blob.get("name", "image") for blob in self.header.get("blobs", [])]
+        return encode_binary_frame(header, list(zip(names, self.blobs)))
+
+
+class _Worker:
+    def __init__(self, index: int, port: int):
+        self.index = index
+        self.port = port
+        self.process = None
+        self.ws = None
+        self.reader = None
+        self.pending = {}
+        self.ready = False
+        self.restarts = 0
+        self.restarting = False
+        self.completed = 0
+
+    @property
+    def connected(self) -> bool:
+        return self.ws is not None
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.pending)
+
+
+class CaptionRouter:
+    """
+    前置路由：启动 N 个工作进程（每个进程一份模型，各自监听一个端口），
+    把客户端请求转发给当前在途请求最少的已就绪进程。
+
+    工作进程崩溃或断开时自动重启，其在途请求转发到其他进程重试；
+    单个请求超过 request_timeout 未返回时，视为该进程卡死，杀掉重启后重试。
+    """
+
+    def __init__(self, worker_target: Callable[[int], None], worker_count: int, base_port: int = 9201,
+                 max_retries: int = 2, request_timeout: float = 300, start_timeout: float = 120):
+        """
+        :param worker_target: 工作进程入口，参数为监听端口，需可被 spawn 方式导入
+        :param worker_count: 工作进程数
+        :param base_port: 第 i 个工作进程监听 base_port + i
+        :param max_retries: 单个请求因进程故障最多重试的次数
+        :param request_timeout: 单个请求的最长处理时间（秒），0 表示不限制
+        :param start_timeout: 工作进程启动后等待其端口可连接的最长时间（秒）
+        """
+        self.worker_target = worker_target
+        self.max_retries = max_retries
+        self.request_timeout = request_timeout or None
+        self.start_timeout = start_timeout
+        self.workers = [_Worker(i, base_port + i) for i in range(worker_count)]
+        self._mp = multiprocessing.get_context("spawn")
+        self._ids = itertools.count(1)
+        self._available = None
+        self._tasks = set()
+        self.retries = 0
+
+    async def start(self):
+        """启动全部工作进程并建立连接"""
+        self._available = asyncio.Condition()
+        await asyncio.gather(*[self._start_worker(worker) for worker in self.workers])
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        for worker in self.workers:
+            if worker.ws is not None:
+                await worker.ws.close()
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.kill()
+                worker.process.join(timeout=5)
+
+    def stats(self) -> dict:
+        """各工作进程的队列深度、就绪状态、完成数与重启次数"""
+        return {
+            "retries": self.retries,
+            "workers": [{
+                "index": worker.index,
+                "port": worker.port,
+                "connected": worker.connected,
+                "ready": worker.ready,
+                "queue_depth": worker.queue_depth,
+                "completed": worker.completed,
+                "restarts": worker.restarts,
+            } for worker in self.workers],
+        }
+
+    async def handle_client(self, websocket):
+        """客户端连接：每条消息一个转发任务，响应按客户端原 request_id 回传"""
+        logger.info("WebSocket客户端已连接（路由）")
+
+        async def _respond(job: _Job):
+            try:
+                response = await self.dispatch(job)
+            except Exception as e:
+                logger.error(f"路由转发失败: {e}")
+                response = {"error": str(e)}
+            try:
+                await job.send_to_client(response)
+            except websockets.ConnectionClosed:
+                logger.info("WebSocket客户端已断开连接，丢弃结果")
+
+        def _sender(request_id):
+            async def _send(frame: dict):
+                frame = dict(frame)
+                frame.pop("request_id", None)
+                if request_id is not None:
+                    frame["request_id"] = request_id
+                await websocket.send(json.dumps(frame))
+
+            return _send
+
+        tasks = set()
+        try:
+            async for message in websocket:
+                if is_binary_frame(message):
+                    header, blobs = decode_binary_frame(message)
+                else:
+                    header, blobs = json.loads(message), None
+                if header.get("tool") == "get_router_stats":
+                    await _sender(header.get("request_id"))(self.stats())
+                    continue
+                job = _Job(header, blobs, _sender(header.get("request_id")))
+                task = asyncio.create_task(_respond(job))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except websockets.ConnectionClosed:
+            logger.info("WebSocket客户端已断开连接（路由）")
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def dispatch(self, job: _Job) -> dict:
+        """转发请求并等待结果；进程故障时换进程重试"""
+        while True:
+            job.attempts += 1
+            worker = await self._pick_worker()
+            internal_id = next(self._ids)
+            job.future = asyncio.get_running_loop().create_future()
+            worker.pending[internal_id] = job
+            try:
+                await worker.ws.send(job.encode(internal_id))
+                response = await asyncio.wait_for(asyncio.shield(job.future), self.request_timeout)
+                worker.completed += 1
+                return response
+            except (WorkerLostError, websockets.ConnectionClosed, asyncio.TimeoutError) as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    logger.error(f"工作进程 {worker.index} 处理超时（{self.request_timeout}s），判定为卡死并重启")
+                    self._schedule_restart(worker)
+                if job.streamed or job.attempts > self.max_retries:
+                    raise WorkerLostError(f"工作进程故障，请求失败（已尝试 {job.attempts} 次）：{e}")
+                self.retries += 1
+                logger.warning(f"工作进程 {worker.index} 故障，请求转发到其他进程重试（第 {job.attempts} 次）")
+            finally:
+                worker.pending.pop(internal_id, None)
+
+    async def _pick_worker(self) -> _Worker:
+        """选择在途请求最少的进程，已就绪的优先；都不可用时等待"""
+        async with self._available:
+            while True:
+                connected = [worker for worker in self.workers if worker.connected]
+                if connected:
+                    return min(connected, key=lambda worker: (not worker.ready, worker.queue_depth))
+                await self._available.wait()
+
+    async def _notify_available(self):
+        async with self._available:
+            self._available.notify_all()
+
+    def _spawn(self, worker: _Worker):
+        worker.process = self._mp.Process(target=self.worker_target, args=(worker.port,),
+                                          name=f"caption-worker-{worker.index}", daemon=True)
+        worker.process.start()
+        logger.info(f"已启动工作进程 {worker.index}，pid：{worker.process.pid}，端口：{worker.port}")
+
+    async def _start_worker(self, worker: _Worker):
+        self._spawn(worker)
+        deadline = time.time() + self.start_timeout
+        while True:
+            try:
+                worker.ws = await websockets.connect(f"ws://127.0.0.1:{worker.port}", max_size=None)
+                break
+            except OSError:
+                if time.time() > deadline or not worker.process.is_alive():
+                    logger.error(f"工作进程 {worker.index} 启动失败，稍后重试")
+                    # 可能处于重启流程中，待其结束后再安排下一次重启
+                    asyncio.get_running_loop().call_soon(self._schedule_restart, worker)
+                    return
+                await asyncio.sleep(0.5)
+        worker.ready = False
+        worker.reader = self._create_task(self._read_loop(worker, worker.ws))
+        self._create_task(self._poll_ready(worker, worker.ws))
+        await self._notify_available()
+
+    def _schedule_restart(self, worker: _Worker):
+        self._create_task(self._restart_worker(worker))
+
+    async def _restart_worker(self, worker: _Worker):
+        """杀掉（如仍存活）并重启工作进程；连接断开会使其在途请求以 WorkerLostError 结束并重试"""
+        if worker.restarting:
+            return
+        worker.restarting = True
+        try:
+            await self._do_restart(worker)
+        finally:
+            worker.restarting = False
+
+    async def _do_restart(self, worker: _Worker):
+        ws, worker.ws, worker.ready = worker.ws, None, False
+        if ws is not None:
+            await ws.close()
+        if worker.process is not None and worker.process.is_alive():
+            worker.process.kill()
+        if worker.process is not None:
+            await asyncio.get_running_loop().run_in_executor(None, worker.process.join, 5)
+        worker.restarts += 1
+        self._fail_pending(worker)
+        await asyncio.sleep(min(worker.restarts, 5))
+        await self._start_worker(worker)
+
+    def _fail_pending(self, worker: _Worker):
+        for job in list(worker.pending.values()):
+            if job.future is not None and not job.future.done():
+                job.future.set_exception(WorkerLostError(f"工作进程 {worker.index} 已断开"))
+        worker.pending.clear()
+
+    async def _read_loop(self, worker: _Worker, ws):
+        """读取工作进程的响应：流式片段直接转发给客户端，最终结果交给等待中的 dispatch"""
+        try:
+            async for message in ws:
+                response = json.loads(message)
+                job = worker.pending.get(response.get("request_id"))
+                if job is None:
+                    continue
+                if response.get("type") == "partial":
+                    job.streamed = True
+                    try:
+                        await job.send_to_client(response)
+                    except websockets.ConnectionClosed:
+                        pass
+                elif not job.future.done():
+                    job.future.set_result(response)
+        except websockets.ConnectionClosed:
+            pass
+        if worker.ws is ws:
+            logger.error(f"工作进程 {worker.index} 连接断开，准备重启")
+            worker.ws, worker.ready = None, False
+            self._fail_pending(worker)
+            self._schedule_restart(worker)
+
+    async def _poll_ready(self, worker: _Worker, ws):
+        """轮询工作进程的模型加载状态，就绪后才优先分配请求"""
+        while worker.ws is ws and not worker.ready:
+            internal_id = next(self._ids)
+            job = _Job({"tool": "get_model_status"}, None, None)
+            job.future = asyncio.get_running_loop().create_future()
+            worker.pending[internal_id] = job
+            try:
+                await ws.send(job.encode(internal_id))
+                status = await asyncio.wait_for(job.future, 10)
+                worker.ready = bool(status.get("ready"))
+            except (WorkerLostError, websockets.ConnectionClosed, asyncio.TimeoutError):
+                return
+            finally:
+                worker.pending.pop(internal_id, None)
+            if worker.ready:
+                logger.info(f"工作进程 {worker.index} 模型已就绪")
+            else:
+                await asyncio.sleep(1)
+
+    def _create_task(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
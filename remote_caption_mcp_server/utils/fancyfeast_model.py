@@ -1,33 +1,147 @@
-from transformers import LlavaForConditionalGeneration, AutoProcessor
-# from liger_kernel.transformers import apply_liger_kernel_to_llama
+import threading
+import time
+
+from loguru import logger
+
+from remote_caption_mcp_server.utils.inference_backend import InferenceBackend, create_backend
+
+
+class ModelNotReadyError(RuntimeError):
+    """模型尚未加载完成（或预热未完成）时拒绝请求"""
 
 
 class FancyFeastModel:
+    """
+    单例模型。构造时不加载权重，由 start_background_load 在后台线程中加载并预热，
+    服务可以先监听端口，通过 readiness() 查询加载进度与耗时。
+    未启动后台加载时，首次调用 get_processor / get_model 会同步加载（兼容旧用法）。
+    具体的加载与生成由推理后端完成（见 inference_backend.py，CAPTION_BACKEND 选择）。
+    """
     _instance = None
+    _lock = threading.Lock()
 
     def __new__(cls, *args, **kwargs):
         if not cls._instance:
-            if not cls._instance:
-                cls._instance = super(FancyFeastModel, cls).__new__(cls)
-                cls._instance._load_model()
+            with cls._lock:
+                if not cls._instance:
+                    instance = super(FancyFeastModel, cls).__new__(cls)
+                    instance._init_state(*args, **kwargs)
+                    cls._instance = instance
         return cls._instance
 
-    def _load_model(self):
-        # 加载模型和处理器
-        # 修改：使用 Hugging Face 支持的模型名称，而非本地路径
-        MODEL_PATH = "fancyfeast/llama-joycaption-beta-one-hf-llava"
-        self.processor = AutoProcessor.from_pretrained(MODEL_PATH)
-        self.model = LlavaForConditionalGeneration.from_pretrained(
-            MODEL_PATH,
-            torch_dtype="bfloat16",
-            device_map="auto",
-        )
-        self.model.eval()
-        # apply_liger_kernel_to_llama(model=self.model.language_model)  # Meow
-        print("✅ 模型加载成功！")
+    def _init_state(self, backend: InferenceBackend = None):
+        self.backend = backend or create_backend()
+        self.model_path = self.backend.model_path
+        # idle -> loading -> warming_up -> ready，任一阶段出错进入 failed
+        self.status = "idle"
+        self.stage = None
+        self.progress = 0.0
+        self.error = None
+        self.timings = {}
+        self.started_at = None
+        self.ready_at = None
+        self._ready_event = threading.Event()
+        self._load_thread = None
+        self._done_callbacks = []
+
+    @property
+    def processor(self):
+        return self.backend.processor
+
+    @property
+    def model(self):
+        return self.backend.model
+
+    @property
+    def model_id(self) -> str:
+        return self.backend.model_id
+
+    @property
+    def is_ready(self) -> bool:
+        return self.status == "ready"
+
+    def start_background_load(self, on_done=None):
+        """
+        在后台线程中加载模型并执行一次预热生成，重复调用不会重复加载。
+
+        :param on_done: 加载结束（成功或失败）后调用；加载已结束时立即调用
+        """
+        with self._lock:
+            if on_done is not None and not self._ready_event.is_set():
+                self._done_callbacks.append(on_done)
+                on_done = None
+            if self._load_thread is None:
+                self._load_thread = threading.Thread(target=self._load_and_warmup, name="model-loader", daemon=True)
+                self._load_thread.start()
+        if on_done is not None:
+            on_done()
+
+    def wait_ready(self, timeout: float = None) -> bool:
+        """阻塞等待加载结束，返回是否已就绪"""
+        self._ready_event.wait(timeout)
+        return self.is_ready
+
+    def readiness(self) -> dict:
+        """加载状态、阶段、进度与各阶段耗时"""
+        now = time.time()
+        return {
+            "ready": self.is_ready,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": round(self.progress, 2),
+            "error": self.error,
+            "backend": self.backend.name,
+            "model_id": self.model_id,
+            "timings": dict(self.timings),
+            "elapsed_seconds": round((self.ready_at or now) - self.started_at, 2) if self.started_at else 0,
+        }
+
+    def _load_and_warmup(self):
+        self.started_at = time.time()
+        try:
+            self.status = "loading"
+            self._run_stage("processor", 0.1, self.backend.load_processor)
+            self._run_stage("model", 0.9, self.backend.load_model)
+            self.status = "warming_up"
+            self._run_stage("warmup", 1.0, self.backend.warmup)
+            self.ready_at = time.time()
+            self.status = "ready"
+            logger.info(f"✅ 模型加载并预热完成，总耗时：{self.ready_at - self.started_at:.2f}s")
+        except Exception as e:
+            self.error = str(e)
+            self.status = "failed"
+            logger.exception(f"模型加载失败，阶段：{self.stage}，错误：{e}")
+        finally:
+            with self._lock:
+                self._ready_event.set()
+                callbacks, self._done_callbacks = self._done_callbacks, []
+            for callback in callbacks:
+                callback()
+
+    def _run_stage(self, stage: str, progress: float, fn):
+        self.stage = stage
+        logger.info(f"模型加载阶段：{stage}")
+        start_time = time.time()
+        fn()
+        self.timings[stage] = round(time.time() - start_time, 2)
+        self.progress = progress
+
+    def _ensure_loaded(self):
+        if self.status in ("warming_up", "ready"):
+            return
+        self.start_background_load()
+        if not self.wait_ready():
+            raise ModelNotReadyError(f"模型加载失败：{self.error}")
+
+    def get_backend(self) -> InferenceBackend:
+        self._ensure_loaded()
+        return self.backend
 
     def get_processor(self):
+        if self.processor is None:
+            self._ensure_loaded()
         return self.processor
 
     def get_model(self):
-        return self.model
\ No newline at end of file
+        self._ensure_loaded()
+        return self.model
@@ -0,0 +1,398 @@
+import copy
+import hashlib
+import os
+import queue
+import time
+
+from loguru import logger
+
+# 修改：使用 Hugging Face 支持的模型名称，而非本地路径
+MODEL_PATH = "fancyfeast/llama-joycaption-beta-one-hf-llava"
+
+
+class InferenceBackend:
+    """
+    推理后端接口。FancyFeastModel 负责加载流程与就绪状态，具体的权重加载、
+    输入放置（设备/精度）与生成由后端实现，服务端只调用这里的方法。
+    """
+    name = "base"
+
+    def __init__(self, model_path: str = MODEL_PATH):
+        self.model_path = model_path
+        self.processor = None
+        self.model = None
+
+    @property
+    def model_id(self) -> str:
+        """区分模型与推理方式的标识，结果缓存键的一部分"""
+        return f"{self.name}:{self.model_path}"
+
+    def load_processor(self):
+        raise NotImplementedError
+
+    def load_model(self):
+        raise NotImplementedError
+
+    def warmup(self):
+        """加载完成后执行一次短生成"""
+
+    def format_prompt(self, convo: list[dict]) -> str:
+        """把对话消息渲染为模型输入文本"""
+        raise NotImplementedError
+
+    def caption_batch(self, prompt: str, images: list, **generation_kwargs) -> list[str]:
+        """一次生成多张图片的描述，按输入顺序返回解码后的完整文本"""
+        raise NotImplementedError
+
+    def stream_caption(self, prompt: str, image, streamer_timeout: float = None, stop_event=None,
+                       **generation_kwargs):
+        """
+        流式生成单张图片的描述。
+
+        :param stop_event: 可选的 threading.Event，置位后生成在下一个 token 处停止
+        :return: (streamer, run)。run 需在推理线程中执行，生成结束后返回完整解码文本；
+                 streamer 为迭代器，在生成过程中逐段产出新生成的文本，end() 可提前结束
+        """
+        raise NotImplementedError
+
+
+class TransformersBackend(InferenceBackend):
+    """
+    基于 transformers LLaVA 的后端，子类决定设备、精度与加载方式。
+
+    同一提示词的请求只有图片不同：文本部分的 token 按提示词缓存，每次只处理图片。
+
+    CAPTION_PREFIX_CACHE=true 时图片 token 之前的前缀（系统提示等）的 KV 状态也按提示词缓存，
+    生成时从前缀之后开始计算。部分 transformers 版本的 LLaVA 只在 cache_position 从 0 开始时
+    合并图片特征，带前缀缓存生成会丢失图片内容，因此默认关闭；开启后预热时会对比有无缓存的生成结果，
+    不一致时自动关闭。
+    """
+    device = "cuda"
+    dtype = "bfloat16"
+
+    def __init__(self, model_path: str = MODEL_PATH):
+        super().__init__(model_path)
+        self.prefix_cache_enabled = os.getenv("CAPTION_PREFIX_CACHE", "false").lower() == "true"
+        self._text_inputs = {}
+        self._prefix_kv = {}
+
+    def load_processor(self):
+        from transformers import AutoProcessor
+
+        self.processor = AutoProcessor.from_pretrained(self.model_path)
+        # 批量生成时左侧填充，保证各条序列的生成位置对齐
+        self.processor.tokenizer.padding_side = "left"
+
+    def load_model(self):
+        self.model = self._load_weights()
+        self.model.eval()
+
+    def _load_weights(self):
+        raise NotImplementedError
+
+    def format_prompt(self, convo: list[dict]) -> str:
+        return self.processor.apply_chat_template(convo, tokenize=False, add_generation_prompt=True)
+
+    def _fixed_image_tokens(self) -> bool:
+        """LLaVA（非动态切片）每张图片展开的 token 数固定，文本 token 可跨请求复用"""
+        return type(self.processor).__name__ == "LlavaProcessor"
+
+    def _get_text_inputs(self, prompt: str) -> dict:
+        """按提示词缓存展开图片占位符后的 input_ids 与 attention_mask"""
+        if prompt not in self._text_inputs:
+            from PIL import Image
+
+            inputs = self.processor(text=[prompt], images=[Image.new("RGB", (64, 64))], return_tensors="pt")
+            self._text_inputs[prompt] = {"input_ids": inputs["input_ids"], "attention_mask": inputs["attention_mask"]}
+        return self._text_inputs[prompt]
+
+    def _prepare_inputs(self, prompts: list[str], images: list):
+        import torch
+        from transformers import BatchFeature
+
+        if len(set(prompts)) == 1 and self._fixed_image_tokens():
+            text_inputs = self._get_text_inputs(prompts[0])
+            inputs = BatchFeature({
+                "input_ids": text_inputs["input_ids"].repeat(len(images), 1),
+                "attention_mask": text_inputs["attention_mask"].repeat(len(images), 1),
+                "pixel_values": self.processor.image_processor(images, return_tensors="pt")["pixel_values"],
+            }).to(self.device)
+        else:
+            inputs = self.processor(text=prompts, images=images, padding=True, return_tensors="pt").to(self.device)
+        inputs['pixel_values'] = inputs['pixel_values'].to(getattr(torch, self.dtype))
+        return inputs
+
+    def _get_prefix_kv(self, prompt: str, input_ids):
+        """
+        返回提示词前缀（第一个图片 token 之前）的 KV 缓存副本，已按批大小展开；
+        找不到图片 token 或各行前缀不一致（存在左侧填充）时返回 None。
+        """
+        import torch
+
+        config = self.model.config
+        image_token_id = getattr(config, "image_token_id", None) or getattr(config, "image_token_index", None)
+        if image_token_id is None:
+            return None
+        positions = (input_ids[0] == image_token_id).nonzero()
+        if len(positions) == 0:
+            return None
+        prefix_len = int(positions[0])
+        prefix_ids = input_ids[0, :prefix_len]
+        if prefix_len < 2 or not bool((input_ids[:, :prefix_len] == prefix_ids).all()):
+            return None
+
+        if prompt not in self._prefix_kv:
+            with torch.no_grad():
+                outputs = self.model(input_ids=prefix_ids.unsqueeze(0), use_cache=True)
+            self._prefix_kv[prompt] = outputs.past_key_values
+            logger.info(f"已缓存提示词前缀 KV，前缀长度：{prefix_len}")
+        # generate 会在缓存上追加新 token，每次使用副本
+        past_key_values = copy.deepcopy(self._prefix_kv[prompt])
+        if input_ids.shape[0] > 1:
+            past_key_values.batch_repeat_interleave(input_ids.shape[0])
+        return past_key_values
+
+    def _generate(self, prompt: str, inputs, **generation_kwargs):
+        """生成时复用前缀 KV；当前 transformers 版本不支持时关闭前缀缓存并按完整输入重新生成"""
+        past_key_values = None
+        if self.prefix_cache_enabled:
+            try:
+                past_key_values = self._get_prefix_kv(prompt, inputs["input_ids"])
+            except Exception as e:
+                logger.warning(f"前缀 KV 缓存不可用，已关闭：{e}")
+                self.prefix_cache_enabled = False
+        if past_key_values is None:
+            return self.model.generate(**inputs, **generation_kwargs, use_cache=True)
+        try:
+            return self.model.generate(**inputs, **generation_kwargs, past_key_values=past_key_values,
+                                       use_cache=True)
+        except Exception as e:
+            # 流式生成已向 streamer 输出过内容，不能重试
+            if "streamer" in generation_kwargs:
+                raise
+            logger.warning(f"复用前缀 KV 生成失败，已关闭前缀缓存：{e}")
+            self.prefix_cache_enabled = False
+            return self.model.generate(**inputs, **generation_kwargs, use_cache=True)
+
+    def validate_prefix_cache(self, prompt: str, image, max_new_tokens: int = 16) -> bool:
+        """
+        用同一输入分别在有无前缀缓存时贪心生成，结果不一致（如图片特征被丢弃）时关闭前缀缓存。
+
+        :return: 前缀缓存是否可用
+        """
+        import torch
+        import transformers
+
+        inputs = self._prepare_inputs([prompt], [image])
+        with torch.no_grad():
+            expected = self.model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False)
+            actual = self._generate(prompt, inputs, max_new_tokens=max_new_tokens, do_sample=False)
+        if not self.prefix_cache_enabled:
+            return False
+        if expected.shape != actual.shape or not bool((expected == actual).all()):
+            logger.warning(f"前缀 KV 缓存的生成结果与完整输入不一致（transformers {transformers.__version__}），已关闭")
+            self.prefix_cache_enabled = False
+            return False
+        logger.info(f"前缀 KV 缓存校验通过（transformers {transformers.__version__}）")
+        return True
+
+    def warmup(self):
+        """用一张小图做一次短生成，提前完成设备初始化与内核编译，首个真实请求不再承担这部分耗时"""
+        import torch
+        from PIL import Image
+
+        prompt = self.format_prompt([{"role": "user", "content": "为这幅图像写一个描述。"}])
+        # 带渐变的图片：图片特征丢失时生成结果会明显不同，便于校验前缀缓存
+        image = Image.linear_gradient("L").convert("RGB").resize((64, 64))
+        if self.prefix_cache_enabled:
+            self.validate_prefix_cache(prompt, image)
+            return
+        inputs = self._prepare_inputs([prompt], [image])
+        with torch.no_grad():
+            self.model.generate(**inputs, max_new_tokens=4, do_sample=False)
+
+    def caption_batch(self, prompt: str, images: list, **generation_kwargs) -> list[str]:
+        inputs = self._prepare_inputs([prompt] * len(images), images)
+        outputs = self._generate(prompt, inputs, **generation_kwargs)
+        return self.processor.batch_decode(outputs, skip_special_tokens=True)
+
+    def stream_caption(self, prompt: str, image, streamer_timeout: float = None, stop_event=None,
+                       **generation_kwargs):
+        from transformers import TextIteratorStreamer
+
+        inputs = self._prepare_inputs([prompt], [image])
+        streamer = TextIteratorStreamer(self.processor.tokenizer, timeout=streamer_timeout, skip_prompt=True,
+                                        skip_special_tokens=True)
+        if stop_event is not None:
+            generation_kwargs["stopping_criteria"] = _event_stopping_criteria(stop_event)
+
+        def run():
+            try:
+                outputs = self._generate(prompt, inputs, streamer=streamer, **generation_kwargs)
+            except Exception:
+                # 生成失败时结束流，避免消费方一直阻塞
+                streamer.end()
+                raise
+            return self.processor.decode(outputs[0], skip_special_tokens=True)
+
+        return streamer, run
+
+
+def _event_stopping_criteria(stop_event):
+    """stop_event 置位后让 generate 在下一个 token 处停止"""
+    import torch
+    from transformers import StoppingCriteria, StoppingCriteriaList
+
+    class _EventStoppingCriteria(StoppingCriteria):
+        def __call__(self, input_ids, scores, **kwargs):
+            return torch.full((input_ids.shape[0],), stop_event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+    return StoppingCriteriaList([_EventStoppingCriteria()])
+
+
+class CudaBackend(TransformersBackend):
+    """GPU 后端：bfloat16 权重，按显存自动分配设备"""
+    name = "cuda"
+
+    def _load_weights(self):
+        from transformers import LlavaForConditionalGeneration
+
+        # from liger_kernel.transformers import apply_liger_kernel_to_llama
+        model = LlavaForConditionalGeneration.from_pretrained(
+            self.model_path,
+            torch_dtype="bfloat16",
+            device_map="auto",
+        )
+        # apply_liger_kernel_to_llama(model=model.language_model)  # Meow
+        return model
+
+
+class CpuBackend(TransformersBackend):
+    """
+    CPU 后端：float32 权重，可选 int8 动态量化（仅量化 Linear 层），
+    可通过 CAPTION_CPU_MODEL_PATH 换用更小的兼容 LLaVA 检查点。
+    """
+    name = "cpu"
+    device = "cpu"
+    dtype = "float32"
+
+    def __init__(self, model_path: str = None, quantize: str = None, num_threads: int = None):
+        super().__init__(model_path or os.getenv("CAPTION_CPU_MODEL_PATH", MODEL_PATH))
+        self.quantize = (quantize or os.getenv("CAPTION_CPU_QUANTIZE", "none")).lower()
+        self.num_threads = num_threads or int(os.getenv("CAPTION_CPU_THREADS", "0"))
+
+    @property
+    def model_id(self) -> str:
+        return f"{super().model_id}:{self.quantize}"
+
+    def _load_weights(self):
+        import torch
+        from transformers import LlavaForConditionalGeneration
+
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+        model = LlavaForConditionalGeneration.from_pretrained(self.model_path, torch_dtype=torch.float32)
+        if self.quantize == "int8":
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            logger.info("已对 Linear 层进行 int8 动态量化")
+        return model
+
+
+class _QueueStreamer:
+    """与 TextIteratorStreamer 用法一致的简单文本流"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def put(self, text: str):
+        self._queue.put(text)
+
+    def end(self):
+        self._queue.put(None)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        text = self._queue.get()
+        if text is None:
+            raise StopIteration
+        return text
+
+
+class FakeBackend(InferenceBackend):
+    """
+    确定性替身后端：不加载任何权重，按图片内容哈希生成固定描述，可模拟推理耗时。
+    用于在没有 GPU 的机器上测试与压测服务链路（调度、缓存、路由）。
+    """
+    name = "fake"
+
+    def __init__(self, model_path: str = "fake", fixed_ms: float = None, per_image_ms: float = None):
+        super().__init__(model_path)
+        self.fixed_seconds = (fixed_ms if fixed_ms is not None else float(os.getenv("CAPTION_FAKE_FIXED_MS", "0"))) / 1000
+        self.per_image_seconds = (per_image_ms if per_image_ms is not None else
+                                  float(os.getenv("CAPTION_FAKE_PER_IMAGE_MS", "0"))) / 1000
+
+    def load_processor(self):
+        pass
+
+    def load_model(self):
+        pass
+
+    def format_prompt(self, convo: list[dict]) -> str:
+        # 与真实模型解码后的对话格式一致：角色名与内容之间以空行分隔
+        return "".join(f"{message['role']}\n\n{message['content']}" for message in convo) + "assistant\n\n"
+
+    def _caption(self, image) -> str:
+        digest = hashlib.sha256(image.tobytes()).hexdigest()[:12]
+        return f"一幅 {image.width}x{image.height} 的测试图像，内容指纹 {digest}。"
+
+    def caption_batch(self, prompt: str, images: list, **generation_kwargs) -> list[str]:
+        time.sleep(self.fixed_seconds + self.per_image_seconds * len(images))
+        return [prompt + self._caption(image) for image in images]
+
+    def stream_caption(self, prompt: str, image, streamer_timeout: float = None, stop_event=None,
+                       **generation_kwargs):
+        streamer = _QueueStreamer()
+
+        def run():
+            try:
+                caption = self.caption_batch(prompt, [image])[0][len(prompt):]
+                for start in range(0, len(caption), 4):
+                    if stop_event is not None and stop_event.is_set():
+                        caption = caption[:start]
+                        break
+                    streamer.put(caption[start:start + 4])
+            finally:
+                streamer.end()
+            return prompt + caption
+
+        return streamer, run
+
+
+# 后端注册表：通过 CAPTION_BACKEND 选择，auto 表示有 GPU 时用 cuda，否则用 cpu
+BACKENDS = {
+    "cuda": CudaBackend,
+    "cpu": CpuBackend,
+    "fake": FakeBackend,
+}
+
+
+def register_backend(name: str, backend_cls):
+    """注册自定义推理后端"""
+    BACKENDS[name] = backend_cls
+
+
+def create_backend(name: str = None) -> InferenceBackend:
+    """按名称创建推理后端"""
+    name = (name or os.getenv("CAPTION_BACKEND", "auto")).lower()
+    if name == "auto":
+        try:
+            import torch
+            name = "cuda" if torch.cuda.is_available() else "cpu"
+        except ImportError:
+            name = "cpu"
+    if name not in BACKENDS:
+        raise ValueError(f"未知推理后端：{name}，可选：{', '.join(BACKENDS)}")
+    logger.info(f"使用推理后端：{name}")
+    return BACKENDS[name]()
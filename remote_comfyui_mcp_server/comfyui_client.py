@@ -175,13 +175,14 @@ class ComfyUIClient:
         except requests.RequestException as e:
             raise Exception(f"ComfyUI API错误: {e}")  # 请求异常处理
 
-    async def generate_image_to_video(self, image_path, prompt, workflow_id="hy_image_to_video_api", ):
+    async def generate_image_to_video(self, image_path, prompt, workflow_id="hy_image_to_video_api", image_data=None):
         """从图像生成视频
         
         Args:
-            image_path (str): 输入图像的路径
+            image_path (str): 输入图像的路径（提供 image_data 时仅用于确定文件名）
             prompt (str): 提示文本
             workflow_id (str, optional): 工作流ID. 默认为"hy_image_to_video_api".
+            image_data (bytes, optional): 客户端通过二进制帧发送的图像原始字节
         Returns:
             str: 生成的视频URL
             
@@ -195,7 +196,7 @@ class ComfyUIClient:
             logger.info(f"使用工作流 {workflow_id} 生成视频...")
             # logger.info(f"workflow_id:\n{json.dumps(workflow, indent=2, ensure_ascii=False)}")
             # 上传图像
-            uploaded_filename = self.upload_image(image_path)
+            uploaded_filename = self.upload_image(image_path, image_data)
             logger.info(f"上传的图像文件名: {uploaded_filename}")
 
             # 加载参数映射表
@@ -233,11 +234,12 @@ class ComfyUIClient:
         except requests.RequestException as e:
             raise Exception(f"ComfyUI API错误: {e}")  # 请求异常处理
 
-    def upload_image(self, image_path):
+    def upload_image(self, image_path, image_data=None):
         """上传图像到ComfyUI的input目录
         
         Args:
             image_path (str): 要上传的图像路径
+            image_data (bytes, optional): 图像原始字节，提供时直接上传，不读取 image_path
             
         Returns:
             str: 上传后服务器上的文件名
@@ -248,12 +250,15 @@ class ComfyUIClient:
         try:
             url = f"{self.base_url}/api/upload/image"
             filename = os.path.basename(image_path)
-            with open(image_path, 'rb') as f:
-                files = {'image': (filename, f)}
-                data = {'overwrite': 'true'}
-                response = requests.post(url, files=files, data=data)
-                response.raise_for_status()
-                return response.json()['name']
+            data = {'overwrite': 'true'}
+            if image_data is not None:
+                response = requests.post(url, files={'image': (filename, image_data)}, data=data)
+            else:
+                with open(image_path, 'rb') as f:
+                    files = {'image': (filename, f)}
+                    response = requests.post(url, files=files, data=data)
+            response.raise_for_status()
+            return response.json()['name']
         except Exception as e:
             raise Exception(f"上传图像失败: {e}")
 
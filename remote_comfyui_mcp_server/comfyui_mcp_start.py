@@ -6,6 +6,7 @@ from contextlib import asynccontextmanager
 import websockets
 from mcp.server.fastmcp import FastMCP
 from comfyui_client import ComfyUIClient
+from binary_frame import decode_binary_frame, find_blob, is_binary_frame
 
 # 配置日志
 
@@ -43,7 +44,7 @@ def generate_audio(params: str) -> dict:
     """使用ComfyUI生成图像"""
     logger.info(f"收到请求参数: {params}")
     try:
-        param_dict = json.loads(params)
+        param_dict = json.loads(params) if isinstance(params, str) else params
         tags = param_dict["tags"]
         lyrics = param_dict.get("lyrics", None)
         workflow_id = param_dict.get("workflow_id", "audio_ace_step_api")
@@ -66,7 +67,7 @@ def generate_image(params: str) -> dict:
     """使用ComfyUI生成图像"""
     logger.info(f"收到请求参数: {params}")
     try:
-        param_dict = json.loads(params)
+        param_dict = json.loads(params) if isinstance(params, str) else params
         prompt = param_dict["prompt"]
         width = param_dict.get("width", 512)
         height = param_dict.get("height", 512)
@@ -90,11 +91,11 @@ def generate_image(params: str) -> dict:
 
 # 定义视频生成工具
 @mcp.tool()
-def generate_image_to_video(params: str) -> dict:
+def generate_image_to_video(params: str, image_data: bytes = None) -> dict:
     """使用ComfyUI生成图像"""
     logger.info(f"收到请求参数: {params}")
     try:
-        param_dict = json.loads(params)
+        param_dict = json.loads(params) if isinstance(params, str) else params
         prompt = param_dict["prompt"]
         image_path = param_dict["image_path"]
         workflow_id = param_dict.get("workflow_id", "hy_image_to_video_api")
@@ -104,6 +105,7 @@ def generate_image_to_video(params: str) -> dict:
             image_path=image_path,
             prompt=prompt,
             workflow_id=workflow_id,
+            image_data=image_data,
         ))
         logger.info(f"返回视频URL: {video_url}")
         return {"image_url": video_url}
@@ -117,19 +119,26 @@ async def handle_websocket(websocket):
     logger.info("WebSocket客户端已连接")
     try:
         async for message in websocket:
-            request = json.loads(message)
+            # 二进制帧：头部 + 图像原始字节；文本消息：旧的 JSON 格式（params 为 JSON 字符串）
+            if is_binary_frame(message):
+                request, blobs = decode_binary_frame(message)
+            else:
+                request, blobs = json.loads(message), []
             logger.info(f"收到消息: {request}")
             if request.get("tool") == "generate_image":
                 result = generate_image(request.get("params", ""))
-                await websocket.send(json.dumps(result))
             elif request.get("tool") == "generate_image_to_video":
-                result = generate_image_to_video(request.get("params", ""))
-                await websocket.send(json.dumps(result))
+                image_data = find_blob(request, blobs, "image")
+                image_data = bytes(image_data) if image_data is not None else None
+                result = generate_image_to_video(request.get("params", ""), image_data)
             elif request.get("tool") == "generate_audio":
                 result = generate_audio(request.get("params", ""))
-                await websocket.send(json.dumps(result))
             else:
-                await websocket.send(json.dumps({"error": "未知工具"}))
+                result = {"error": "未知工具"}
+            # 回传 request_id，供长连接客户端对应请求
+            if "request_id" in request:
+                result["request_id"] = request["request_id"]
+            await websocket.send(json.dumps(result))
     except websockets.ConnectionClosed:
         logger.info("WebSocket客户端已断开连接")
 
@@ -137,7 +146,7 @@ async def handle_websocket(websocket):
 # 主服务器循环
 async def main():
     logger.info("正在启动MCP服务器在 ws://0.0.0.0:9100...")
-    async with websockets.serve(handle_websocket, "0.0.0.0", 9100):
+    async with websockets.serve(handle_websocket, "0.0.0.0", 9100, max_size=None):
         await asyncio.Future()  # 永远运行
 
 
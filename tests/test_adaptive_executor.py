@@ -0,0 +1,57 @@
+import asyncio
+import threading
+
+import pytest
+from aiohttp import web
+
+from agent.utils.adaptive_executor import run_adaptive
+from agent.utils.call_llm import LLMOverloadedError
+from agent.utils.llm_client import AsyncLLMClient
+
+
+@pytest.fixture
+def overloaded_server():
+    """始终返回 429 的服务，记录收到的请求数"""
+    hits = []
+    loop = asyncio.new_event_loop()
+
+    async def handle(request):
+        hits.append(1)
+        return web.json_response({"error": "busy"}, status=429)
+
+    async def start():
+        app = web.Application()
+        app.router.add_post("/", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        return runner, site._server.sockets[0].getsockname()[1]
+
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    runner, port = asyncio.run_coroutine_threadsafe(start(), loop).result()
+    yield f"http://127.0.0.1:{port}/", hits
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def test_overload_is_not_retried_inside_client_under_run_adaptive(overloaded_server):
+    url, hits = overloaded_server
+    client = AsyncLLMClient(max_retries=3, backoff_base=0.01)
+
+    def call(_):
+        status, _ = client.post_json_sync(url, {})
+        if status == 429:
+            raise LLMOverloadedError(status)
+        return status
+
+    results = list(run_adaptive(call, [1], max_workers=1, max_retries=3, backoff=0.01))
+    assert isinstance(results[0][2], LLMOverloadedError)
+    # 每次过载都交给执行器处理：1 次请求 + 3 次执行器重试，客户端内不再额外重试
+    assert len(hits) == 4
+
+    # 执行器之外仍按客户端配置重试
+    hits.clear()
+    assert client.post_json_sync(url, {})[0] == 429
+    assert len(hits) == 4
@@ -0,0 +1,25 @@
+import pytest
+
+import remote_caption_mcp_server.utils.binary_frame as caption_frame
+import remote_comfyui_mcp_server.binary_frame as comfyui_frame
+from agent.utils.binary_frame import encode_binary_frame
+
+
+@pytest.mark.parametrize("frame_module", [caption_frame, comfyui_frame])
+def test_servers_decode_blobs_in_header_order(frame_module):
+    message = encode_binary_frame({"tool": "batch", "request_id": 1},
+                                  [("image", b"first"), ("image", b"second"), ("mask", b"third")])
+    assert frame_module.is_binary_frame(message)
+    header, blobs = frame_module.decode_binary_frame(message)
+    assert header["tool"] == "batch"
+    # 同名字节块（如批量请求的多张图片）按顺序全部保留
+    assert [bytes(blob) for blob in blobs] == [b"first", b"second", b"third"]
+    assert bytes(frame_module.find_blob(header, blobs, "mask")) == b"third"
+    assert frame_module.find_blob(header, blobs, "video") is None
+
+
+@pytest.mark.parametrize("frame_module", [caption_frame, comfyui_frame])
+def test_truncated_frame_is_rejected(frame_module):
+    message = encode_binary_frame({"tool": "caption"}, [("image", b"abcdef")])
+    with pytest.raises(ValueError):
+        frame_module.decode_binary_frame(message[:-2])
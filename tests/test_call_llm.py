@@ -0,0 +1,42 @@
+import pytest
+
+import agent.utils.call_llm as call_llm_module
+from agent.tools.image_desc_structure import analyze_image_structure
+from agent.utils.call_llm import LLMResponseCache
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = LLMResponseCache(str(tmp_path / "llm_cache.db"))
+    monkeypatch.setenv("LLM_CACHE_ENABLED", "true")
+    monkeypatch.setenv("MODEL_PLATFORM", "local")
+    monkeypatch.setenv("LLM_CONSTRAINED_OUTPUT", "false")
+    monkeypatch.setenv("LLM_STREAM", "false")
+    monkeypatch.setattr(call_llm_module, "_llm_cache", cache)
+    return cache
+
+
+def _stub_model(monkeypatch, replies):
+    calls = []
+
+    def fake(prompt, output_schema=None):
+        calls.append(prompt)
+        return replies[min(len(calls), len(replies)) - 1], True
+
+    monkeypatch.setattr(call_llm_module, "call_local_llm", fake)
+    return calls
+
+
+def test_unparsable_reply_is_not_cached(cache, monkeypatch):
+    valid = "```yaml\nlens: 远景\ncomposition: 居中\nvisual_style: 胶片\n```"
+    calls = _stub_model(monkeypatch, ["no yaml here", valid])
+
+    assert analyze_image_structure("desc") == ("", "", "")
+    # 无法解析的响应没有写入缓存，再次调用会重新请求模型
+    assert analyze_image_structure("desc") == ("远景", "居中", "胶片")
+    assert cache.stats()["hits"] == 0
+
+    # 能解析的响应已缓存
+    assert analyze_image_structure("desc") == ("远景", "居中", "胶片")
+    assert cache.stats()["hits"] == 1
+    assert len(calls) == 2
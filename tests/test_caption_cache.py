@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+from remote_caption_mcp_server.utils.caption_cache import CaptionCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return CaptionCache(str(tmp_path / "caption_cache.db"))
+
+
+def test_cancelled_leader_does_not_fail_coalesced_waiter(cache):
+    async def scenario():
+        release = asyncio.Event()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await release.wait()
+            return "一幅测试图像"
+
+        leader = asyncio.create_task(cache.get_or_compute("key", compute))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(cache.get_or_compute("key", compute))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        assert await asyncio.wait_for(waiter, 1) == "一幅测试图像"
+        assert len(calls) == 1
+        assert cache.stats()["coalesced"] == 1
+
+    asyncio.run(scenario())
+    assert cache.get("key") == "一幅测试图像"
+    assert cache.stats()["inflight"] == 0
+
+
+def test_compute_error_reaches_every_waiter(cache):
+    async def scenario():
+        async def compute():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("推理失败")
+
+        results = await asyncio.gather(cache.get_or_compute("key", compute), cache.get_or_compute("key", compute),
+                                       return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+
+    asyncio.run(scenario())
+    assert cache.get("key") is None
+    assert cache.stats()["inflight"] == 0
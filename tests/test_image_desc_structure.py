@@ -0,0 +1,22 @@
+import agent.tools.image_desc_structure as image_desc_structure
+from agent.tools.image_desc_structure import analyze_image_structures
+
+
+def test_batch_rejects_malformed_entries_and_strips_values(monkeypatch):
+    replies = iter([
+        '```yaml\n"1":\n    lens: |\n        远景\n    composition: |\n        居中: 对称\n'
+        '    visual_style: 胶片\n"2":\n    lens:\n        a: b\n    composition: 居中\n    visual_style: 冷色\n```',
+        '```yaml\n"2":\n    lens: 近景\n    composition: 三分\n    visual_style: 冷色\n```',
+    ])
+    prompts = []
+
+    def fake_call_llm(prompt, **kwargs):
+        prompts.append(prompt)
+        return next(replies), True
+
+    monkeypatch.setattr(image_desc_structure, "call_llm", fake_call_llm)
+    results = analyze_image_structures({1: "描述一", 2: "描述二"})
+
+    assert results == {1: ("远景", "居中: 对称", "胶片"), 2: ("近景", "三分", "冷色")}
+    # 第二轮只重新请求结构有误的图片
+    assert "描述二" in prompts[1] and "描述一" not in prompts[1]
@@ -0,0 +1,38 @@
+import agent.node.weaver_node as weaver_node
+from agent.tools.image_selection import estimate_tokens, format_image_block, select_images
+
+
+def _images(count):
+    scenes = ["森林中的小屋", "城市夜景霓虹", "海边日落浪花", "宇宙飞船星云"]
+    return [{"id": index, "image_description": f"{scenes[index % 4]} 第{index}张", "lens": "远景",
+             "composition": "居中", "visual_style": scenes[index % 4]} for index in range(count)]
+
+
+def test_selection_fits_budget_and_keeps_input_order():
+    images = _images(200)
+    selected = select_images(images, token_budget=300)
+    assert sum(estimate_tokens(format_image_block(item)) for item in selected) <= 300
+    assert [item["id"] for item in selected] == sorted(item["id"] for item in selected)
+    # 多样性：各类场景都有入选
+    assert {item["id"] % 4 for item in selected} == {0, 1, 2, 3}
+
+
+def test_candidates_are_limited_to_most_relevant():
+    images = _images(500)
+    relevance = {item["id"]: (1.0 if item["id"] < 50 else 0.0) for item in images}
+    selected = select_images(images, token_budget=400, relevance_scores=relevance, candidate_limit=50)
+    assert selected and all(item["id"] < 50 for item in selected)
+
+
+def test_theme_selection_skips_vector_index_when_disabled(monkeypatch):
+    def _no_index(*args, **kwargs):
+        raise AssertionError("VECTOR_INDEX_ENABLED=false 时不应访问向量索引")
+
+    monkeypatch.setenv("VECTOR_INDEX_ENABLED", "false")
+    monkeypatch.setattr(weaver_node, "VectorIndex", _no_index)
+    monkeypatch.setattr(weaver_node, "_load_image_info_list", lambda shared: _images(40))
+    node = weaver_node.ImageSelectNode()
+    image_info_list, options = node.prep({"theme": "海边日落", "db_path": ":memory:", "image_id_list": []})
+    assert "relevance_scores" not in options
+    selected = node.exec((image_info_list, options))
+    assert any(item["visual_style"] == "海边日落浪花" for item in selected)
@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from PIL import Image
+
+from remote_caption_mcp_server.utils.inference_backend import CpuBackend
+
+# 前缀 KV 缓存需用真实 LLaVA 检查点校验（可用小型兼容检查点），未指定时跳过
+MODEL_PATH = os.getenv("CAPTION_TEST_MODEL_PATH")
+pytestmark = pytest.mark.skipif(not MODEL_PATH, reason="未设置 CAPTION_TEST_MODEL_PATH")
+
+
+@pytest.fixture(scope="module")
+def backend():
+    backend = CpuBackend(model_path=MODEL_PATH)
+    backend.load_processor()
+    backend.load_model()
+    return backend
+
+
+def test_prefix_cache_keeps_image_features(backend):
+    prompt = backend.format_prompt([{"role": "user", "content": "为这幅图像写一个描述。"}])
+    images = [Image.linear_gradient("L").convert("RGB").resize((64, 64)), Image.new("RGB", (64, 64), "red")]
+    generation_kwargs = {"max_new_tokens": 16, "do_sample": False}
+
+    backend.prefix_cache_enabled = False
+    expected = [backend.caption_batch(prompt, [image], **generation_kwargs)[0] for image in images]
+    backend.prefix_cache_enabled = True
+    actual = [backend.caption_batch(prompt, [image], **generation_kwargs)[0] for image in images]
+
+    assert backend.prefix_cache_enabled, "前缀缓存在生成时出错被关闭"
+    assert actual == expected
@@ -0,0 +1,47 @@
+from agent.tools.script_scoring import SCENE_FIELDS, score_script
+
+
+def _script(scene_ids=(1, 2, 3), summary_length=180, tags="pop, rock, sad"):
+    return {
+        "story_theme": "重逢",
+        "plot_summary": "久" * summary_length,
+        "key_plot_points": "相遇、回忆、告别",
+        "emotional_tone": "温暖",
+        "tags": tags,
+        "scenes": [{**{field: "内容" for field in SCENE_FIELDS}, "scene_number": index, "image_id": image_id}
+                   for index, image_id in enumerate(scene_ids, start=1)],
+    }
+
+
+def test_complete_script_gets_full_score():
+    assert score_script(_script(), [1, 2, 3, 4]) == (100, [])
+
+
+def test_script_without_scenes_is_not_scored():
+    assert score_script({"story_theme": "重逢", "scenes": []}, [1]) == (None, ["没有分镜"])
+    assert score_script("不是剧本", [1])[0] is None
+
+
+def test_invalid_image_ids_and_scene_count_lose_points():
+    score, problems = score_script(_script(scene_ids=(1, 9)), [1, 2, 3])
+    # 一半分镜引用了无效图片（-12.5），分镜数不足（-5）
+    assert score == 82.5
+    assert "无效的图片ID：9" in problems
+    assert any(problem.startswith("分镜数 2") for problem in problems)
+
+
+def test_summary_length_and_unknown_tags_lose_points():
+    score, problems = score_script(_script(summary_length=75, tags="pop, 不存在的风格"), [1, 2, 3])
+    assert score == 100 - 10 - 10
+    assert "梗概长度 75 字" in problems
+    assert "未知的音乐标签：不存在的风格" in problems
+
+
+def test_missing_fields_lower_structure_score():
+    script = _script()
+    del script["emotional_tone"]
+    script["scenes"][0]["narration_subtitle"] = " "
+    score, problems = score_script(script, [1, 2, 3])
+    assert score < 100
+    assert "缺少剧本字段：emotional_tone" in problems
+    assert any(problem.startswith("分镜字段完整度") for problem in problems)
@@ -0,0 +1,60 @@
+import re
+
+import pytest
+
+import agent.tools.story_outline as story_outline
+from agent.node.weaver_node import ChunkOutlineNode
+from agent.tools.image_selection import estimate_tokens, format_image_block
+from agent.tools.story_outline import chunk_by_time, format_outline_block
+
+TOKEN_BUDGET = 6000
+
+
+def _fake_structured(prompt, schema, use_cache=True, stream=None, repair=True):
+    """概括与合并都返回 100 字概括，关键图片取提示词中出现的前 4 个图片ID"""
+    ids = re.findall(r"图片ID: (\d+)", prompt)
+    for line in re.findall(r"关键图片ID：(.*)", prompt):
+        ids.extend(image_id.strip() for image_id in line.split(",") if image_id.strip())
+    return {
+        "chunk_theme": "旅途中的一天",
+        "summary": "清晨出发" * 25,
+        "key_images": [{"image_id": int(image_id)} for image_id in ids[:4]],
+    }
+
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    monkeypatch.setattr(story_outline, "call_llm_structured", _fake_structured)
+
+
+def _album(count):
+    return [{"id": index, "image_path": f"/album/{index}.jpg", "image_description": f"第{index}张照片",
+             "lens": "远景", "composition": "居中构图", "visual_style": "胶片质感"} for index in range(1, count + 1)]
+
+
+@pytest.mark.parametrize("count", [2000, 10000])
+def test_outlines_and_key_images_fit_budget(fake_llm, count):
+    images = _album(count)
+    chunks = chunk_by_time(images, {item["id"]: item["id"] * 60 for item in images}, TOKEN_BUDGET, 40)
+    options = {"key_image_count": 4, "token_budget": TOKEN_BUDGET, "outline_share": 0.5}
+    outlines, key_images = ChunkOutlineNode().exec(
+        (chunks, images, options, {"max_workers": 4, "rate": 0, "latency_target": 30}))
+
+    outline_tokens = sum(estimate_tokens(format_outline_block(index, outline))
+                         for index, outline in enumerate(outlines, start=1))
+    image_tokens = sum(estimate_tokens(format_image_block(item)) for item in key_images)
+    assert len(chunks) > len(outlines)
+    assert outline_tokens <= TOKEN_BUDGET * 0.5
+    assert outline_tokens + image_tokens <= TOKEN_BUDGET
+    # 关键图片保留了足够的预算，而不是只剩一张
+    assert len(key_images) >= 20
+    assert {item["id"] for item in key_images} <= {image_id for outline in outlines
+                                                    for image_id in outline["key_image_ids"]}
+
+
+def test_merge_fallback_keeps_key_images_from_each_outline(monkeypatch):
+    monkeypatch.setattr(story_outline, "call_llm_structured", lambda *args, **kwargs: None)
+    outlines = [{"chunk_theme": f"段落{index}", "summary": "概括", "key_image_ids": [index * 10, index * 10 + 1]}
+                for index in range(3)]
+    merged = story_outline.merge_outlines(outlines, key_image_count=4)
+    assert merged["key_image_ids"] == [0, 10, 20, 1]
@@ -0,0 +1,85 @@
+import pytest
+
+import agent.utils.structured_output as structured_output
+from agent.utils.structured_output import _salvage_fields, broken_fields, call_llm_structured, parse_tolerant
+
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "story_theme": {"type": "string"},
+        "plot_summary": {"type": "string"},
+        "scenes": {"type": "array", "minItems": 1,
+                   "items": {"type": "object", "properties": {"image_id": {"type": "integer"}},
+                             "required": ["image_id"]}},
+    },
+    "required": ["story_theme", "plot_summary", "scenes"],
+}
+
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    """按顺序返回预设的模型输出，记录每次调用的提示词与参数"""
+    monkeypatch.setenv("LLM_CONSTRAINED_OUTPUT", "false")
+    calls, replies = [], []
+
+    def fake(prompt, use_cache=True, stream=None, required_keys=None, output_schema=None, validate=None):
+        calls.append({"prompt": prompt, "use_cache": use_cache})
+        return replies.pop(0), True
+
+    monkeypatch.setattr(structured_output, "call_llm", fake)
+    return calls, replies
+
+
+def test_unfenced_reply_is_parsed():
+    assert parse_tolerant("<think>先想一想</think>\nstory_theme: 重逢\nplot_summary: 久别的朋友再次见面") == {
+        "story_theme": "重逢", "plot_summary": "久别的朋友再次见面"}
+
+
+def test_stray_colon_is_repaired_when_parsing():
+    assert parse_tolerant("```yaml\nstory_theme: 时间: 黄昏\n```") == {"story_theme": "时间: 黄昏"}
+
+
+def test_salvage_keeps_fields_that_parse():
+    block = "story_theme: 重逢\nscenes: [ {image_id: 1\nplot_summary: 久别的朋友再次见面"
+    assert parse_tolerant(block) is None
+    assert _salvage_fields(block) == {"story_theme": "重逢", "plot_summary": "久别的朋友再次见面"}
+
+
+def test_broken_fields_reports_missing_empty_and_mistyped():
+    data = {"story_theme": "", "scenes": [{"image_id": "abc"}]}
+    assert broken_fields(data, SCHEMA) == ["story_theme", "plot_summary", "scenes"]
+    assert broken_fields({"story_theme": "重逢", "plot_summary": "概括", "scenes": [{"image_id": "3"}]}, SCHEMA) == []
+    assert broken_fields(None, SCHEMA) == ["story_theme", "plot_summary", "scenes"]
+
+
+def test_valid_reply_needs_no_repair(fake_llm):
+    calls, replies = fake_llm
+    replies.append("```yaml\nstory_theme: 重逢\nplot_summary: 概括\nscenes:\n  - image_id: 3\n```")
+    assert call_llm_structured("写剧本", SCHEMA)["scenes"] == [{"image_id": 3}]
+    assert len(calls) == 1
+
+
+def test_partially_valid_reply_repairs_only_broken_fields(fake_llm):
+    calls, replies = fake_llm
+    replies.append("```yaml\nstory_theme: 重逢\nplot_summary: 时间: 黄昏\nscenes: 无\n```")
+    replies.append("```yaml\nscenes:\n  - image_id: 7\n```")
+    result = call_llm_structured("写剧本", SCHEMA)
+    assert result == {"story_theme": "重逢", "plot_summary": "时间: 黄昏", "scenes": [{"image_id": 7}]}
+    assert len(calls) == 2
+    # 修复请求只要求有问题的字段，且不走响应缓存
+    assert "其中 scenes 缺失或格式有误" in calls[1]["prompt"]
+    assert calls[1]["use_cache"] is False
+
+
+def test_unusable_reply_returns_none_without_repair(fake_llm):
+    calls, replies = fake_llm
+    replies.append("抱歉，我无法完成这个任务。")
+    assert call_llm_structured("写剧本", SCHEMA) is None
+    assert len(calls) == 1
+
+
+def test_failed_repair_returns_none(fake_llm):
+    calls, replies = fake_llm
+    replies.extend(["```yaml\nstory_theme: 重逢\nplot_summary: 概括\n```", "仍然没有分镜"])
+    assert call_llm_structured("写剧本", SCHEMA) is None
+    assert len(calls) == 2
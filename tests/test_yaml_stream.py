@@ -0,0 +1,51 @@
+import yaml
+
+from agent.utils.yaml_stream import FencedYamlMonitor, quote_stray_colons
+
+
+def test_stray_colon_in_value_is_quoted():
+    text = "story_theme: 时间: 黄昏\nquoted: \"已加引号: 保持不变\"\nurl: 无冒号"
+    assert yaml.safe_load(quote_stray_colons(text)) == {
+        "story_theme": "时间: 黄昏", "quoted": "已加引号: 保持不变", "url": "无冒号"}
+
+
+def test_block_scalar_content_is_untouched():
+    text = "scenes:\n  - summary: |\n      旁白: 第一句\n      第二句\n    image_id: 3"
+    assert quote_stray_colons(text) == text
+    assert yaml.safe_load(text)["scenes"][0]["summary"] == "旁白: 第一句\n第二句\n"
+
+
+def test_closed_block_stops_generation_and_drops_trailing_text():
+    monitor = FencedYamlMonitor(required_keys=["lens"])
+    assert monitor.feed("<think>先想一想</think>\n```yaml\nlens: 远景\n")
+    assert not monitor.feed("```\n多余的说明")
+    assert monitor.state == "closed"
+    assert monitor.data == {"lens": "远景"}
+    assert monitor.result_text().endswith("lens: 远景\n```")
+
+
+def test_missing_fence_is_malformed_after_deadline():
+    monitor = FencedYamlMonitor(fence_deadline_chars=20)
+    # 思考内容不计入期限
+    assert monitor.feed("<think>" + "想" * 50)
+    assert monitor.feed("</think>lens: 远景\n")
+    assert not monitor.feed("composition: 居中\n")
+    assert monitor.state == "malformed"
+
+
+def test_unclosed_block_is_parsed_on_finish():
+    monitor = FencedYamlMonitor(required_keys=["lens", "composition"])
+    monitor.feed("```yaml\nlens: 远景\n")
+    monitor.finish()
+    assert monitor.state == "malformed" and "composition" in monitor.error
+
+
+def test_syntax_error_aborts_only_once_it_is_far_from_the_end():
+    monitor = FencedYamlMonitor(check_every_lines=1)
+    lines = ["```yaml", "a: 1", "  b: 2", "c: 3", "d: 4"]
+    for line in lines:
+        assert monitor.feed(line + "\n")
+    # 错误在第 2 行，距末尾超过 3 行后才判定为无法修复
+    assert not monitor.feed("e: 5\n")
+    assert monitor.state == "malformed"
+    assert "第 2 行" in monitor.error
@@ -5,6 +5,7 @@ import pandas as pd
 from agent.agent_start import caption_flow, weaver_flow
 from agent.flow.weaver_flow import i2v_flow
 from database.db_manager import DatabaseManager
+from database.vector_index import VectorIndex, vector_index_enabled
 
 # 初始化数据库管理器
 db_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'db/image_database.db')
@@ -13,10 +14,17 @@ db_manager.connect()  # 确保连接已建立
 db_manager.create_script_table()  # 创建或确保剧本表存在
 db_manager.create_image_info_table()
 
-def run_caption_flow(image_dir):
+def run_caption_flow(image_dir, stream):
     """运行 caption_flow 并返回结果"""
-    caption_flow(image_dir, db_path)
-    return "Caption Flow 执行完成！"
+    shared = caption_flow(image_dir, db_path, stream=stream)
+    image_info_list = shared.get("image_info_list") or []
+    ttft_list = [item["ttft"] for item in image_info_list if item.get("ttft") is not None]
+    duration_list = [item["duration"] for item in image_info_list if item.get("duration") is not None]
+    if not image_info_list:
+        return "Caption Flow 执行完成！没有需要识别的新图片。"
+    return (f"Caption Flow 执行完成！新识别图片 {len(image_info_list)} 张，"
+            f"平均首字延迟 {sum(ttft_list) / max(len(ttft_list), 1):.2f}s，"
+            f"平均单张耗时 {sum(duration_list) / max(len(duration_list), 1):.2f}s")
 
 
 def run_i2v_flow(selected_ids):
@@ -24,10 +32,39 @@ def run_i2v_flow(selected_ids):
     i2v_flow(script_id=selected_ids, db_path=db_path)
     return f"i2v_flow执行完成！选择的剧本 ID: {selected_ids}"
 
-def run_weaver_flow(selected_ids):
+def run_weaver_flow(selected_ids, theme):
     """运行 weaver_flow 并返回结果"""
-    weaver_flow(image_id_list=selected_ids, db_path=db_path)
+    weaver_flow(image_id_list=selected_ids, db_path=db_path, theme=theme.strip() or None)
     return f"Weaver Flow 执行完成！选择的图片 ID: {selected_ids}"
+
+
+def search_images(query, similar_image_id, top_k):
+    """按文本或相似图片检索图片描述向量索引"""
+    columns = ["ID", "相似度", "图片描述", "图片存储位置"]
+    if not vector_index_enabled():
+        gr.Warning("未启用向量索引（VECTOR_INDEX_ENABLED=false），无法检索")
+        return pd.DataFrame(columns=columns)
+    vector_index = VectorIndex(db_manager)
+    top_k = int(top_k or 20)
+    if str(similar_image_id or "").strip():
+        try:
+            image_id = int(str(similar_image_id).strip())
+        except ValueError:
+            gr.Warning(f"相似图片ID必须是整数：{similar_image_id}")
+            return pd.DataFrame(columns=columns)
+        hits = vector_index.similar_images(image_id, top_k=top_k)
+    elif query.strip():
+        hits = vector_index.search_text(query.strip(), top_k=top_k)
+    else:
+        hits = []
+    image_info = {info['id']: info for info in db_manager.get_all_image_info([image_id for image_id, _ in hits])} \
+        if hits else {}
+    return pd.DataFrame({
+        columns[0]: [image_id for image_id, _ in hits],
+        columns[1]: [round(score, 3) for _, score in hits],
+        columns[2]: [image_info[image_id]['image_description'] for image_id, _ in hits],
+        columns[3]: [image_info[image_id]['image_name'] for image_id, _ in hits]
+    })
 def get_all_image_info():
     """获取所有图片信息"""
     image_info = db_manager.get_all_image_info()
@@ -108,10 +145,11 @@ with gr.Blocks() as demo:
         image_dir_input = gr.Text(label="图片文件夹路径",
                                   value=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
                                                      "example"))
+        stream_checkbox = gr.Checkbox(label="流式识别（逐段返回文本，统计首字延迟）", value=False)
         run_button = gr.Button("执行图片识别")
         output_text = gr.Textbox(label="执行结果")
 
-        run_button.click(run_caption_flow, inputs=image_dir_input, outputs=output_text)
+        run_button.click(run_caption_flow, inputs=[image_dir_input, stream_checkbox], outputs=output_text)
 
     # Tab2: 展示所有 image_info 📸🔍
     with gr.Tab("选择图片->构建剧本"):
@@ -144,10 +182,29 @@ with gr.Blocks() as demo:
 
         image_id_checkboxes = gr.CheckboxGroup(choices=get_image_id_list(), label="选择剧本可能使用到的图片(ID)",
                                                interactive=True)  # 确保为交互式
+        theme_input = gr.Textbox(label="创作主题（可选，用于召回相关图片）")
         run_weaver_button = gr.Button("执行构建剧本")
         weaver_output = gr.Textbox(label="执行结果")
 
-        run_weaver_button.click(run_weaver_flow, inputs=image_id_checkboxes, outputs=weaver_output)
+        run_weaver_button.click(run_weaver_flow, inputs=[image_id_checkboxes, theme_input], outputs=weaver_output)
+
+    # Tab: 检索图片 🔎
+    with gr.Tab("检索图片"):
+        # 说明：按主题/关键词或相似图片检索图片描述
+        with gr.Row():
+            search_query_input = gr.Textbox(label="主题或关键词")
+            similar_image_input = gr.Textbox(label="相似图片ID（填写后按该图片检索）")
+            search_top_k = gr.Number(value=20, precision=0, label="返回数量")
+        search_button = gr.Button("检索")
+        search_output = gr.Dataframe(
+            headers=["ID", "相似度", "图片描述", "图片存储位置"],
+            label="检索结果",
+            column_widths=[1, 2, 20, 5],
+            wrap=True
+        )
+
+        search_button.click(search_images, inputs=[search_query_input, similar_image_input, search_top_k],
+                            outputs=search_output)
 
     # Tab3: 查看剧本信息 📖🔍
     with gr.Tab("查看剧本"):